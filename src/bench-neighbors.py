@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Benchmark the neighbor search backends (see lsd/neighbors.py) on
+# crossmatches of a synthetic cell, at PS1-like source densities.
+#
+# Example: bench-neighbors.py --density=1e4,1e5,1e6 --nmax=1,5
+#
+
+import sys
+import time
+import getopt
+import numpy as np
+from lsd import neighbors
+
+def usage():
+	print "Usage: %s [--density=1e4,1e5,1e6 (per sq. deg.)] [--size=0.5 (deg)] [--radius=1 (arcsec)] [--nmax=1,5] [--backends=grid,kdtree,ann]" % sys.argv[0]
+
+optlist, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'density=', 'size=', 'radius=', 'nmax=', 'backends='])
+
+densities = [ 1e4, 1e5, 1e6 ]	# PS1 3pi: ~1e4 (high latitudes) to ~1e6 (plane) objects per sq. deg.
+size = 0.5			# Side of the (square) cell, in degrees
+radius = 1.			# Crossmatch radius, in arcsec
+nmaxs = [ 1, 5 ]
+names = neighbors.available_backends()
+for (o, a) in optlist:
+	if o == '-h' or o == '--help':
+		usage()
+		exit()
+	if o == '--density':
+		densities = [ float(v) for v in a.split(',') ]
+	if o == '--size':
+		size = float(a)
+	if o == '--radius':
+		radius = float(a)
+	if o == '--nmax':
+		nmaxs = [ int(v) for v in a.split(',') ]
+	if o == '--backends':
+		names = a.split(',')
+
+print "Backends: %s (unavailable: %s)" % (', '.join(names), ', '.join(sorted(set(neighbors.backends) - set(neighbors.available_backends()))) or '-')
+print "%10s %10s %5s %8s %10s %10s %10s" % ('density', 'nobj', 'nmax', 'backend', 'build (s)', 'match (s)', 'matches')
+
+clon, clat = 180., 30.
+np.random.seed(42)
+for density in densities:
+	# A cell of objects, and a catalog of detections of 80% of them
+	# (with 0.1" scatter), plus 20% as many unrelated sources
+	n = int(density * size * size)
+	lon2 = clon + np.random.uniform(-size/2, size/2, n) / np.cos(np.radians(clat))
+	lat2 = np.random.uniform(clat - size/2, clat + size/2, n)
+	det = np.random.rand(n) < 0.8
+	lon1 = np.concatenate((lon2[det] + np.random.normal(0, 0.1/3600, det.sum()) / np.cos(np.radians(clat)), np.random.uniform(lon2.min(), lon2.max(), n // 5)))
+	lat1 = np.concatenate((lat2[det] + np.random.normal(0, 0.1/3600, det.sum()), np.random.uniform(lat2.min(), lat2.max(), n // 5)))
+
+	for nmax in nmaxs:
+		for name in names:
+			t0 = time.time()
+			search = neighbors.get_backend(name).build(lon2, lat2, clon, clat)
+			t1 = time.time()
+			i1, i2, dist, nr = neighbors.xmatch(search, lon1, lat1, lon2, lat2, nmax, radius / 3600.)
+			t2 = time.time()
+			print "%10.0e %10d %5d %8s %10.3f %10.3f %10d" % (density, n, nmax, name, t1 - t0, t2 - t1, len(i1))
+			sys.stdout.flush()
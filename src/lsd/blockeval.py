@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Blocked evaluation of elementwise query expressions
+
+A query expression such as
+
+	(g - r < 0.5) & (psf_mag - ap_mag < 0.1)
+
+evaluated with eval() creates a full-length temporary for each
+intermediate result (g - r, g - r < 0.5, ...), each as large as the
+cell. On cells of millions of rows these don't fit into the CPU
+caches, and the evaluation becomes bound by memory bandwidth.
+
+If an expression consists only of elementwise operations (arithmetic,
+comparisons, bitwise logic, and calls to numpy ufuncs), it can instead
+be evaluated in blocks of rows small enough that all the temporaries of
+a block stay in cache, with only the final result being allocated at
+full size. compile_blocked() recognizes such expressions; anything else
+(UDF calls, indexing, method calls, ...) is left to eval().
+"""
+
+import ast
+import os
+import operator
+import numpy as np
+
+# Set LSD_BLOCKED_EVAL=0 to always evaluate query expressions with eval()
+enabled = os.getenv("LSD_BLOCKED_EVAL", "1") != "0"
+
+# Number of rows evaluated in a single pass, and the number of rows
+# below which plain eval() is used
+block_rows = int(os.getenv("LSD_EVAL_BLOCK_ROWS", 8192))
+min_rows = int(os.getenv("LSD_EVAL_MIN_ROWS", 4 * block_rows))
+
+_binops = {
+	ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+	ast.Div: operator.div, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+	ast.Pow: operator.pow, ast.BitAnd: operator.and_, ast.BitOr: operator.or_,
+	ast.BitXor: operator.xor, ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+}
+_unaryops = {
+	ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Invert: operator.invert,
+}
+_cmpops = {
+	ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt,
+	ast.GtE: operator.ge, ast.Eq: operator.eq, ast.NotEq: operator.ne,
+}
+
+_scalar_types = (int, long, float, complex, bool, str, np.generic)
+
+class _Fallback(Exception):
+	# Raised if an expression can't be evaluated in blocks
+	pass
+
+class BlockedExpr(object):
+	""" An elementwise expression, compiled to a tree of closures
+	    that evaluate it on a block of rows.
+
+	    The leaves of the tree (names, and attributes of names) are
+	    looked up once per evaluation, before the blocked passes.
+	"""
+	def __init__(self, expr):
+		self.expr = expr
+		self.leaves = []	# List of leaf AST nodes, in order of lookup
+		self.ufuncs = []	# Indices (into leaves) of called objects (must be numpy ufuncs)
+
+		tree = ast.parse(expr.strip(), mode='eval')
+		self.fun = self._compile(tree.body)
+
+	def _leaf(self, node):
+		# Register a leaf, and return its evaluator
+		i = len(self.leaves)
+		self.leaves.append(node)
+		return lambda vals, sl: vals[i][sl] if isinstance(vals[i], np.ndarray) and vals[i].ndim else vals[i]
+
+	def _compile(self, node):
+		# Return a function (vals, sl) -> value of node on rows sl,
+		# where vals is the list of values of the leaves
+		if isinstance(node, ast.BinOp) and type(node.op) in _binops:
+			op, l, r = _binops[type(node.op)], self._compile(node.left), self._compile(node.right)
+			return lambda vals, sl: op(l(vals, sl), r(vals, sl))
+		elif isinstance(node, ast.UnaryOp) and type(node.op) in _unaryops:
+			op, v = _unaryops[type(node.op)], self._compile(node.operand)
+			return lambda vals, sl: op(v(vals, sl))
+		elif isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _cmpops:
+			# Chained comparisons are ambiguous for arrays
+			op, l, r = _cmpops[type(node.ops[0])], self._compile(node.left), self._compile(node.comparators[0])
+			return lambda vals, sl: op(l(vals, sl), r(vals, sl))
+		elif isinstance(node, ast.Call) and not (node.keywords or node.starargs or node.kwargs) and isinstance(node.func, (ast.Name, ast.Attribute)):
+			self.ufuncs.append(len(self.leaves))
+			f = self._compile(node.func)
+			args = [ self._compile(arg) for arg in node.args ]
+			return lambda vals, sl: f(vals, sl)(*[ arg(vals, sl) for arg in args ])
+		elif isinstance(node, (ast.Num, ast.Str)):
+			val = node.n if isinstance(node, ast.Num) else node.s
+			return lambda vals, sl: val
+		elif isinstance(node, ast.Name) or (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name)):
+			return self._leaf(node)
+		else:
+			raise _Fallback()
+
+	def _lookup(self, node, globals_, locals_):
+		if isinstance(node, ast.Attribute):
+			return getattr(self._lookup(node.value, globals_, locals_), node.attr)
+
+		name = node.id
+		if name in locals_:
+			return locals_[name]
+		if name in globals_:
+			return globals_[name]
+		if name in ('True', 'False', 'None'):
+			return eval(name)
+		raise _Fallback()		# Let eval() raise the NameError
+
+	def evaluate(self, globals_, locals_):
+		""" Evaluate the expression in blocks of rows, with the
+		    names resolved from locals_ and globals_ (as with
+		    eval()). Returns None if the expression is better left
+		    to eval() (e.g., it calls a function that isn't a numpy
+		    ufunc, it has no array operands, or these are too
+		    short).
+		"""
+		try:
+			vals = [ self._lookup(node, globals_, locals_) for node in self.leaves ]
+		except _Fallback:
+			return None
+
+		# Called objects must be ufuncs, all other leaves arrays or scalars
+		ufuncs = set(self.ufuncs)
+		n, atype = None, None
+		for i, val in enumerate(vals):
+			if i in ufuncs:
+				if not isinstance(val, np.ufunc):
+					return None
+			elif isinstance(val, np.ndarray):
+				if val.dtype.names is not None:
+					return None
+				if val.ndim:
+					if n is None:
+						n, atype = len(val), type(val)
+					elif len(val) != n:
+						return None
+			elif not isinstance(val, _scalar_types):
+				return None
+
+		if n is None or n < min_rows:
+			return None
+
+		# Evaluate, block by block
+		out = None
+		for start in xrange(0, n, block_rows):
+			sl = slice(start, min(start + block_rows, n))
+			res = self.fun(vals, sl)
+			if getattr(res, 'ndim', 0) == 0 or len(res) != sl.stop - sl.start:
+				# Broadcasts to something other than a column
+				return None
+			if out is None:
+				out = np.empty((n,) + res.shape[1:], dtype=res.dtype)
+			out[sl] = res
+
+		return out.view(atype)
+
+def compile_blocked(expr):
+	""" Return a BlockedExpr for the expression, or None if it
+	    contains operations that aren't elementwise.
+	"""
+	try:
+		bexpr = BlockedExpr(expr)
+	except (_Fallback, SyntaxError):
+		return None
+
+	# Nothing to be gained for a bare name or constant
+	if not bexpr.ufuncs and isinstance(ast.parse(expr.strip(), mode='eval').body, (ast.Name, ast.Attribute, ast.Num, ast.Str)):
+		return None
+
+	return bexpr
+
+###################################################################
+## Unit tests
+
+class Test_BlockedExpr:
+	def setUp(self):
+		global block_rows, min_rows
+		self.block_rows, self.min_rows = block_rows, min_rows
+		block_rows, min_rows = 7, 0
+
+		n = 100
+		self.locals_ = {
+			'g': np.linspace(15, 22, n), 'r': np.linspace(14, 23, n)[::-1],
+			'flags': np.arange(n, dtype=np.uint32), 'name': np.array(['a', 'b'] * (n // 2)),
+			'xy': np.arange(2 * n).reshape(n, 2),
+		}
+		self.globals_ = dict(np.__dict__)
+
+	def tearDown(self):
+		global block_rows, min_rows
+		block_rows, min_rows = self.block_rows, self.min_rows
+
+	def check(self, expr, blocked=True):
+		bexpr = compile_blocked(expr)
+		res = bexpr.evaluate(self.globals_, self.locals_) if bexpr is not None else None
+		assert (res is not None) == blocked, expr
+		if blocked:
+			expect = eval(expr, self.globals_, self.locals_)
+			assert res.dtype == expect.dtype and res.shape == expect.shape, expr
+			assert np.all(res == expect), expr
+
+	def test_elementwise(self):
+		""" Blocked evaluation of elementwise expressions """
+		self.check('(g - r < 0.5) & (g > 16)')
+		self.check('~((flags & 3) == 0) | (name == "a")')
+		self.check('sqrt(abs(g - r)) * 2 + 1 / g')
+		self.check('-flags % 7 + flags / 3')
+		self.check('xy * 2 + 1')
+		self.check('where(g > 18, g, r)', blocked=False)	# Not a ufunc
+
+	def test_fallback(self):
+		""" Non-elementwise expressions are left to eval """
+		self.check('g', blocked=False)
+		self.check('g[::2] + 1', blocked=False)
+		self.check('g.sum() - r', blocked=False)
+		self.check('(g < r < 20)', blocked=False)
+		self.check('sqrt(g, out=None)', blocked=False)
+		self.check('1 + 2', blocked=False)
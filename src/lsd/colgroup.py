@@ -593,12 +593,31 @@ class ColGroup(object):
 		return self
 
 
-def fromiter(it, dtype=None, blocks=False):
+def fromiter(it, dtype=None, blocks=False, copy=True):
 	"""
 	Load a ColGroup from an iterable.
+
+	If copy=False, the blocks yielded by the iterable are assumed not
+	to be used elsewhere: a single block is returned as-is, and
+	multiple blocks are concatenated only once, at the end (instead
+	of being appended to a growing buffer).
 	"""
 	assert blocks == True, "blocks==False not implemented yet."
 
+	if not copy:
+		bufs = list(it)
+		if len(bufs) == 0:
+			return ColGroup(dtype=dtype, size=0)
+		elif len(bufs) == 1:
+			return bufs[0]
+		elif not isinstance(bufs[0], ColGroup):
+			return np.concatenate(bufs)
+
+		buf = ColGroup(info=bufs[0].info)
+		for name in bufs[0].keys():
+			buf.add_column(name, np.concatenate([ rows[name] for rows in bufs ]))
+		return buf
+
 	buf = None
 	for rows in it:
 		if buf is None:
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+"""
+GROUP BY aggregation of query results
+
+A query such as
+
+	SELECT obj_id, count() AS n, mean(mag) AS mag, quantile(mag, 0.9) AS mag90
+	FROM ... WHERE ... GROUP BY obj_id
+
+is executed by reducing the rows of each cell to partial aggregates
+(the number of rows, and the sums, minima and maxima of the aggregated
+expressions, for each group), computed with vectorized sorts and
+ufunc.reduceat calls. The partials are merged across all cells a worker
+processes, hash-partitioned on the GROUP BY keys, and merged once more,
+per partition, in the reduce step that computes the final values of the
+aggregates. Only the quantiles require the individual values; these are
+kept (sorted within each group) only for the expressions whose quantiles
+were requested.
+
+The supported aggregate functions are:
+
+	count()		- the number of rows in the group
+	sum(expr)	- the sum of expr
+	mean(expr)	- the mean of expr
+	min(expr)	- the minimum of expr
+	max(expr)	- the maximum of expr
+	quantile(expr, q) - the q-th quantile (0 <= q <= 1) of expr,
+			  linearly interpolated (as numpy.percentile)
+
+As with numpy, the aggregates of expressions (other than count()) are
+NaN for groups where the expression is NaN in any row.
+"""
+
+import ast
+import os
+import numpy as np
+import query_parser as qp
+from colgroup import ColGroup
+
+# Aggregate functions: name -> (number of arguments, partial aggregates
+# needed to compute it)
+aggregates = {
+	'count':    (0, ()),
+	'sum':      (1, ('sum',)),
+	'mean':     (1, ('sum',)),
+	'min':      (1, ('min',)),
+	'max':      (1, ('max',)),
+	'quantile': (2, ('values',)),
+}
+
+_reduce_ufuncs = { 'sum': np.add, 'min': np.minimum, 'max': np.maximum }
+
+# The number of groups a worker accumulates before merging them, and
+# passing them on to the reducers if there's still more than half as
+# many after the merge
+max_groups = int(os.getenv("LSD_GROUPBY_MAX_GROUPS", 2**20))
+
+def _normalize(expr):
+	# A canonical form of the expression, to recognize the same
+	# expression written differently (e.g., 'a//10' and 'a // 10')
+	return ast.dump(ast.parse(expr.strip(), mode='eval'))
+
+def _strip_parens(expr):
+	# Remove the redundant parenthesis around the expression
+	expr = expr.strip()
+	while expr[:1] == '(' and expr[-1:] == ')':
+		try:
+			if _normalize(expr[1:-1]) != _normalize(expr):
+				break
+		except SyntaxError:
+			break
+		expr = expr[1:-1].strip()
+	return expr
+
+def _parse_aggregate(expr):
+	# Return (function, argument, q) if expr is a call to an aggregate
+	# function, None otherwise
+	expr = _strip_parens(expr)
+	node = ast.parse(expr, mode='eval').body
+	if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in aggregates):
+		return None
+
+	fun = node.func.id
+	if node.keywords or node.starargs or node.kwargs:
+		raise Exception('Aggregate function %s() takes no keyword arguments' % fun)
+	args = qp.split_toplevel(expr[expr.index('(')+1:-1])
+	nargs = aggregates[fun][0]
+	if len(args) != nargs:
+		raise Exception('Aggregate function %s() takes %d argument(s) (%d given)' % (fun, nargs, len(args)))
+
+	q = None
+	if fun == 'quantile':
+		try:
+			q = float(ast.literal_eval(args[1]))
+		except (ValueError, SyntaxError):
+			raise Exception('The second argument of quantile() must be a number (got "%s")' % args[1])
+		if not 0 <= q <= 1:
+			raise Exception('The second argument of quantile() must be between 0 and 1 (got %s)' % args[1])
+
+	return (fun, args[0] if args else None, q)
+
+def _sum_dtype(dtype):
+	# Sums are accumulated in 64 bits
+	return {'b': np.int64, 'i': np.int64, 'u': np.uint64, 'f': np.float64}.get(dtype.kind, dtype)
+
+def _group(keys):
+	# Sort the rows by the key columns; return the sort order, the
+	# indices (into the sorted rows) of the first row of each group,
+	# and the group of each row. NaNs are grouped together.
+	n = len(keys[0])
+	order = np.lexsort(keys[::-1])
+
+	first = np.zeros(n, dtype=bool)
+	first[:1] = True
+	for k in keys:
+		k = k[order]
+		new = k[1:] != k[:-1]
+		if k.dtype.kind in 'fc':
+			new &= ~(np.isnan(k[1:]) & np.isnan(k[:-1]))
+		first[1:] |= new
+
+	group = np.empty(n, dtype=np.intp)
+	group[order] = np.cumsum(first) - 1
+	return order, np.flatnonzero(first), group
+
+def _hash(keys):
+	# A hash of the keys, reproducible across processes (FNV-1a of the
+	# bytes of the values)
+	h = np.empty(len(keys[0]), dtype=np.uint64)
+	h[:] = 14695981039346656037
+	prime = np.uint64(1099511628211)
+	for k in keys:
+		if k.dtype.kind == 'O':
+			k = np.array([ hash(v) for v in k ], dtype=np.int64)
+		elif k.dtype.kind in 'fc':
+			k = k + 0.0		# -0.0 == 0.0 (hashed as 0.0)
+		b = np.ascontiguousarray(k).view(np.uint8).reshape(len(k), -1)
+		for c in xrange(b.shape[1]):
+			h = (h ^ b[:, c]) * prime
+	return h
+
+def _quantile(values, n, q):
+	# The q-th quantile of each group, for values grouped into groups of
+	# n (sorted within each group)
+	if values.dtype.kind in 'biu':
+		values = values.astype(np.float64)
+	offs = np.cumsum(n) - n
+	pos = q * (n - 1)
+	lo = np.floor(pos).astype(np.int64)
+	hi = np.minimum(lo + 1, n - 1)
+	frac = pos - lo
+	quantiles = values[offs + lo] * (1 - frac) + values[offs + hi] * frac
+
+	# NaNs sort last within each group; a group with any NaN has a
+	# NaN quantile (as with numpy.percentile)
+	if values.dtype.kind in 'fc':
+		quantiles[np.isnan(values[offs + n - 1])] = np.nan
+	return quantiles
+
+class Partial(object):
+	""" Partial aggregates of a set of rows, for each group """
+	def __init__(self, keys, n, aggs, values):
+		self.keys = keys	# List of key columns (one row per group)
+		self.n = n		# The number of rows in each group
+		self.aggs = aggs	# (aggregate, argument index) -> partial aggregate of each group
+		self.values = values	# argument index -> values of the argument, grouped as the keys, and sorted within each group
+
+	def __len__(self):
+		return len(self.n)
+
+	def select(self, mask):
+		""" Return the partial aggregates of the selected groups """
+		values = dict(( (j, v[np.repeat(mask, self.n)]) for (j, v) in self.values.iteritems() ))
+		aggs = dict(( (agg, col[mask]) for (agg, col) in self.aggs.iteritems() ))
+		return Partial([ k[mask] for k in self.keys ], self.n[mask], aggs, values)
+
+class GroupBy(object):
+	""" The execution plan of the aggregates of a GROUP BY query.
+
+	    The SELECT clause of the query is replaced by select_clause,
+	    computing the GROUP BY keys and the arguments of the
+	    aggregates. The resulting rows are reduced to Partial
+	    aggregates (partial()), merged (merge()), and finally
+	    converted to the requested columns (finalize()).
+	"""
+	keys     = None		# The GROUP BY expressions
+	keynames = None		# The names of the key columns in select_clause
+	args     = None		# The arguments of the aggregates
+	needs    = None		# The partial aggregates needed for each argument
+	columns  = None		# (name, function, index, q) for each output column ('key' function for keys)
+	select_clause = None	# The SELECT clause evaluating the keys and arguments
+
+	def __init__(self, select_clause, group_by):
+		# GROUP BY may refer to SELECT-ed keys by their names
+		aliases = dict(( (asnames[0], expr) for (asnames, expr) in select_clause if len(asnames) == 1 ))
+
+		self.keys, keyidx = [], {}
+		for expr in group_by:
+			expr = aliases.get(expr, expr)
+			norm = _normalize(expr)
+			if norm not in keyidx:
+				keyidx[norm] = len(self.keys)
+				self.keys.append(expr)
+		self.keynames = [ '_G%d' % i for i in xrange(len(self.keys)) ]
+
+		self.args, argidx = [], {}
+		self.columns = []
+		for (asnames, expr) in select_clause:
+			if len(asnames) > 1:
+				raise Exception('Columns of GROUP BY queries must have a single name ("%s")' % expr)
+			name = asnames[0] if asnames else expr
+
+			agg = _parse_aggregate(expr)
+			if agg is None:
+				i = keyidx.get(_normalize(expr))
+				if i is None:
+					raise Exception('"%s" is neither an aggregate nor a GROUP BY expression' % expr)
+				if asnames:
+					self.keynames[i] = asnames[0]	# So that WHERE can refer to it
+				self.columns.append((name, 'key', i, None))
+			else:
+				(fun, arg, q) = agg
+				j = None
+				if arg is not None:
+					j = argidx.setdefault(_normalize(arg), len(self.args))
+					if j == len(self.args):
+						self.args.append(arg)
+				self.columns.append((name, fun, j, q))
+
+		self.needs = [ set() for _ in self.args ]
+		for (_, fun, j, _) in self.columns:
+			if fun != 'key' and j is not None:
+				self.needs[j].update(aggregates[fun][1])
+
+		self.select_clause = [ ([name], expr) for (name, expr) in zip(self.keynames, self.keys) ] + \
+				     [ (['_A%d' % j], arg) for (j, arg) in enumerate(self.args) ]
+
+	def partial(self, rows):
+		""" Reduce the rows (computed by select_clause) to partial
+		    aggregates
+		"""
+		keys = []
+		for (name, expr) in zip(self.keynames, self.keys):
+			k = np.asarray(rows[name])
+			if k.ndim != 1:
+				raise Exception('GROUP BY expression "%s" must evaluate to a scalar per row' % expr)
+			keys.append(k)
+
+		aggs, values = {}, {}
+		for (j, needs) in enumerate(self.needs):
+			col = np.asarray(rows['_A%d' % j])
+			for agg in needs:
+				if agg == 'sum':
+					aggs[(agg, j)] = col.astype(_sum_dtype(col.dtype))
+				elif agg == 'values':
+					values[j] = col
+				else:
+					aggs[(agg, j)] = col
+
+		# Each row is a group of its own; merge() groups them
+		n = np.ones(len(rows), dtype=np.int64)
+		return self.merge([ Partial(keys, n, aggs, values) ])
+
+	def merge(self, parts):
+		""" Merge a list of Partial aggregates """
+		keys = [ np.concatenate([ p.keys[i] for p in parts ]) for i in xrange(len(self.keys)) ]
+		n = np.concatenate([ p.n for p in parts ])
+		order, starts, group = _group(keys)
+
+		if len(n):
+			reduceat = lambda ufunc, col: ufunc.reduceat(col[order], starts)
+		else:
+			reduceat = lambda ufunc, col: col
+		keys = [ k[order[starts]] for k in keys ]
+		aggs = dict(( ((agg, j), reduceat(_reduce_ufuncs[agg], np.concatenate([ p.aggs[(agg, j)] for p in parts ])))
+				for (agg, j) in parts[0].aggs ))
+
+		# Regroup the individual values, and sort them within groups
+		values = {}
+		if parts[0].values:
+			vgroup = np.repeat(group, n)
+			for j in parts[0].values:
+				v = np.concatenate([ p.values[j] for p in parts ])
+				values[j] = v[np.lexsort((v, vgroup))]
+
+		return Partial(keys, reduceat(np.add, n), aggs, values)
+
+	def partition(self, part, nparts):
+		""" Split the Partial aggregates into nparts partitions by
+		    the hash of the keys. Yields (partition, Partial) for
+		    the nonempty partitions.
+		"""
+		p = _hash(part.keys) % np.uint64(nparts)
+		for i in np.unique(p):
+			yield (int(i), part.select(p == i))
+
+	def finalize(self, part):
+		""" Compute the output columns from the (fully merged)
+		    Partial aggregates. Returns a ColGroup.
+		"""
+		rows = ColGroup()
+		for (name, fun, j, q) in self.columns:
+			if fun == 'key':
+				col = part.keys[j]
+			elif fun == 'count':
+				col = part.n
+			elif fun == 'mean':
+				col = np.true_divide(part.aggs[('sum', j)], part.n)
+			elif fun == 'quantile':
+				col = _quantile(part.values[j], part.n, q)
+			else:
+				col = part.aggs[(fun, j)]
+			rows.add_column(name, col)
+		return rows
+
+	def empty(self, rows):
+		""" The (empty) result of the query, given a block of
+		    (possibly empty) rows with the dtypes of select_clause
+		"""
+		return self.finalize(self.partial(rows[:0]))
+
+class GroupByMapper(object):
+	""" The mapper of GROUP BY queries (see Query.iterate).
+
+	    Reduces the rows to partial aggregates, which are merged
+	    over all cells processed by the worker, and yielded as
+	    (partition, Partial) pairs once the worker is done (see
+	    map_done), or more than max_groups groups have accumulated.
+	"""
+	def __init__(self, gb, nparts):
+		self.gb, self.nparts = gb, nparts
+		self.parts, self.ngroups = [], 0
+
+	def __call__(self, qresult):
+		for rows in qresult:
+			if not len(rows):
+				continue
+
+			part = self.gb.partial(rows)
+			self.parts.append(part)
+			self.ngroups += len(part)
+
+			if self.ngroups >= max_groups:
+				part = self.gb.merge(self.parts)
+				self.parts, self.ngroups = [ part ], len(part)
+				if self.ngroups >= max_groups // 2:
+					for kv in self.map_done():
+						yield kv
+
+	def map_done(self):
+		if not self.parts:
+			return
+
+		part = self.gb.merge(self.parts) if len(self.parts) > 1 else self.parts[0]
+		self.parts, self.ngroups = [], 0
+
+		for kv in self.gb.partition(part, self.nparts):
+			yield kv
+
+def groupby_reducer(kv, gb):
+	""" The reducer of GROUP BY queries: merges the partial
+	    aggregates of a partition, and yields (partition, rows) with
+	    the final values
+	"""
+	p, parts = kv
+
+	acc, ngroups = [], 0
+	for part in parts:
+		acc.append(part)
+		ngroups += len(part)
+		if ngroups >= max_groups and len(acc) > 1:
+			part = gb.merge(acc)
+			acc, ngroups = [ part ], len(part)
+
+	part = gb.merge(acc) if len(acc) > 1 else acc[0]
+	yield (p, gb.finalize(part))
+
+###################################################################
+## Unit tests
+
+class Test_GroupBy:
+	def setUp(self):
+		np.random.seed(42)
+		n = 1000
+		self.k1 = np.random.randint(0, 7, n)
+		self.k2 = np.random.choice(['a', 'b', 'c'], n)
+		self.x = np.random.normal(size=n)
+		self.x[::97] = np.nan
+
+	def rows(self, gb, sl=np.s_[:]):
+		cols = { 'k1': self.k1[sl], 'k2': self.k2[sl], 'x': self.x[sl] }
+		rows = ColGroup()
+		for (asnames, expr) in gb.select_clause:
+			rows.add_column(asnames[0], eval(expr, dict(np.__dict__), cols))
+		return rows
+
+	def test_plan(self):
+		""" GROUP BY query planning """
+		select = [([], 'k1'), (['n'], 'count()'), (['m'], 'mean(x*2)'), ([], 'max( x*2 )'), ([], '(quantile(x, 0.25))')]
+		gb = GroupBy(select, ['k1'])
+		assert gb.select_clause == [(['_G0'], 'k1'), (['_A0'], 'x*2'), (['_A1'], 'x')], gb.select_clause
+		assert [ c[0] for c in gb.columns ] == ['k1', 'n', 'm', 'max( x*2 )', '(quantile(x, 0.25))']
+		assert gb.needs == [set(['sum', 'max']), set(['values'])]
+
+		gb = GroupBy([(['bin'], 'k1 // 2'), ([], 'sum(x)')], ['bin'])
+		assert gb.select_clause == [(['bin'], 'k1 // 2'), (['_A0'], 'x')], gb.select_clause
+
+		for (select, group_by) in [ ([([], 'x')], ['k1']), ([([], 'quantile(x)')], ['k1']), ([([], 'quantile(x, 2)')], ['k1']) ]:
+			try:
+				GroupBy(select, group_by)
+			except Exception:
+				pass
+			else:
+				assert 0, select
+
+	def test_aggregate(self):
+		""" GROUP BY aggregates, merged over blocks of rows and partitions """
+		select = [([], 'k1'), ([], 'k2'), ([], 'count()'), ([], 'sum(x)'), ([], 'mean(x)'),
+			  ([], 'min(k1*10)'), ([], 'max(x)'), ([], 'quantile(x,0.3)'), ([], 'quantile(x,1)')]
+		gb = GroupBy(select, ['k1', 'k2'])
+
+		# Two "cells", merged and partitioned in a "worker", reduced per partition
+		mapper = GroupByMapper(gb, 3)
+		list(mapper(iter([ self.rows(gb, np.s_[:300]), self.rows(gb, np.s_[300:310]) ])))
+		list(mapper(iter([ self.rows(gb, np.s_[310:]) ])))
+		results = list(mapper.map_done())
+		assert len(set( p for (p, _) in results )) == len(results)
+		out = [ rows for (p, part) in results for (_, rows) in groupby_reducer((p, iter([part])), gb) ]
+		assert sum( len(rows) for rows in out ) == 21
+
+		for rows in out:
+			for row in rows:
+				k1, k2 = row['k1'], row['k2']
+				x = self.x[(self.k1 == k1) & (self.k2 == k2)]
+				assert row['count()'] == len(x)
+				assert row['min(k1*10)'] == k1 * 10
+				if np.isnan(x).any():
+					assert np.isnan(row['sum(x)']) and np.isnan(row['max(x)'])
+					assert np.isnan(row['quantile(x,0.3)']) and np.isnan(row['quantile(x,1)'])
+					continue
+				assert np.allclose([row['sum(x)'], row['mean(x)'], row['max(x)'], row['quantile(x,0.3)'], row['quantile(x,1)']],
+					[x.sum(), x.mean(), x.max(), np.percentile(x, 30), x.max()])
+
+	def test_quantile_nan(self):
+		""" GROUP BY quantiles of groups with NaNs are NaN, as with numpy.percentile """
+		gb = GroupBy([([], 'k1'), ([], 'quantile(x, 0.5)')], ['k1'])
+		k1 = np.array([0, 0, 0, 1, 1, 1, 1, 2])
+		x = np.array([3., np.nan, 1., 4., 1., 5., 9., np.nan])
+		rows = ColGroup([('_G0', k1), ('_A0', x)])
+		part = gb.merge([ gb.partial(rows[:4]), gb.partial(rows[4:]) ])
+		out = gb.finalize(part)
+		assert list(out['k1']) == [0, 1, 2]
+		q = out['quantile(x, 0.5)']
+		assert np.isnan(q[0]) and np.isnan(q[2]) and q[1] == np.percentile(x[k1 == 1], 50)
+
+	def test_empty(self):
+		""" GROUP BY with no rows """
+		gb = GroupBy([([], 'k1'), ([], 'count()'), ([], 'quantile(x, 0.5)')], ['k1'])
+		rows = gb.empty(self.rows(gb))
+		assert len(rows) == 0 and rows['k1'].dtype == self.k1.dtype
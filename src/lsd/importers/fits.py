@@ -2,6 +2,7 @@
 
 import numpy as np
 from itertools import izip
+from .. import ingest
 try:
 	import astropy.io.fits as pyfits
 except ImportError:
@@ -21,6 +22,15 @@ class FITSImporter:
 
 		    To be used as an importer for import_from_chunks
 		"""
+		(ret,) = ingest.append_parsed(db, self.parse(db, fn))
+		return ret
+
+	def parse(self, db, fn):
+		""" Load a FITS file, and yield its rows for the named table
+
+		    To be used as a parser for lsd.ingest (see
+		    import_from_chunks)
+		"""
 		hdus = pyfits.open(fn)
 		try:
         	        rows = None
@@ -42,13 +52,10 @@ class FITSImporter:
 				a[:] = val
 				rows[col] = a
 
-		# Append to the table
-		ids = db.table(self.tabname).append(rows, _update=self.import_primary_key)
-		assert len(ids) == len(rows)
-
-		# Return the total number of rows in the input file, and the number of rows actually
-		# imported
-		return (len(ids), len(ids))
+		# Yield the rows, followed by the number of rows imported
+		# and the total number of rows in the input file
+		yield (self.tabname, rows, self.import_primary_key)
+		yield (None, (len(rows), len(rows)))
 
 def get_importer(db, args):
 	"""
@@ -4,6 +4,7 @@ import numpy as np
 import warnings
 from itertools import izip
 from ..utils import open_ex
+from .. import ingest
 
 def conv_bool(s):
 	""" Convert string s to bool, recognizing True/False as literals """
@@ -52,6 +53,15 @@ class TextImporter:
 
 		    To be used as an importer for import_from_chunks
 		"""
+		(ret,) = ingest.append_parsed(db, self.parse(db, fn))
+		return ret
+
+	def parse(self, db, fn):
+		""" Load a Text file, and yield its rows for the named table
+
+		    To be used as a parser for lsd.ingest (see
+		    import_from_chunks)
+		"""
 		# Allow errors in files
 		with warnings.catch_warnings():
 			warnings.simplefilter("ignore")
@@ -75,13 +85,10 @@ class TextImporter:
 				a[:] = val
 				rows[col] = a
 
-		# Append to the table
-		ids = db.table(self.tabname).append(rows, _update=self.import_primary_key)
-		assert len(ids) == len(rows)
-
-		# Return the total number of rows in the input file, and the number of rows actually
-		# imported
-		return (len(ids), nlines)
+		# Yield the rows, followed by the number of rows imported
+		# and the total number of rows in the input file
+		yield (self.tabname, rows, self.import_primary_key)
+		yield (None, (len(rows), nlines))
 
 def get_importer(db, args):
 	"""
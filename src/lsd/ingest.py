@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Write-batched ingest of rows parsed from many inputs
+
+Importers typically parse an input file in a worker, and append the
+rows to the table right away. As every file touches many cells, the
+workers then contend for the same cell locks, and each cell's tablets
+get reopened once per file.
+
+Here, importing is split into two stages. In the parse stage, a
+parser is run on each input, and the rows it yields are split by their
+destination cells (see Table.split_by_cell). They're shuffled (see
+Pool.map_reduce_chain) to the write stage, where all rows destined for a
+cell are appended to it at once, taking its lock and opening its tablets
+only once.
+
+A parser is a generator, called as parser(input, *args), yielding:
+
+    - (tabname, rows) tuples, with the rows (as accepted by
+      Table.append) to be appended to table tabname, or
+      (tabname, rows, _update) to update existing rows (see
+      Table.append),
+    - (None, result) tuples, with results to be returned to the caller
+      (e.g., the number of rows parsed from the input).
+
+Set LSD_IMPORT_BATCHED=0 to append the rows as they're parsed instead.
+"""
+
+import os
+import shutil
+import numpy as np
+import pool2
+import colgroup
+from utils import unpack_callable
+
+batch_by_cell = os.getenv("LSD_IMPORT_BATCHED", "1") != "0"
+
+def append_parsed(db, parsed):
+	""" Append the rows yielded by parser output parsed to their
+	    tables as they come, yielding the results.
+	"""
+	for item in parsed:
+		tabname, rows = item[:2]
+		if tabname is None:
+			yield rows
+		else:
+			_update = item[2] if len(item) > 2 else False
+			db.table(tabname).append(rows, _update=_update)
+
+def _append_mapper(input, db, parser):
+	""" Parse an input and append its rows (the unbatched import) """
+	parser, parser_args = unpack_callable(parser)
+	for result in append_parsed(db, parser(input, *parser_args)):
+		yield result
+
+def _parse_mapper(input, db, parser):
+	""" The parse stage: key the parsed rows by (tabname, cell_id)
+	    of their destination cells, and the results by (None, None).
+	"""
+	parser, parser_args = unpack_callable(parser)
+	for item in parser(input, *parser_args):
+		tabname, rows = item[:2]
+		if tabname is None:
+			yield (None, None), rows
+			continue
+
+		_update = item[2] if len(item) > 2 else False
+		for cell_id, cellrows in db.table(tabname).split_by_cell(rows, _update):
+			yield (tabname, cell_id), (cellrows, _update)
+
+def _write_reducer(kv, db):
+	""" The write stage: append all rows destined for a cell at once,
+	    and pass through the results.
+	"""
+	(tabname, cell_id), values = kv
+	if tabname is None:
+		for result in values:
+			yield result
+		return
+
+	values = list(values)
+	rows = colgroup.fromiter(( rows for rows, _ in values ), blocks=True, copy=False)
+	_update = any( _update for _, _update in values )
+	db.table(tabname).append(rows, _update=_update)
+
+def import_parsed(db, inputs, parser, batched=None):
+	"""
+	Import the rows parsed from inputs (most commonly files).
+
+	Runs the parser on each input in parallel, and appends the rows
+	it yields to their tables. Unless batched=False (the default is
+	taken from LSD_IMPORT_BATCHED), the appends are batched by cell
+	(see the module docstring).
+
+	Yields the results yielded by the parser. When batching, these
+	are passed on by the write stage as it runs, so some of the rows
+	may not have been written yet when they're yielded.
+
+	Must be called from within a transaction.
+	"""
+	if batched is None:
+		batched = batch_by_cell
+
+	pool = pool2.Pool()
+	if not batched:
+		for result in pool.imap_unordered(inputs, _append_mapper, (db, parser), progress_callback=pool2.progress_pass):
+			yield result
+	else:
+		for result in pool.map_reduce_chain(inputs, [ (_parse_mapper, db, parser), (_write_reducer, db) ]):
+			yield result
+	del pool
+
+############ Unit tests
+
+def _test_ingest_parser(seed, tabname, n):
+	# Rows spread over a few cells, numbered to tell them apart
+	np.random.seed(seed)
+	ra, dec = np.random.uniform(10, 14, n), np.random.uniform(20, 24, n)
+	yield (tabname, dict(ra=ra, dec=dec, row=seed*n + np.arange(n)))
+	yield (None, seed)
+
+class Test_import_parsed:
+	def setUp(self):
+		import tempfile
+		from join_ops import DB
+		self.tmpdir = tempfile.mkdtemp()
+		self.db = DB(self.tmpdir)
+		schema = {
+			'schema': {
+				'main': {
+					'columns': [ ('obj_id', 'u8'), ('ra', 'f8'), ('dec', 'f8'), ('row', 'i8') ],
+					'primary_key': 'obj_id',
+					'spatial_keys': ['ra', 'dec']
+				}
+			},
+			'commit_hooks': []
+		}
+		with self.db.transaction():
+			for tabname in ['batched', 'direct']:
+				self.db.create_table(tabname, schema)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def _import(self, seeds):
+		# Import the same rows batched and unbatched, and return
+		# the keys the rows were given by each, ordered by row
+		with self.db.transaction():
+			for tabname in ['batched', 'direct']:
+				res = import_parsed(self.db, seeds, (_test_ingest_parser, tabname, 300), batched=(tabname == 'batched'))
+				assert sorted(res) == sorted(seeds)
+
+		keys = []
+		for tabname in ['batched', 'direct']:
+			table = self.db.table(tabname)
+			rows = np.concatenate([ table.fetch_tablet(cell_id) for cell_id in table.get_cells() ])
+			assert len(rows) == 300*len(seeds)
+			keys.append(rows['obj_id'][np.argsort(rows['row'])])
+		return keys
+
+	def test_same_keys(self):
+		""" Batched and unbatched imports give the rows the same keys """
+		batched, direct = self._import([1])
+		assert np.all(batched == direct)
+
+	def test_same_keys_many_inputs(self):
+		""" Batched and unbatched imports of many inputs give the rows the same keys, up to the order of the object IDs within each cell """
+		batched, direct = self._import([1, 2, 3, 4, 5])
+		mask = np.uint64(0xFFFFFFFF00000000)
+		assert np.all(batched & mask == direct & mask)
+
+		cells = self.db.table('batched').pix.cell_for_id(batched)
+		for cell_id in set(cells):
+			incell = cells == cell_id
+			assert sorted(batched[incell]) == sorted(direct[incell])
@@ -7,6 +7,8 @@ well as the JOIN machinery.
 
 """
 import os, json, glob, copy, sys
+import multiprocessing
+import traceback
 import numpy as np
 import cPickle
 import logging
@@ -14,9 +16,12 @@ import time
 import locking
 
 from contextlib  import contextmanager
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import query_parser as qp
+import blockeval
+import groupby
+import neighbors
 import bhpix
 import utils
 import pool2
@@ -26,7 +31,7 @@ import colgroup
 
 from interval    import intervalset
 from colgroup    import ColGroup
-from table       import Table
+from table       import Table, CUT_OPS
 
 import caching
 
@@ -42,34 +47,113 @@ def set_NULL(col, mask=np.s_[:]):
 	""" Set the NULL marker apropriate for the datatype """
 	col[mask] = 0
 
+def _expand_column(col, nrows):
+	""" Zero-pad (or truncate) col to nrows rows """
+	if len(col) == nrows:
+		return col
+	ret = np.zeros((nrows,) + col.shape[1:], dtype=col.dtype)
+	n = min(nrows, len(col))
+	ret[:n] = col[:n]
+	return ret
+
 class TabletCache:
 	""" An cache of tablets loaded while performing a Query.
 
+		Only the columns that were actually requested are read from
+		disk (see Table.fetch_tablet's columns argument). The
+		columns referenced by the expressions of a query are read
+		together, with one read per cgroup (see load_columns).
+		Columns loaded later on from the same cell and cgroup are
+		merged into the already cached ColGroup.
+
 		TODO: Perhaps merge it with DB? Or make it a global?
 	"""
-	cache = {}		# Cache of loaded tables, in the form of cache[cell_id][include_cached][table][cgroup] = rows
+	cache = {}		# Cache of loaded columns, in the form of cache[cell_id][table][include_cached][cgroup] = ColGroup
 
 	root_path = None	# The name of the root table (string). Used for figuring out if _not_ to load the cached rows.
 	include_cached = False	# Should we load the cached rows from the root table?
+	piece = None		# (i, n) if only the i-th of n equal row ranges of the root table's cells is to be loaded
+	rowranges = None	# Cache of cell_id -> (start, stop) row ranges, computed from piece
+	root_names = None	# Names of tables with root_path that have been loaded (see set_piece)
 
-	def __init__(self, root_path, include_cached = False):
+	def __init__(self, root_path, include_cached = False, piece = None):
 		self.cache = {}
 		self.root_path = root_path
 		self.include_cached = include_cached
+		self.piece = piece
+		self.rowranges = {}
+		self.root_names = set()
+
+	def set_piece(self, piece):
+		# Switch to a different row range of the root table, dropping
+		# the root table's already loaded columns, but keeping those
+		# of the joined tables (see QueryEngine.__iter__)
+		self.piece = piece
+		self.rowranges = {}
+		for tables in self.cache.itervalues():
+			for name in self.root_names:
+				tables.pop(name, None)
+
+	def rowrange(self, cell_id, table):
+		# Return the (start, stop) range of rows to load from the
+		# root table, or None if all are to be loaded
+		if self.piece is None or table.path != self.root_path:
+			return None
+
+		if cell_id not in self.rowranges:
+			i, n = self.piece
+			nrows = table.main_nrows(cell_id)
+			self.rowranges[cell_id] = (i*nrows // n, (i+1)*nrows // n)
+
+		return self.rowranges[cell_id]
 
 	def load_column(self, cell_id, name, table, autoexpand=True, resolve_blobs=False):
 		# Return the column 'name' from table 'table'.
-		# Load its tablet if necessary, and cache it for further reuse.
+		# Load it from its tablet if necessary, and cache it for further reuse.
 		#
 		# NOTE: Unless resolve_blobs=True, this method DOES NOT resolve blobrefs to BLOBs
-		include_cached = self.include_cached if table.path == self.root_path else True
-
-		# Resolve a column name alias
-		name = table.resolve_alias(name)
+		# Resolve a column name alias (names from .join files are
+		# unicode; ColGroups only index columns by str)
+		name = str(table.resolve_alias(name))
 
 		# Figure out which table contains this column
 		cgroup = table.columns[name].cgroup
 
+		# See if we have already loaded the required column
+		rows = self._cgroup_cache(cell_id, table, cgroup)
+		if name not in rows:
+			self._fetch_columns(cell_id, [ name ], table, cgroup, autoexpand)
+
+		col = rows[name]
+		
+		# resolve blobs, if requested
+		if resolve_blobs:
+			col = self.resolve_blobs(cell_id, col, name, table)
+
+		return col
+
+	def load_columns(self, cell_id, names, table):
+		# Load the columns 'names' from table 'table' that are not
+		# cached yet, reading all those of a cgroup from its tablet
+		# at once (instead of one read per column in load_column).
+		bycgroup = OrderedDict()
+		for name in names:
+			name = str(table.resolve_alias(name))
+			cgroup = table.columns[name].cgroup
+			if name not in self._cgroup_cache(cell_id, table, cgroup):
+				cnames = bycgroup.setdefault(cgroup, [])
+				if name not in cnames:
+					cnames.append(name)
+
+		for cgroup, cnames in bycgroup.iteritems():
+			self._fetch_columns(cell_id, cnames, table, cgroup)
+
+	def _cgroup_cache(self, cell_id, table, cgroup):
+		# Return the ColGroup with the cached columns of the cgroup
+		include_cached = self.include_cached if table.path == self.root_path else True
+		if table.path == self.root_path:
+			self.root_names.add(table.name)
+
 		# Create self.cache[cell_id][table.name][include_cached][cgroup] hierarchy if needed
 		if  cell_id not in self.cache:
 			self.cache[cell_id] = {}
@@ -78,28 +162,33 @@ class TabletCache:
 		if include_cached not in self.cache[cell_id][table.name]:		# This bit is to support (in the future) self-joins. Note that (yes) this can be implemented in a much smarter way.
 			self.cache[cell_id][table.name][include_cached] = {}
 
-		# See if we have already loaded the required tablet
 		tcache = self.cache[cell_id][table.name][include_cached]
 		if cgroup not in tcache:
-			# Load and cache the tablet
-			rows = table.fetch_tablet(cell_id, cgroup, include_cached=include_cached)
+			tcache[cgroup] = ColGroup()
+		return tcache[cgroup]
 
-			# Ensure it's as long as the primary table (this allows us to support "sparse" tablets)
-			if autoexpand and cgroup != table.primary_cgroup:
-				nrows = len(self.load_column(cell_id, table.primary_key.name, table))
-				rows.resize(nrows)
+	def _fetch_columns(self, cell_id, names, table, cgroup, autoexpand=True):
+		# Load only these columns from the cgroup's tablet, and
+		# merge them into the cache
+		include_cached = self.include_cached if table.path == self.root_path else True
+		rows = self._cgroup_cache(cell_id, table, cgroup)
+		cols = table.fetch_tablet(cell_id, cgroup, include_cached=include_cached, columns=names, rowrange=self.rowrange(cell_id, table))
 
-			tcache[cgroup] = rows
-		else:
-			rows = tcache[cgroup]
+		# Ensure they're as long as the primary table (this allows us to support "sparse" tablets)
+		nrows = None
+		if autoexpand and cgroup != table.primary_cgroup:
+			nrows = len(self.load_column(cell_id, table.primary_key.name, table))
 
-		col = rows[name]
-		
-		# resolve blobs, if requested
-		if resolve_blobs:
-			col = self.resolve_blobs(cell_id, col, name, table)
+		for name in names:
+			col = cols[name]
+			if nrows is not None:
+				col = _expand_column(col, nrows)
 
-		return col
+			# Merge it into the cached columns of this cgroup. The
+			# first load fixes the length of the cached cgroup.
+			if rows.ncols():
+				col = _expand_column(col, len(rows))
+			rows.add_column(name, col)
 
 	def resolve_blobs(self, cell_id, col, name, table):
 		# Resolve blobs (if blob column). NOTE: the resolved blobs
@@ -401,13 +490,58 @@ class JoinRelation:
 	def join(self, cell_id, table1, table2, idx1, idx2, tcache):	# Returns idx1, idx2, isnull
 		raise NotImplementedError('You must override this method from a derived class')
 
+class _JoinMapCache(object):
+	""" A worker-wide LRU cache of the join maps prepared by
+	    IndirectJoin.fetch_join_map, holding up to maxbytes bytes
+	    (set by LSD_JOIN_MAP_CACHE; default: 256MB, 0 disables it).
+	"""
+	def __init__(self, maxbytes):
+		self.maxbytes = maxbytes
+		self.maps = OrderedDict()
+		self.nbytes = 0
+
+	def get(self, key):
+		cg = self.maps.pop(key, None)
+		if cg is not None:
+			self.maps[key] = cg
+		return cg
+
+	def put(self, key, cg):
+		nbytes = sum( cg[name].nbytes for name in cg.keys() )
+		if nbytes > self.maxbytes:
+			return
+
+		while self.nbytes + nbytes > self.maxbytes:
+			_, old = self.maps.popitem(last=False)
+			self.nbytes -= sum( old[name].nbytes for name in old.keys() )
+		self.maps[key] = cg
+		self.nbytes += nbytes
+
+_join_maps = _JoinMapCache(int(os.getenv('LSD_JOIN_MAP_CACHE', 256*2**20)))
+
 class IndirectJoin(JoinRelation):
 	m1_colspec = None	# (table, column) tuple giving the location of m1
 	m2_colspec = None	# (table, column) tuple giving the location of m2
 
+	def _join_map_key(self, table, cell_id, tcache):
+		# The part of the join map cache key identifying the tablets
+		# of table. Returns None if they may change (i.e., they're
+		# written to in this transaction), or only a range of their
+		# rows is loaded (see TabletCache.rowrange).
+		snapid = table.catalog.snapshot_of_cell(cell_id)
+		if (table.transaction and snapid == table.snapid) or tcache.rowrange(cell_id, table) is not None:
+			return None
+		include_cached = tcache.include_cached if table.path == tcache.root_path else True
+		return (table.path, cell_id, snapid, include_cached)
+
 	def fetch_join_map(self, cell_id, m1_colspec, m2_colspec, tcache):
 		"""
-			Return a list of crossmatches corresponding to ids
+			Return a list of crossmatches corresponding to ids,
+			cut on _NR and _DIST, and sorted by m1.
+
+			The maps are cached (see _JoinMapCache), and reused
+			by subsequent queries (and chunks of a cell) executed
+			by the same worker.
 		"""
 		table1, column_from = m1_colspec
 		table2, column_to   = m2_colspec
@@ -427,29 +561,66 @@ class IndirectJoin(JoinRelation):
 		   	cg.m2 = np.empty(0, dtype=np.uint64)
 		   	return cg
 
-		cg.m1 = tcache.load_column(cell_id_from, column_from, table1)
-		cg.m2 = tcache.load_column(cell_id_to  , column_to  , table2)
-		assert len(cg.m1) == len(cg.m2)
+		key1 = self._join_map_key(table1, cell_id_from, tcache)
+		key2 = self._join_map_key(table2, cell_id_to, tcache)
+		key = (key1, column_from, key2, column_to, self.n, self.d) if key1 is not None and key2 is not None else None
+		if key is not None:
+			cached = _join_maps.get(key)
+			if cached is not None:
+				return cached
+
+		# Columns with extra join data, on which we might filter or
+		# which the user may SELECT, and the cuts on them
+		extras = [ colname for colname in ['_NR', '_DIST'] if table1.resolve_alias(colname) in table1.columns ]
+		if '_NR' not in extras and self.n != 1:
+			raise Exception("No _NR column in indirect join table, and nmax != 1")
+		if '_DIST' not in extras and self.d != 0:
+			raise Exception("No _DIST column in indirect join table, and dmax != 0")
 
-		# Fetch columns with extra join data, on which we might filter or which
-		# the user may SELECT
+		cuts = []
+		if '_NR' in extras:
+			cuts.append(('_NR', '<', self.n))
+		if '_DIST' in extras and self.d != 0:
+			cuts.append(('_DIST', '<', self.d))
+
+		names = [ str(table1.resolve_alias(name)) for name in [column_from, column_to] + extras ]	# Column names from .join files are unicode
+		cgroups = set( table1.columns[name].cgroup for name in names )
+		if table1.path == table2.path and cell_id_from == cell_id_to and len(cgroups) == 1:
+			# The links and the extra data are in the same tablet:
+			# push the cuts into the read, reading only the links
+			# passing them
+			include_cached = tcache.include_cached if table1.path == tcache.root_path else True
+			rows = table1.fetch_tablet(cell_id_from, cgroups.pop(), include_cached=include_cached,
+				columns=list(OrderedDict.fromkeys(names)), rowrange=tcache.rowrange(cell_id_from, table1),
+				cuts=[ (table1.resolve_alias(name), op, val) for (name, op, val) in cuts ])
+			m1, m2 = rows[names[0]], rows[names[1]]
+			extra = dict(zip(extras, ( rows[name] for name in names[2:] )))
+			idx = np.arange(len(m1))
+		else:
+			m1 = tcache.load_column(cell_id_from, column_from, table1)
+			m2 = tcache.load_column(cell_id_to  , column_to  , table2)
+			assert len(m1) == len(m2)
+
+			extra = dict(( (colname, tcache.load_column(cell_id_from, colname, table1)) for colname in extras ))
+			keep = np.ones(len(m1), dtype=bool)
+			for (name, op, val) in cuts:
+				keep &= CUT_OPS[op](extra[name], val)
+			idx = np.flatnonzero(keep)
+
+		# Apply the cuts together with the sort by m1 (so that
+		# native.table_join merges the sorted links instead of
+		# sorting them on each call)
+		if len(idx) > 1 and np.any(m1[idx][1:] < m1[idx][:-1]):
+			idx = idx[np.argsort(m1[idx], kind='mergesort')]
+
+		cg.m1 = m1[idx]
+		cg.m2 = m2[idx]
 		for colname in ['_NR', '_DIST']:
-			try:
-				cg[colname] = tcache.load_column(cell_id_from, colname, table1)
-			except KeyError:
-				pass
-
-		# Apply cuts
-		if getattr(cg, '_NR', None) is not None:
-			cg.cut(cg._NR < self.n)
-		elif self.n != 1:
-			raise Exception("No _NR column in indirect join table, and nmax != 1")
+			if colname in extra:
+				cg[colname] = extra[colname][idx]
 
-		if getattr(cg, '_DIST', None) is not None:
-			if self.d != 0:
-				cg.cut(cg._DIST < self.d)
-		elif self.d != 0:
-			raise Exception("No _DIST column in indirect join table, and dmax != 0")
+		if key is not None:
+			_join_maps.put(key, cg)
 
 		return cg
 
@@ -463,6 +634,15 @@ class IndirectJoin(JoinRelation):
 		id1 = tcache.load_column(cell_id, self.tableR.get_primary_key(), self.tableR)[idx1]
 		id2 = tcache.load_column(cell_id, self.tableS.get_primary_key(), self.tableS)[idx2]
 
+		# The links are sorted by m1; only those within the range of
+		# id1 can match (a small part of them, if only a chunk of the
+		# cell's rows is being processed; see QueryEngine.__iter__)
+		if len(id1):
+			lo, hi = np.searchsorted(cg.m1, id1.min(), 'left'), np.searchsorted(cg.m1, id1.max(), 'right')
+		else:
+			lo = hi = 0
+		cg = cg[lo:hi]
+
 		return native_join(id1, id2, self.kind, cg)
 
 	def __init__(self, db, tableR, tableS, **joindef):
@@ -489,9 +669,12 @@ class CrossmatchJoin(JoinRelation):
 	def __init__(self, db, tableR, tableS, **joindef):
 		JoinRelation.__init__(self, db, tableR, tableS, **joindef)
 
-		# Number of neighbors, max distance (these are usually given as FROM clause args)
+		# Number of neighbors, max distance, neighbor search backend
+		# (these are usually given as FROM clause args)
 		self.n = int(joindef.get('nmax', 1))
 		self.d = float(joindef.get('dmax', 1.)) / 3600. # fetch and convert to degrees
+		self.nn = joindef.get('nn', None)
+		neighbors.get_backend(self.nn)			# Fail early on unknown backends
 
 	def join(self, cell_id, idx1, idx2, tcache):
 		"""
@@ -501,9 +684,6 @@ class CrossmatchJoin(JoinRelation):
 		# Cross-match, R x S
 		# Return objects (== rows) from S that are nearest neighbors of
 		# objects (== rows) in R
-		from scikits.ann import kdtree
-		from utils import gnomonic, gc_dist
-
 		join = ColGroup(dtype=[('m1', 'u8'), ('m2', 'u8'), ('_DIST', 'f4'), ('_NR', 'u1')])
 
 		# Load spatial keys from S table
@@ -519,31 +699,19 @@ class CrossmatchJoin(JoinRelation):
 				tcache.load_column(cell_id, rakey, self.tableR)[uidx1], \
 				tcache.load_column(cell_id, deckey, self.tableR)[uidx1]
 
-			# Project to tangent plane around the center of the cell. We
-			# assume the cell is small enough for the distortions not to
-			# matter and Euclidian distances apply
-			bounds, _    = self.tableR.pix.cell_bounds(cell_id)
-			(clon, clat) = bhpix.deproj_bhealpix(*bounds.center())
-			xy1 = np.column_stack(gnomonic(ra1, dec1, clon, clat))
-			xy2 = np.column_stack(gnomonic(ra2, dec2, clon, clat))
-
-			# Construct kD-tree to find nearest neighbors from tableS
-			# for every object in tableR
-			tree = kdtree(xy2)
-			match_idxs, match_d2 = tree.knn(xy1, min(self.n, len(xy2)))
-			del tree
-
-			# Expand the matches into a table, with one row per neighbor
-			join.resize(match_idxs.size)
-			for k in xrange(match_idxs.shape[1]):
-				match_idx = match_idxs[:,k]
-				join['m1'][k::match_idxs.shape[1]]   = uidx1
-				join['m2'][k::match_idxs.shape[1]]   = match_idx
-				join['_DIST'][k::match_idxs.shape[1]] = gc_dist(ra1, dec1, ra2[match_idx], dec2[match_idx])
-				join['_NR'][k::match_idxs.shape[1]]   = k
-
-			# Remove matches beyond the xmatch radius
-			join = join[join['_DIST'] < self.d]
+			# Find the nearest neighbors from tableS within the
+			# xmatch radius, for every object in tableR (with the
+			# grid backend, using the spatial index of the cell built
+			# at commit time)
+			search = neighbors.for_cell(self.tableS, cell_id, ra2, dec2, self.nn)
+			(i1, i2, dist, nr) = neighbors.xmatch(search, ra1, dec1, ra2, dec2, self.n, self.d)
+
+			# A table with one row per neighbor
+			join.resize(len(i1))
+			join['m1']    = uidx1[i1]
+			join['m2']    = i2
+			join['_DIST'] = dist
+			join['_NR']   = nr
 
 		# Perform the join
 		assert idx1.dtype == idx2.dtype == np.int64
@@ -657,6 +825,9 @@ class TableColsProxy:
 		table = self.tables[tabname].table
 		return [ name for (name, coldef) in table.columns.iteritems() if not table._is_pseudotablet(coldef.cgroup) ]
 
+# Query pseudocolumns (see QueryInstance.load_pseudocolumn)
+_PSEUDOCOLUMNS = frozenset(['_ROWNUM', '_CELLID', '_CELLPATH'])
+
 class QueryInstance(object):
 	# Internal working state variables
 	tcache   = None		# TabletCache() instance
@@ -672,19 +843,28 @@ class QueryInstance(object):
 	query_clauses = None	# Tuple with parsed query clauses
 	pix      = None         # Pixelization object (TODO: this should be moved to class DB)
 	locals   = None		# Extra local variables to be made available within the query
+	where_first = False	# Evaluate WHERE before SELECT (see QueryEngine.__init__)
+	engine   = None		# The QueryEngine instance (compiles the expressions)
 
-	def __init__(self, q, cell_id, bounds, include_cached):
+	def __init__(self, q, cell_id, bounds, include_cached, piece=None, tcache=None):
+		self.engine        = q
 		self.db            = q.db
 		self.tables	   = q.tables
 		self.root	   = q.root
 		self.query_clauses = q.query_clauses
 		self.pix           = q.root.table.pix
 		self.locals        = q.locals
+		self.where_first   = q.where_first
 
 		self.cell_id	= cell_id
 		self.bounds	= bounds
 
-		self.tcache	= TabletCache(self.root.table.path, include_cached)
+		# Reuse the tablet cache of a previous row range of the cell, if given
+		if tcache is None:
+			self.tcache	= TabletCache(self.root.table.path, include_cached, piece)
+		else:
+			self.tcache	= tcache
+			self.tcache.set_piece(piece)
 		self.columns	= {}
 		
 	def peek(self):
@@ -698,45 +878,101 @@ class QueryInstance(object):
 		self.jmap   	    = self.root.evaluate_join(self.cell_id, self.bounds, self.tcache)
 
 		if self.jmap is not None:
-			# TODO: We could optimize this by evaluating WHERE first, using the result
-			#       to cull the output number of rows, and then evaluating the columns.
-			#		When doing so, care must be taken to fall back onto evaluating a
-			#		column from the SELECT clause, if it's referenced in WHERE
-
 			globals_ = self.prep_globals()
 
-			# eval individual columns in select clause to slurp them up from disk
-			# and have them ready for the WHERE clause
-			rows = self.eval_select(globals_)
-
-			if len(rows):
-				in_  = self.eval_where(globals_)
+			if self.where_first:
+				# Evaluate WHERE first, loading only the columns it
+				# references. Then cull the JOIN map, so that the
+				# SELECT columns (and their BLOBs) are loaded and
+				# computed only for the rows that survived.
+				in_ = self.eval_where(globals_)
 
-				if(in_.any()):
+				if in_.any():
 					if not in_.all():
-						rows = rows[in_]
+						self.cut(in_)
+
+					rows = self.eval_select(globals_)
 
 					# Attach metadata
 					rows.info.cell_id = self.cell_id
+					if self.engine.order_by is not None:
+						rows.info.order_key = self.eval_order_key(globals_)
 
 					yield rows
+			else:
+				# WHERE refers to a column computed in the SELECT
+				# clause. Eval individual columns in select clause to
+				# slurp them up from disk and have them ready for the
+				# WHERE clause
+				rows = self.eval_select(globals_)
+
+				if len(rows):
+					in_  = self.eval_where(globals_)
+
+					if(in_.any()):
+						if self.engine.order_by is not None:
+							order_key = self.eval_order_key(globals_)
+
+						if not in_.all():
+							rows = rows[in_]
+							if self.engine.order_by is not None:
+								order_key = order_key[in_]
+
+						# Attach metadata
+						rows.info.cell_id = self.cell_id
+						if self.engine.order_by is not None:
+							rows.info.order_key = order_key
+
+						yield rows
 
 		# We yield nothing if the result set is empty.
 
+	def nrows(self):
+		""" The number of rows in the (joined) cell """
+		if self.jmap.ncols():
+			return len(self.jmap)
+
+		# Single-table query with no bounds; the JOIN map is empty
+		table = self.root.table
+		return len(self.tcache.load_column(self.cell_id, table.get_primary_key(), table))
+
+	def cut(self, in_):
+		""" Keep only the rows for which in_ is True.
+
+		    Culls the JOIN map and all already evaluated columns, so
+		    that any columns loaded afterwards will only be loaded
+		    for the surviving rows.
+		"""
+		jmap = self.jmap
+		if self.root.name not in jmap:
+			# Single-table query with no bounds; index the root explicitly
+			jmap = ColGroup()
+			jmap.add_column(self.root.name, np.arange(len(in_)))
+			jmap.add_column('%s._ISNULL' % self.root.name, np.zeros(len(in_), dtype=bool))
+
+		self.jmap = jmap[in_]
+		self.jmap.info = colgroup.InfoInstance()	# Invalidate the optimized (idx, isnull) cache
+
+		for name, col in self.columns.items():
+			self.columns[name] = col[in_]
+
 	def prep_globals(self):
-		globals_ = self.db.get_globals()
+		return self.engine.get_globals()
 
-		# Import packages of interest (numpy)
-		for i in np.__all__:
-			if len(i) >= 2 and i[:2] == '__':
-				continue
-			globals_[i] = np.__dict__[i]
+	def eval_expr(self, expr, globals_):
+		# Evaluate a SELECT or WHERE expression, with the query
+		# symbols it references (see QueryEngine.compile) looked
+		# up in advance. Elementwise expressions are evaluated in
+		# cache-sized blocks of rows, if possible (see blockeval)
+		code, symbols, bexpr = self.engine.compile(expr)
+		locals_ = dict(( (name, self[name]) for name in symbols ))
 
-		# Add implicit global objects present in queries
-		globals_['_PIX'] = self.root.table.pix
-		globals_['_DB']  = self.db
+		if bexpr is not None:
+			res = bexpr.evaluate(globals_, locals_)
+			if res is not None:
+				return res
 
-		return globals_
+		return eval(code, globals_, locals_)
 
 	def eval_where(self, globals_ = None):
 		(_, where_clause, _, _) = self.query_clauses
@@ -745,21 +981,37 @@ class QueryInstance(object):
 			globals_ = self.prep_globals()
 
 		# evaluate the WHERE clause, to obtain the final filter
-		in_    = np.empty(len(next(self.columns.itervalues())), dtype=bool)
-		in_[:] = eval(where_clause, globals_, self)
+		self.preload(self.engine.symbols.get(where_clause, []))
+		in_    = np.empty(self.nrows(), dtype=bool)
+		in_[:] = self.eval_expr(where_clause, globals_)
 
 		return in_
 
+	def eval_order_key(self, globals_):
+		# Evaluate the ORDER BY expression (for the current rows)
+		(expr, _) = self.engine.order_by
+
+		val = self.eval_expr(expr, globals_)
+		key = np.empty(self.nrows(), dtype=np.asarray(val).dtype)
+		key[:] = val
+
+		return key
+
 	def eval_select(self, globals_ = None):
 		(select_clause, _, _, _) = self.query_clauses
 
 		if globals_ is None:
 			globals_ = self.prep_globals()
 
+		exprs = [ name for (_, name) in select_clause ]
+		if self.engine.order_by is not None:
+			exprs.append(self.engine.order_by[0])
+		self.preload([ sym for expr in exprs for sym in self.engine.symbols.get(expr, []) ])
+
 		rows = ColGroup()
 		for (asnames, name) in select_clause:
 #			cols = self[name]	# For debugging
-			cols = eval(name, globals_, self)
+			cols = self.eval_expr(name, globals_)
 #			exit()
 
 			# eval() is expected to return:
@@ -831,6 +1083,29 @@ class QueryInstance(object):
 
 		return optimized_idx, optimized_isnull
 
+	def preload(self, names):
+		# Load the yet unloaded table columns among names (the
+		# symbols referenced by the expressions about to be
+		# evaluated), with a single read per cgroup of each table
+		# (see TabletCache.load_columns). Names are resolved to
+		# tables as in __getitem__.
+		if self.cell_id is None:
+			return
+
+		tabnames = [ self.root.name ] + [ name for name in self.tables if name != self.root.name ]
+		bytable = OrderedDict()
+		for name in names:
+			if name in self.columns or name.find('.') != -1:
+				continue
+			for tabname in tabnames:
+				table = self.tables[tabname].table
+				if table.resolve_alias(name) in table.columns:
+					bytable.setdefault(tabname, []).append(name)
+					break
+
+		for tabname, cnames in bytable.iteritems():
+			self.tcache.load_columns(self.cell_id, cnames, self.tables[tabname].table)
+
 	def load_column(self, name, tabname):
 		# If we're just peeking, construct the column from schema
 		if self.cell_id is None:
@@ -890,7 +1165,7 @@ class QueryInstance(object):
 		""" Generate per-query pseudocolumns.
 		
 		    Developer note: When adding a new pseudocol, make sure to also add
-		       it to the if() statement in __getitem__
+		       it to _PSEUDOCOLUMNS
 		"""
 		# Detect the number of rows
 		nrows = len(self['_ID'])
@@ -952,7 +1227,7 @@ class QueryInstance(object):
 			return TableProxy(self, name)
 
 		# A query pseudocolumn?
-		if name in ['_ROWNUM', '_CELLID', '_CELLPATH']:
+		if name in _PSEUDOCOLUMNS:
 			col = self[name] = self.load_pseudocolumn(name)
 			return col
 
@@ -985,6 +1260,8 @@ class IntoWriter(object):
 	db = None
 	pix = None
 	table = None
+	_keycode = None		# Compiled key expression (see eval_key)
+	_globals = None		# Globals for the key expression (see prep_globals)
 
 	def __init__(self, db, into_clause, locals = {}):
 		# This handles INTO clauses. Stores the data into
@@ -997,6 +1274,13 @@ class IntoWriter(object):
 		self.into_clause = into_clause
 		self.locals      = locals
 
+	def __getstate__(self):
+		# Code objects can't be pickled; they'll be recompiled on use
+		state = self.__dict__.copy()
+		state.pop('_keycode', None)
+		state.pop('_globals', None)
+		return state
+
 	@property
 	def tcache(self):
 		# Auto-create a tablet cache if needed
@@ -1082,13 +1366,24 @@ class IntoWriter(object):
 		return id
 
 	def prep_globals(self):
-		globals_ = self.db.get_globals()
+		# Built once, and reused for all cells
+		if self._globals is None:
+			globals_ = self.db.get_globals()
 
-		# Add implicit global objects present in queries
-		globals_['_PIX'] = self.table.pix
-		globals_['_DB']  = self.db
-		
-		return globals_
+			# Add implicit global objects present in queries
+			globals_['_PIX'] = self.table.pix
+			globals_['_DB']  = self.db
+
+			self._globals = globals_
+
+		return self._globals
+
+	def eval_key(self, keyexpr):
+		# Evaluate the key expression (compiled on first use)
+		if self._keycode is None:
+			self._keycode = compile(keyexpr.strip(), '<into>', 'eval')
+
+		return eval(self._keycode, self.prep_globals(), self)
 
 	def eval_into(self, cell_id, rows):
 		# Insert into the destination table
@@ -1100,8 +1395,7 @@ class IntoWriter(object):
 			ids = table.append(rows)
 		elif kind in ['update/ignore', 'update/insert']:
 			# Evaluate the key expression
-			globals_ = self.prep_globals()
-			vals = eval(keyexpr, globals_, self)
+			vals = self.eval_key(keyexpr)
 #			print rows['mjd_obs'], rows['mjdorig'], keyexpr, vals; exit()
 
 			# Match rows
@@ -1126,8 +1420,7 @@ class IntoWriter(object):
 			assert np.all(id[id != 0] == ids)
 		elif kind == 'insert':	# Insert/update new rows (the expression give the key)
 			# Evaluate the key expression
-			globals_ = self.prep_globals()
-			id = eval(keyexpr, globals_, self)
+			id = self.eval_key(keyexpr)
 
 			if table.primary_key.name not in rows:
 				rows.add_column('_ID', id)
@@ -1248,9 +1541,21 @@ class QueryEngine(object):
 	root	 = None		# TableEntry instance with the primary (root) table
 	query_clauses  = None	# Parsed query clauses
 	locals   = None		# Extra variables to be made local to the query
+	where_first = False	# True if WHERE can be evaluated before SELECT
+	zonemap_predicates = None # (column, op, value) WHERE predicates on root table columns, checkable against zone maps
+	splittable = False	# True if cells may be split into row ranges (see Query.execute)
+	chunk_rows = None	# Maximum number of root table rows to process at once (see QueryEngine.__iter__)
+	order_by = None		# (expr, descending) tuple from the ORDER BY clause, or None
+	limit    = None		# The number of rows from the LIMIT clause, or None (see Query.iterate)
+	group_by = None		# groupby.GroupBy plan of the GROUP BY clause, or None (see Query.iterate)
+	symbols  = None		# expr:[names] of query symbols referenced by SELECT and WHERE expressions (see compile)
+
+	_codes   = None		# Cache of compiled expressions (see compile)
+	_globals = None		# Cache of the globals for expressions (see get_globals)
 
 	def __init__(self, db, query, locals = {}):
 		self.db = db
+		self.locals = locals
 
 		# parse query
 		(select_clause, where_clause, from_clause, into_clause) = qp.parse(query)
@@ -1258,13 +1563,145 @@ class QueryEngine(object):
 		self.root, self.tables = db.construct_join_tree(from_clause);
 		select_clause            = qp.resolve_wildcards(select_clause, TableColsProxy(self.root.name, self.tables))
 
+		rest, self.order_by, self.limit = qp.parse_order_limit(query)
+		if (self.order_by is not None or self.limit is not None) and into_clause is not None:
+			raise Exception('ORDER BY and LIMIT clauses cannot be combined with INTO')
+		if self.order_by is not None and self.limit is None:
+			raise Exception('ORDER BY clause requires a LIMIT')
+
+		# With GROUP BY, the rows carry the keys and the arguments
+		# of the aggregates, which Query.iterate aggregates
+		_, group_by = qp.parse_group_by(rest)
+		if group_by is not None:
+			if into_clause is not None or self.order_by is not None:
+				raise Exception('GROUP BY clause cannot be combined with INTO or ORDER BY')
+			self.group_by = groupby.GroupBy(select_clause, group_by)
+			select_clause = self.group_by.select_clause
+
 		self.query_clauses       = (select_clause, where_clause, from_clause, into_clause)
 
-		self.locals = locals
+		# WHERE can be evaluated before SELECT (and used to cull the rows
+		# for which SELECT is evaluated), unless it refers to a column
+		# computed in the SELECT clause (via 'expr AS name'), or SELECT
+		# depends on the row numbering within the cell (_ROWNUM).
+		asnames = set( asname for (asnames, _) in select_clause for asname in asnames )
+		selnames = set()
+		for (_, name) in select_clause:
+			selnames |= qp.referenced_names(name)
+		self.where_first = where_clause != 'True' \
+			and not (qp.referenced_names(where_clause) & asnames) \
+			and '_ROWNUM' not in selnames
+
+		# Cells can be split into row ranges processed independently
+		# (see Query.execute), unless the query depends on the row
+		# numbering within the cell, or the root table is self-joined
+		# (as only the root table's rows are split).
+		self.splittable = '_ROWNUM' not in (selnames | qp.referenced_names(where_clause)) \
+			and not any(e.table.path == self.root.table.path for e in self.tables.itervalues() if e is not self.root)
+
+		# Large cells are streamed in chunks of at most chunk_rows
+		# rows of the root table (see __iter__), with chunk_rows
+		# set by the LSD_CHUNK_ROWS row budget, or the LSD_CHUNK_BYTES
+		# byte budget (default: 512MB) divided by the size of a
+		# root table row. Set both to 0 to disable.
+		if self.splittable:
+			budgets = []
+			max_rows = int(os.getenv('LSD_CHUNK_ROWS', 0))
+			if max_rows:
+				budgets.append(max_rows)
+			max_bytes = int(os.getenv('LSD_CHUNK_BYTES', 512*2**20))
+			if max_bytes:
+				rowbytes = sum( c.dtype.itemsize for c in self.root.table.columns.itervalues() )
+				budgets.append(max(max_bytes // max(rowbytes, 1), 1))
+			if budgets:
+				self.chunk_rows = min(budgets)
+
+		# Simple comparisons of root table columns to constants,
+		# that Query.execute can check against the per-cell zone
+		# maps to skip cells where WHERE is false for all rows.
+		self.zonemap_predicates = []
+		for (name, op, val) in qp.simple_comparisons(where_clause):
+			if name.find('.') != -1:
+				(tabname, colname) = name.rsplit('.', 1)
+				if tabname != self.root.name:
+					continue
+			elif name in asnames:
+				continue
+			else:
+				colname = name
+			colname = self.root.table.resolve_alias(colname)
+			if colname in self.root.table.columns:
+				self.zonemap_predicates.append((colname, op, val))
+
+		# The symbol table: for each SELECT and WHERE expression,
+		# the names it references that QueryInstance resolves
+		# (columns, tables, pseudocolumns, SELECT-computed columns,
+		# and locals), as opposed to those coming from the globals
+		# (numpy, UDFs, ...).
+		self.symbols = {}
+		order_clause = [ self.order_by[0] ] if self.order_by is not None else []
+		for expr in [ name for (_, name) in select_clause ] + [ where_clause ] + order_clause:
+			self.symbols[expr] = sorted( name for name in qp.free_names(expr) if self._is_query_symbol(name, asnames) )
 
 		# Aux variables that mappers can access
 		self.pix = self.root.table.pix
 
+	def __getstate__(self):
+		# Code objects can't be pickled; they'll be recompiled (and
+		# the globals rebuilt) once in each worker
+		state = self.__dict__.copy()
+		state.pop('_codes', None)
+		state.pop('_globals', None)
+		return state
+
+	def _is_query_symbol(self, name, asnames):
+		# Would QueryInstance.__getitem__ resolve this name?
+		if name in asnames or name in self.tables or name == 'db' or name in _PSEUDOCOLUMNS or name in self.locals:
+			return True
+		return any( e.table.resolve_alias(name) in e.table.columns for e in self.tables.itervalues() )
+
+	def compile(self, expr):
+		""" Return (code, symbols, bexpr) for a SELECT or WHERE
+		    expression, where code is the compiled expression,
+		    symbols the list of query symbols it references (see
+		    QueryEngine.symbols), and bexpr a blockeval.BlockedExpr
+		    if the expression is elementwise (None otherwise, or if
+		    disabled with LSD_BLOCKED_EVAL=0). Expressions are
+		    compiled once, and cached.
+		"""
+		if self._codes is None:
+			self._codes = {}
+
+		try:
+			return self._codes[expr]
+		except KeyError:
+			code = compile(expr.strip(), '<query>', 'eval')
+			bexpr = blockeval.compile_blocked(expr) if blockeval.enabled else None
+			self._codes[expr] = (code, self.symbols[expr], bexpr)
+			return self._codes[expr]
+
+	def get_globals(self):
+		""" Return the global namespace for the evaluation of query
+		    expressions (LSD built-ins, UDFs, numpy, _PIX and _DB).
+		    Built once, and shared by all cells.
+		"""
+		if self._globals is None:
+			globals_ = self.db.get_globals()
+
+			# Import packages of interest (numpy)
+			for i in np.__all__:
+				if len(i) >= 2 and i[:2] == '__':
+					continue
+				globals_[i] = np.__dict__[i]
+
+			# Add implicit global objects present in queries
+			globals_['_PIX'] = self.root.table.pix
+			globals_['_DB']  = self.db
+
+			self._globals = globals_
+
+		return self._globals
+
 	def on_cell(self, cell_id, bounds=None, include_cached=False):
 		return QueryInstance(self, cell_id, bounds, include_cached)
 
@@ -1284,13 +1721,77 @@ class QueryEngine(object):
 		# Generate a single stream of row blocks for a list of cells+bounds
 		partspecs, include_cached = self._partspecs, self._include_cached
 
-		for cell_id, bounds in partspecs:
-			for rows in QueryInstance(self, cell_id, bounds, include_cached):
-				yield rows
+		for i, part in enumerate(partspecs):
+			# A part is a (cell_id, bounds) tuple, or a (cell_id,
+			# bounds, (i, n)) tuple if only the i-th of n row
+			# ranges of the cell is to be processed (see
+			# Query.execute's split_cells)
+			(cell_id, bounds), piece = part[:2], (part[2] if len(part) > 2 else None)
+
+			# Let the tables warm up the tablets of the next cell
+			# while this one is being processed (see Table.prefetch_cell)
+			if i + 1 < len(partspecs):
+				next_cell_id = partspecs[i+1][0]
+				for e in self.tables.itervalues():
+					e.table.prefetch_cell(next_cell_id)
+
+			# Stream very large cells in chunks of rows, to bound the
+			# memory use (see chunk_rows). The joined tables'
+			# tablets are loaded only once.
+			tcache = None
+			for piece in self._chunks(cell_id, piece, include_cached):
+				qi = QueryInstance(self, cell_id, bounds, include_cached, piece, tcache)
+				for rows in qi:
+					yield rows
+				tcache = qi.tcache
+
+	def _chunks(self, cell_id, piece, include_cached):
+		# Split the cell (or its piece) into the smallest number of
+		# pieces with no more than chunk_rows rows of the root table
+		if self.chunk_rows is None or include_cached:
+			return [ piece ]
+
+		# (the row count comes from the table catalog, so the
+		# tablet isn't opened just to count the rows)
+		i, n = piece if piece is not None else (0, 1)
+		nrows = self.root.table.main_nrows(cell_id)
+		m = int(np.ceil(nrows / float(n) / self.chunk_rows))
+		if m < 2:
+			return [ piece ]
+
+		# The j-th of m subranges of the i-th of n ranges of rows
+		# is the (i*m + j)-th of n*m (see TabletCache.rowrange)
+		return [ (i*m + j, n*m) for j in xrange(m) ]
 
 	def peek(self):
 		return QueryInstance(self, None, None, None).peek()
 
+def _split_cells(items, costs, nworkers=None):
+	# Split the tasks consisting of a single cell much more expensive
+	# than average into n tasks, each processing 1/n-th of its rows
+	# (see QueryEngine.__iter__ for the format of the parts).
+	nworkers = nworkers if nworkers is not None else pool2.default_nworkers()
+	target = max(sum(costs.itervalues()) / (4. * nworkers), float(os.getenv('LSD_SPLIT_MIN_BYTES', 64*2**20)))
+
+	ret = []
+	for key, parts in items:
+		n = int(np.ceil(costs[parts[0][0]] / target)) if len(parts) == 1 else 1
+		if n < 2:
+			ret.append((key, parts))
+		else:
+			(cell_id, bounds) = parts[0]
+			ret.extend(( (key, [(cell_id, bounds, (i, n))]) for i in xrange(n) ))
+	return ret
+
+@contextmanager
+def _mr_pool(peer_directory):
+	# Distributed (PYMR) pool, shut down on exit
+	pool = mr.Pool(peer_directory)
+	try:
+		yield pool
+	finally:
+		del pool
+
 class Query(object):
 	db      = None
 	qengine = None
@@ -1318,7 +1819,7 @@ class Query(object):
 		if into_clause:
 			self.qwriter = IntoWriter(db, into_clause, locals)
 
-	def execute(self, kernels, bounds=None, include_cached=False, cells=[], group_by_static_cell=False, testbounds=True, nworkers=None, progress_callback=None, _yield_empty=False):
+	def execute(self, kernels, bounds=None, include_cached=False, cells=[], group_by_static_cell=False, testbounds=True, nworkers=None, progress_callback=None, split_cells=False, combiner=None, _yield_empty=False):
 		"""
 		Map/Reduce a list of functions over query results
 		
@@ -1423,12 +1924,43 @@ class Query(object):
 		    interruption). For more, see the discussion in
 		    "Important notes"
 
+		split_cells : boolean
+		    If True, cells that are much larger than average (as
+		    estimated from the size of their tablets) are split into
+		    ranges of rows, each processed by a separate execution
+		    of the mapper. This keeps a few very large cells from
+		    delaying the end of the job, but is only appropriate
+		    for mappers that don't need to see all rows of a cell at
+		    once. Ignored if group_by_static_cell or include_cached
+		    are True, or if the query refers to _ROWNUM.
+
+		combiner : callable or tuple
+		    An optional kernel, given in the same form as the
+		    reducers, that pre-aggregates the (key, value) pairs
+		    yielded by the mapper within each worker, before they're
+		    passed on to the reducer. It's called as:
+
+		        callable(kv, arg2, arg3, arg4, ...)
+
+		    with kv = (key, values), and must yield (key, value)
+		    pairs. It may be called more than once for the same
+		    key, and the reducer may see both combined and
+		    uncombined values; typically, the combiner performs the
+		    same associative operation (a count, a sum, a histogram)
+		    as the reducer. Ignored if there's only one kernel, or
+		    when running on a distributed (PYMR) pool.
+
 		Important notes
 		---------------
 		    - Each execution of a mapper is guaranteed to operate on
 		      one and only one cell, unless group_by_static=True in
 		      which case rows from all temporal cells, belonging to
-		      a common spatial cell, will be yielded to it.
+		      a common spatial cell, will be yielded to it (or
+		      split_cells=True, in which case it may see only a
+		      part of a cell).
+
+		    - Cells are dispatched to the workers largest-first
+		      (by size of their tablets on disk).
 		      
 		      However, it is undefined, and mapper should make no
 		      assumptions, on how many times blocks of results from within
@@ -1449,6 +1981,18 @@ class Query(object):
 
 		    - The keys must be comparable and hashable (nearly every
 		      Python object is).
+
+		    - If the mapper has a map_done() method, it is called in
+		      each worker once it has run out of cells, and the
+		      values it yields are treated as outputs of the mapper.
+		      This allows the mapper to accumulate results over
+		      multiple cells.
+
+		    - The query's GROUP BY, ORDER BY and LIMIT clauses are
+		      not applied here (see iterate()). For GROUP BY
+		      queries, the rows carry the GROUP BY expressions and
+		      the arguments of the aggregates instead of the SELECT-ed
+		      columns (see groupby.GroupBy).
 		"""
 		partspecs = dict()
 
@@ -1460,6 +2004,13 @@ class Query(object):
 		if len(cells) == 0 or bounds is not None:
 			partspecs.update(self.qengine.root.get_cells(bounds, include_cached=include_cached))
 
+		# Skip cells whose zone maps prove the WHERE clause is false
+		# for all rows. The zone maps don't cover the neighbor cache.
+		preds = self.qengine.zonemap_predicates
+		if preds and not include_cached:
+			catalog = self.qengine.root.table.catalog
+			partspecs = dict(( (cell_id, b) for (cell_id, b) in partspecs.iteritems() if not catalog.cell_excluded(cell_id, preds) ))
+
 		# Tell _mapper not to test spacetime boundaries if the user requested so
 		if not testbounds:
 			partspecs = dict([ (cell_id, [(None, None)]) for (cell_id, _) in partspecs.iteritems() ])
@@ -1493,24 +2044,48 @@ class Query(object):
 		else:
 			partspecs = dict([ (cell_id, [(cell_id, bounds)]) for (cell_id, bounds) in partspecs.iteritems() ])
 
+		# Estimate the cost of each cell (by the size of its tablets),
+		# so that the largest get dispatched first
+		items = partspecs.items()
+		root = self.qengine.root.table
+		costs = dict(( (cell_id, root.tablet_size(cell_id)) for (_, parts) in items for (cell_id, _) in parts ))
+		def task_cost(item):
+			return sum( costs[part[0]] / float(part[2][1] if len(part) > 2 else 1) for part in item[1] )
+
+		# Split oversized cells into row ranges, if requested
+		if split_cells and not group_by_static_cell and not include_cached and self.qengine.splittable:
+			items = _split_cells(items, costs, nworkers)
+
 		# Insert our feeder mapper into the kernel chain
 		kernels = list(kernels)
-		kernels[0] = (_mapper, kernels[0], self.qengine, include_cached)
+		kernels[0] = _Mapper(kernels[0], self.qengine, include_cached)
 
 		# Append a writer mapper if the query has an INTO clause
 		if self.qwriter:
 			kernels.append((_into_writer, self.qwriter))
 
-		# start and run the workers
+		# start and run the workers (reusing the persistent
+		# process-wide pool, if available)
 		peer_directory = os.getenv("PYMR", None)
 		if peer_directory is None:
-			pool = pool2.Pool(nworkers)
+			pool_ctx = pool2.shared_pool(nworkers)
+			kwargs = dict(cost=task_cost, combiner=combiner)
 		else:
-			pool = mr.Pool(peer_directory)
+			# The distributed pool supports neither cost estimates
+			# nor combiners
+			pool_ctx = _mr_pool(peer_directory)
+			kwargs = dict()
 		yielded = False
-		for result in pool.map_reduce_chain(partspecs.items(), kernels, progress_callback=progress_callback):
-			yield result
-			yielded = True
+		with pool_ctx as pool:
+			results = pool.map_reduce_chain(items, kernels, progress_callback=progress_callback, **kwargs)
+			try:
+				for result in results:
+					yield result
+					yielded = True
+			finally:
+				# Cancel the outstanding work if we've been closed
+				# early (e.g., see the LIMIT clause in iterate())
+				results.close()
 
 		# Yield an empty row, if requested
 		# WARNING: This is NOT a flag designed for use by users -- it is only to be used from .fetch()!
@@ -1520,10 +2095,7 @@ class Query(object):
 			else:
 				yield 0, self.qengine.peek()
 
-		# Shut down the workers
-		del pool
-
-	def iterate(self, bounds=None, include_cached=False, cells=[], return_blocks=False, filter=None, testbounds=True, nworkers=None, progress_callback=None, _yield_empty=False):
+	def iterate(self, bounds=None, include_cached=False, cells=[], return_blocks=False, filter=None, testbounds=True, nworkers=None, progress_callback=None, split_cells=None, _yield_empty=False):
 		"""
 		Yield query results row-by-row or in blocks
 
@@ -1542,6 +2114,25 @@ class Query(object):
 		the filter expects extra argument, pass it and its arguments
 		as a tuple (e.g., filter=(filtercallable, arg2, arg3, ...)).
 
+		Unless split_cells is given explicitly, very large cells
+		are split into row ranges (see Query.execute()) if no
+		filter is given.
+
+		If the query has a LIMIT clause, no more than the given
+		number of rows are returned, and the query is stopped as
+		soon as they're available (so which rows are returned is
+		undefined, unless ORDER BY is given). If it has an ORDER BY
+		clause, the rows with the smallest (largest, if DESC) values
+		of its expression are returned, sorted by it; filters can't
+		be used in that case.
+
+		If the query has a GROUP BY clause, one row is returned for
+		each group, in no particular order, with the aggregates
+		(count(), sum(), mean(), min(), max(), quantile()) listed in
+		the SELECT clause. These are computed from partial
+		aggregates of each cell, merged per group in a reduce step
+		(see groupby.py); filters can't be used in that case.
+
 		See the documentation of Query.execute() for a description of
 		other parameters.
 
@@ -1561,18 +2152,52 @@ class Query(object):
 		   
 		"""
 
-		mapper = filter if filter is not None else _iterate_mapper
+		limit, order_by, group_by = self.qengine.limit, self.qengine.order_by, self.qengine.group_by
+		if (order_by is not None or group_by is not None) and filter is not None:
+			raise Exception('Filters cannot be used with queries with an ORDER BY or GROUP BY clause')
+		if group_by is not None:
+			# Partition the partial aggregates among the reducers
+			nparts = int(os.getenv('LSD_GROUPBY_PARTITIONS', 0)) or 4 * (nworkers or pool2.default_nworkers())
+			kernels = [ groupby.GroupByMapper(group_by, nparts), (groupby.groupby_reducer, group_by) ]
+		elif order_by is not None:
+			kernels = [ _TopK(limit, order_by[1]) ]
+		elif filter is not None:
+			kernels = [ filter ]
+		elif limit is not None:
+			kernels = [ (_iterate_mapper, limit) ]
+		else:
+			kernels = [ _iterate_mapper ]
+		if split_cells is None:
+			split_cells = filter is None
 
-		for (cell_id, rows) in self.execute(
-				[mapper], bounds, include_cached,
+		results = self.execute(
+				kernels, bounds, include_cached,
 				cells=cells, testbounds=testbounds, nworkers=nworkers, progress_callback=progress_callback,
-				_yield_empty=_yield_empty):
+				split_cells=split_cells, _yield_empty=_yield_empty and group_by is None)
+
+		if order_by is not None:
+			results = _merge_topk(results, limit, order_by[1])
+		elif group_by is not None and _yield_empty:
+			results = _or_no_groups(results, group_by, self.qengine)
+
+		nleft = limit
+		for (_, rows) in results:
+			if limit is not None and len(rows) > nleft:
+				rows = rows[:nleft]
+
 			if return_blocks:
 				yield rows
 			else:
 				for row in rows:
 					yield row
 
+			# Stop the query once we have enough rows
+			if limit is not None:
+				nleft -= len(rows)
+				if nleft == 0:
+					results.close()
+					break
+
 	def fetch(self, bounds=None, include_cached=False, cells=[], filter=None, testbounds=True, nworkers=None, progress_callback=None):
 		"""
 		Returns a table (a ColGroup instance) with query results.
@@ -1586,13 +2211,16 @@ class Query(object):
 		various parameters.
 		"""
 
+		# Note: the blocks are not reused by iterate(), so they can be
+		# assembled without copying (and large blocks from the workers
+		# arrive through shared memory; see pool2._shm_pack)
 		return colgroup.fromiter(
 				self.iterate(
 					bounds, include_cached, cells=cells,
 					return_blocks=True, filter=filter, _yield_empty=True,
 					nworkers=nworkers, progress_callback=progress_callback
 					),
-				blocks=True
+				blocks=True, copy=False
 			)
 
 	def fetch_cell(self, cell_id, include_cached=False):
@@ -1604,6 +2232,68 @@ class Query(object):
 		"""
 		return self.fetch(cells=[cell_id], include_cached=include_cached, nworkers=1, progress_callback=pool2.progress_pass)
 
+###################################################################
+## Aux. functions implementing DB.commit
+
+# Set LSD_COMMIT_PARALLEL=0 to run the commit hooks in the committing
+# process, one table at a time
+parallel_commit = os.getenv("LSD_COMMIT_PARALLEL", "1") != "0"
+
+def _commit0_process(conn, db, table, pri):
+	# Run table.commit0 in a child process, and send back the timings
+	# of its steps (or the traceback, if it failed). With the
+	# persistent pool disabled, the pool workers exit (and their I/O
+	# gets counted) at the end of each query.
+	os.environ['LSD_POOL_IDLE_TIMEOUT'] = '0'
+	try:
+		conn.send(('ok', table.commit0(db, pri)))
+	except BaseException:
+		conn.send(('error', traceback.format_exc()))
+	conn.close()
+
+def _commit0_tables(db, tables, pri):
+	# Run the commit hooks of priority pri of all tables,
+	# concurrently. Hooks of different tables with the same priority
+	# must therefore be independent (those that depend on other
+	# tables' hooks must have a higher priority). Returns a list of
+	# (tabname, step, wall time, bytes read, bytes written).
+	tables = [ t for t in tables if t.has_commit_work(pri) ]
+	if not parallel_commit:
+		return [ (t.name,) + st for t in tables for st in t.commit0(db, pri) ]
+
+	procs = []
+	for t in tables:
+		rd, wr = multiprocessing.Pipe(duplex=False)
+		p = multiprocessing.Process(target=_commit0_process, args=(wr, db, t, pri))
+		p.start()
+		wr.close()
+		procs.append((t, p, rd))
+
+	stats, failed = [], []
+	for t, p, rd in procs:
+		try:
+			status, result = rd.recv()
+		except EOFError:
+			status, result = 'error', None
+		p.join()
+
+		if status == 'ok':
+			stats += [ (t.name,) + st for st in result ]
+			t.reload_after_commit0(pri)
+		else:
+			failed.append("[%s] %s" % (t.name, result or "Commit process exited with code %s" % p.exitcode))
+
+	if failed:
+		raise Exception("Commit hooks (priority %d) failed:\n%s" % (pri, '\n'.join(failed)))
+
+	return stats
+
+def _print_commit_stats(stats):
+	print >>sys.stderr, "Commit steps:"
+	for (tabname, step, wall, nread, nwritten) in stats:
+		print >>sys.stderr, "  [%s] %-30s %8.2fs   read %9.1f MB   written %9.1f MB" % (tabname, step + ':', wall, nread / 2.**20, nwritten / 2.**20)
+	print >>sys.stderr, "  Sum of step times: %.2fs" % sum(st[2] for st in stats)
+
 class DB(object):
 	"""
 	The interface to LSD databases
@@ -1795,9 +2485,11 @@ class DB(object):
 				raise Exception("Not in a transaction.")
 
 			# Commit the transaction on all tables, in two phases.
-			# Phase #0 does the post-transaction house-keeping.
-			# When all of phase #1 completes successfully, execute
-			# phase #1 that actually does the commit
+			# Phase #0 does the post-transaction house-keeping
+			# (running the commit hooks in order of priority, those
+			# of different tables concurrently). When all of phase
+			# #0 completes successfully, execute phase #1 that
+			# actually does the commit
 			tables = []
 			for name in os.listdir(self.path[0]):
 				if os.path.isdir('%s/%s' % (self.path[0], name)):
@@ -1813,13 +2505,14 @@ class DB(object):
 			if len(tables):
 				print >>sys.stderr, "\n-------- committing %s [%s] ---------" % (self.snapid, ', '.join(t.name for t in tables))
 
+				stats = []
 				for pri in xrange(-1, 11):
-					for t in tables:
-						t.commit0(self, pri)
+					stats += _commit0_tables(self, tables, pri)
 
 				for t in tables:
 					t.commit1()
 
+				_print_commit_stats(stats)
 				print >>sys.stderr, "----------- success %s [%s] ---------\n" % (self.snapid, ', '.join(t.name for t in tables))
 
 			# Remove the transaction marker
@@ -2199,12 +2892,20 @@ class DB(object):
 
 	def build_neighbor_cache(self, tabname, snapid, margin_x_arcsec=30):
 		""" 
-		(Re)Build the neighbor cache in a given table.
+		Update the neighbor cache of a given table.
 		
 		Cache the objects found within margin_x (arcsecs) of each
 		cell into neighboring cells, to support efficient
 		nearest-neighbor lookups.
 
+		The update is incremental: only the cells modified in
+		snapshot snapid are scanned, each row is sent only to the
+		neighbors whose edge it is near, and the neighbors update
+		the cached rows that came from the modified cells in place,
+		appending the new ones. The cache of a neighbor is rewritten
+		only if some of the rows it cached from the modified cells
+		are no longer there.
+
 		Parameters
 		----------
 		tabname : string
@@ -2212,10 +2913,6 @@ class DB(object):
 		margin_x_arcsec : number
 		    The margin (in arcseconds) which to cache into
 		    neighboring cells
-		    
-		TODO: The implementation of this is pretty and inefficient.
-		      It should be nearly completely rewritten at some
-		      point.
 		"""
 		# This routine works in tandem with _cache_maker_mapper and
 		# _cache_maker_reducer auxilliary routines.
@@ -2229,7 +2926,7 @@ class DB(object):
 
 		ntotal = 0
 		ncells = 0
-		query = "_ID, _LON, _LAT FROM %s" % (tabname)
+		query = "_ID, _LON, _LAT, * FROM %s" % (tabname)
 		for (_, ncached) in self.query(query).execute([
 						(_cache_maker_mapper,  margin_x, self, tabname),
 						(_cache_maker_reducer, self, tabname)
@@ -2242,91 +2939,136 @@ class DB(object):
 ###################################################################
 ## Auxilliary functions implementing DB.build_neighbor_cache
 ## functionallity
-def _cache_maker_mapper(qresult, margin_x, db, tabname):
-	# Map: fetch all rows to be copied to adjacent cells,
-	# yield them keyed by destination cell ID
-	for rows in qresult:
-		cell_id = rows.info.cell_id
-		p, _ = qresult.pix.cell_bounds(cell_id)
-
-		# Find all objects within 'margin_x' from the cell pixel edge
-		# The pixel can be a rectangle, or a triangle, so we have to
-		# handle both situations correctly.
-		(x1, x2, y1, y2) = p.boundingBox()
-		d = x2 - x1
-		(cx, cy) = p.center()
-		if p.nPoints() == 4:
-			s = 1. - 2*margin_x / d
-			p.scale(s, s, cx, cy)
-		elif p.nPoints() == 3:
-			if (cx - x1) / d > 0.5:
-				ax1 = x1 + margin_x*(1 + 2**.5)
-				ax2 = x2 - margin_x
-			else:
-				ax1 = x1 + margin_x
-				ax2 = x2 - margin_x*(1 + 2**.5)
+def _margin_strips(pix, cell_id, x, y, margin_x):
+	# Find the points (x, y) (in BHpix projection) of cell_id that are
+	# within margin_x of each of its neighbors. Returns a dict of
+	# neighbor cell_id -> boolean mask of points to be cached there.
+	nhood = pix.neighboring_cells(cell_id)
+	masks = dict(( (neighbor, np.zeros(len(x), dtype=bool)) for neighbor in nhood ))
+
+	p, _ = pix.cell_bounds(cell_id)
+	(x1, x2, y1, y2) = p.boundingBox()
+	d = x2 - x1
+	(cx, cy, t) = pix._xyt_from_cell_id(cell_id)
+
+	if p.nPoints() == 3:
+		# A half-pixel (triangle) at the edge of the projection. These
+		# are rare, so (for simplicity) send everything within the
+		# margin, no matter close to which edge it actually is, to
+		# all neighbors.
+		if (cx - x1) / d > 0.5:
+			ax1 = x1 + margin_x*(1 + 2**.5)
+			ax2 = x2 - margin_x
+		else:
+			ax1 = x1 + margin_x
+			ax2 = x2 - margin_x*(1 + 2**.5)
 
-			if (cy - y1) / d > 0.5:
-				ay2 = y2 - margin_x
-				ay1 = y1 + margin_x*(1 + 2**.5)
-			else:
-				ay1 = y1 + margin_x
-				ay2 = y2 - margin_x*(1 + 2**.5)
-			p.warpToBox(ax1, ax2, ay1, ay2)
+		if (cy - y1) / d > 0.5:
+			ay2 = y2 - margin_x
+			ay1 = y1 + margin_x*(1 + 2**.5)
 		else:
-			raise Exception("Expecting the pixel shape to be a rectangle or triangle!")
+			ay1 = y1 + margin_x
+			ay2 = y2 - margin_x*(1 + 2**.5)
+		p.warpToBox(ax1, ax2, ay1, ay2)
 
-		# Now reject everything not within the margin, and
-		# (for simplicity) send everything within the margin,
-		# no matter close to which edge it actually is, to
-		# all neighbors.
-		(x, y) = bhpix.proj_bhealpix(rows['_LON'], rows['_LAT'])
 		inMargin = ~p.isInsideV(x, y)
+		for neighbor in nhood:
+			masks[neighbor] = inMargin
+		return masks
+	elif p.nPoints() != 4:
+		raise Exception("Expecting the pixel shape to be a rectangle or triangle!")
+
+	# Strips along the edges of the (square) pixel. A neighbor across
+	# an edge gets the points in that edge's strip, a neighbor across
+	# a corner those in the intersection of the two strips. The
+	# neighbors are found as in bhpix.neighbors(), mapping the
+	# offset pixels to valid ones across the edges of the projection.
+	nearx = { -1: x - x1 < margin_x, 0: None, 1: x2 - x < margin_x }
+	neary = { -1: y - y1 < margin_x, 0: None, 1: y2 - y < margin_x }
+	for di in xrange(-1, 2):
+		for dj in xrange(-1, 2):
+			if di == 0 and dj == 0:
+				continue
+			if di and dj:
+				mask = nearx[di] & neary[dj]
+			else:
+				mask = nearx[di] if di else neary[dj]
+			if not mask.any():
+				continue
 
-		if not inMargin.any():
-			continue
-
-		# Fetch only the rows that are within the margin
-		idsInMargin = rows['_ID'][inMargin]
-		q           = db.query("_ID, * FROM '%s' WHERE np.in1d(_ID, idsInMargin, assume_unique=True)" % tabname, {'idsInMargin': idsInMargin} )
-		data        = q.fetch_cell(cell_id)
-
-		# Send these to neighbors
-		if data is not None:
-			for neighbor in qresult.pix.neighboring_cells(cell_id):
-				yield (neighbor, data)
+			for (nx, ny) in bhpix.map_to_valid_pixels(cx + di*d, cy + dj*d, d):
+				neighbor = pix._cell_id_for_xyt(nx, ny, t)
+				assert neighbor in masks
+				masks[neighbor] |= mask
 
-		##print "Scanned margins of %s*.h5 (%d objects)" % (db.table(tabname)._cell_prefix(cell_id), len(data))
+	return masks
 
-def _cache_maker_reducer(kv, db, tabname):
-	# Cache all rows to be cached in this cell
-	cell_id, rowblocks = kv
-	table = db.table(tabname)
+def _cache_maker_mapper(qresult, margin_x, db, tabname):
+	# Map: find the rows to be copied to adjacent cells, and yield them
+	# keyed by destination cell ID. Every neighbor receives a (possibly
+	# empty) block, so it knows to drop the rows it cached from this
+	# cell before.
+	for rows in qresult:
+		cell_id = rows.info.cell_id
 
-	# Get new neighbors
-	rows = colgroup.fromiter(rowblocks, blocks=True)
-	rcells = np.unique(table.pix.cell_for_id(rows._ID))
-	del rows._ID
+		(x, y) = bhpix.proj_bhealpix(rows['_LON'], rows['_LAT'])
+		masks = _margin_strips(qresult.pix, cell_id, x, y, margin_x)
 
-	# Fetch existing, keep only those not supplanted by new
-	oldn = db.query("_ID, * FROM '%s' WHERE _CACHED == True" % tabname).fetch_cell(cell_id, include_cached=True)
-#	print "OLD N:", len(oldn)
-	ocells = table.pix.cell_for_id(oldn._ID)
-	del oldn._ID
-	oldn = oldn[~np.in1d(ocells, rcells)]
-#	if len(oldn):
-#		print "Kept N:", len(oldn)
+		del rows._LON
+		del rows._LAT
+		for neighbor, mask in masks.iteritems():
+			yield (neighbor, (cell_id, rows[mask] if mask.any() else None))
 
-	# Merge
-	rows = colgroup.fromiter([rows, oldn], blocks=True)
-#	print "New N:", len(rows)
+		##print "Scanned margins of %s*.h5 (%d objects)" % (db.table(tabname)._cell_prefix(cell_id), mask.sum())
 
-	# Delete existing and append new ones
-	table.drop_row_group(cell_id, 'cached')
-	table.append(rows, cell_id=cell_id, group='cached')
+def _cache_maker_reducer(kv, db, tabname):
+	# Update the rows cached in this cell with those from the modified
+	# cells that have sent them
+	cell_id, blocks = kv
+	table = db.table(tabname)
 
-	# Return the number of new rows cached into this cell
-	yield cell_id, len(rows)
+	rcells, rowblocks = set(), []
+	for (rcell, rows) in blocks:
+		rcells.add(rcell)
+		if rows is not None:
+			rowblocks.append(rows)
+	rcells = np.fromiter(rcells, dtype=np.uint64)
+
+	# New neighbors
+	rows = colgroup.fromiter(rowblocks, blocks=True) if rowblocks else None
+	if rows is not None:
+		del rows._ID
+
+	# Check (loading just the IDs) if any of the existing cached rows
+	# came from the modified cells
+	cachedq = "_ID FROM '%s' WHERE _CACHED == True" % tabname
+	oldids  = db.query(cachedq).fetch_cell(cell_id, include_cached=True)
+	stale   = np.in1d(table.pix.cell_for_id(oldids._ID), rcells) if oldids is not None else np.zeros(0, dtype=bool)
+
+	if stale.any() and rows is not None and np.in1d(oldids._ID[stale], rows[table.primary_key.name]).all():
+		# All the stale rows are among the new ones (the common case,
+		# with rows only added to the modified cells): replace just
+		# those in place, and append the others
+		table.append(rows, cell_id=cell_id, group='cached', _update=True)
+	elif stale.any():
+		# Some stale rows are gone (e.g., moved away from the margin).
+		# Fetch existing, keep only those not supplanted by new,
+		# and rewrite the cache
+		oldn = db.query("_ID, * FROM '%s' WHERE _CACHED == True" % tabname).fetch_cell(cell_id, include_cached=True)
+		del oldn._ID
+		oldn = oldn[~stale]
+		rows = colgroup.fromiter([ r for r in [rows, oldn] if r is not None ], blocks=True)
+
+		table.drop_row_group(cell_id, 'cached')
+		if len(rows):
+			table.append(rows, cell_id=cell_id, group='cached')
+	elif rows is not None:
+		# Nothing to replace: just append the new rows
+		table.append(rows, cell_id=cell_id, group='cached')
+
+	# Return the number of rows cached into this cell from the
+	# modified cells
+	yield cell_id, sum(len(r) for r in rowblocks)
 
 ###############################################################
 # Aux. functions implementing Query.iterate() and
@@ -2342,20 +3084,115 @@ class TableProxy:
 	def __getattr__(self, name):
 		return self.coldict[self.prefix + '.' + name]
 
-def _mapper(partspec, mapper, qengine, include_cached):
-	(group_cell_id, cell_list) = partspec
-	mapper, mapper_args = utils.unpack_callable(mapper)
+class _Mapper(object):
+	""" The first kernel of Query.execute: runs the user's mapper
+	    on the query results from a (group of) cell(s)
+	"""
+	def __init__(self, mapper, qengine, include_cached):
+		self.mapper, self.qengine, self.include_cached = mapper, qengine, include_cached
+
+	def __call__(self, partspec):
+		(group_cell_id, cell_list) = partspec
+		mapper, mapper_args = utils.unpack_callable(self.mapper)
 
-	# Pass on to mapper (and yield its results)
-	qresult = qengine.on_cells(cell_list, include_cached)
-	for result in mapper(qresult, *mapper_args):
-		yield result
+		# Pass on to mapper (and yield its results)
+		qresult = self.qengine.on_cells(cell_list, self.include_cached)
+		for result in mapper(qresult, *mapper_args):
+			yield result
 
-def _iterate_mapper(qresult):
+	def map_done(self):
+		# Pass on to the user's mapper, if it accumulates results
+		# across cells (see Query.execute)
+		mapper, _ = utils.unpack_callable(self.mapper)
+		if hasattr(mapper, 'map_done'):
+			return mapper.map_done()
+		return iter([])
+
+def _iterate_mapper(qresult, limit=None):
+	# With a LIMIT clause, no more than limit rows are needed
+	# from any cell
 	for rows in qresult:
+		if limit is not None:
+			rows = rows[:limit]
+			limit -= len(rows)
+
 		if len(rows):	# Don't return empty sets. TODO: Do we need this???
 			yield (rows.info.cell_id, rows)
 
+		if limit == 0:
+			break
+
+def _order(keys, desc):
+	# Return the indices sorting keys in ascending (or descending)
+	# order, with NaNs at the end
+	idx = np.argsort(keys, kind='mergesort')
+	if desc:
+		nnan = np.isnan(keys).sum() if keys.dtype.kind in 'fc' else 0
+		idx = np.concatenate((idx[:len(idx)-nnan][::-1], idx[len(idx)-nnan:]))
+	return idx
+
+def _topk(keys, rows, keys2, rows2, k, desc):
+	# Merge two sets of (keys, rows), and keep the first k rows
+	# (sorted by key)
+	if rows is not None:
+		keys2 = np.concatenate((keys, keys2))
+		rows2 = colgroup.fromiter([rows, rows2], blocks=True, copy=False)
+
+	idx = _order(keys2, desc)[:k]
+	return keys2[idx], rows2[idx]
+
+class _TopK(object):
+	""" Mapper for queries with ORDER BY ... LIMIT k (see
+	    Query.iterate). Keeps the first k rows (by the ORDER BY
+	    key) of all cells processed by a worker, and returns them
+	    as a (keys, rows) tuple once the worker has run out of
+	    cells.
+	"""
+	def __init__(self, k, desc):
+		self.k, self.desc = k, desc
+		self.keys = self.rows = None
+
+	def __call__(self, qresult):
+		for rows in qresult:
+			self.keys, self.rows = _topk(self.keys, self.rows, rows.info.order_key, rows, self.k, self.desc)
+		return iter([])
+
+	def map_done(self):
+		keys, rows = self.keys, self.rows
+		self.keys = self.rows = None
+		if rows is not None:
+			yield (keys, rows)
+
+def _merge_topk(results, k, desc):
+	# Merge the (keys, rows) tuples returned by _TopK, and yield the
+	# first k rows as a single (keys, rows) tuple
+	keys = rows = empty = None
+	for (keys2, rows2) in results:
+		if not len(rows2):
+			# The empty result yielded by Query.execute's _yield_empty
+			empty = (keys2, rows2)
+			continue
+		keys, rows = _topk(keys, rows, keys2, rows2, k, desc)
+
+	if rows is not None:
+		yield (keys, rows)
+	elif empty is not None:
+		yield empty
+
+def _or_no_groups(results, gb, qengine):
+	# Pass on the results of a GROUP BY query, or an empty set of
+	# groups if there are none (see Query.fetch)
+	yielded = False
+	try:
+		for result in results:
+			yield result
+			yielded = True
+	finally:
+		results.close()
+
+	if not yielded:
+		yield 0, gb.empty(qengine.peek())
+
 def _into_writer(kw, qwriter):
 	cell_id, irows = kw
 	for rows in irows:
@@ -2368,6 +3205,243 @@ def test_kernel(qresult):
 	for rows in qresult:
 		yield qresult.cell_id, len(rows)
 
+############ Unit tests
+
+class Test_chunks:
+	def setUp(self):
+		import tempfile
+		self.tmpdir = tempfile.mkdtemp()
+		self.db = DB(self.tmpdir)
+		schema = {
+			'schema': {
+				'main': {
+					'columns': [ ('obj_id', 'u8'), ('ra', 'f8'), ('dec', 'f8') ],
+					'primary_key': 'obj_id',
+					'spatial_keys': ['ra', 'dec']
+				}
+			},
+			'commit_hooks': []
+		}
+		np.random.seed(42)
+		with self.db.transaction():
+			self.db.create_table('t', schema).append(dict(ra=np.random.uniform(10, 14, 500), dec=np.random.uniform(20, 24, 500)))
+		self.table = self.db.table('t')
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmpdir)
+
+	def _engine(self, max_rows, max_bytes):
+		# A QueryEngine with the given LSD_CHUNK_ROWS and LSD_CHUNK_BYTES
+		saved = dict(( (name, os.environ.get(name)) for name in ['LSD_CHUNK_ROWS', 'LSD_CHUNK_BYTES'] ))
+		try:
+			os.environ['LSD_CHUNK_ROWS'], os.environ['LSD_CHUNK_BYTES'] = str(max_rows), str(max_bytes)
+			return QueryEngine(self.db, 'obj_id, ra FROM t')
+		finally:
+			for name, value in saved.iteritems():
+				if value is None:
+					os.environ.pop(name, None)
+				else:
+					os.environ[name] = value
+
+	def test_chunk_rows(self):
+		""" The chunk size is the smaller of the row and byte budgets """
+		rowbytes = sum( c.dtype.itemsize for c in self.table.columns.itervalues() )
+		assert self._engine(7, 0).chunk_rows == 7
+		assert self._engine(0, 5*rowbytes).chunk_rows == 5
+		assert self._engine(0, 5*rowbytes + 1).chunk_rows == 5
+		assert self._engine(0, 1).chunk_rows == 1
+		assert self._engine(7, 5*rowbytes).chunk_rows == 5
+		assert self._engine(3, 5*rowbytes).chunk_rows == 3
+		assert self._engine(0, 0).chunk_rows is None
+
+	def test_chunk_boundaries(self):
+		""" Chunks tile the rows of the cell (or its piece) with no more than chunk_rows rows each """
+		for cell_id in self.table.get_cells():
+			nrows = self.table.main_nrows(cell_id)
+			for max_rows in [1, 7, nrows - 1, nrows, nrows + 1]:
+				qe = self._engine(max(max_rows, 1), 0)
+				for piece in [None, (0, 1), (0, 3), (2, 3)]:
+					i, n = piece if piece is not None else (0, 1)
+					chunks = qe._chunks(cell_id, piece, False)
+					ranges = [ TabletCache(self.table.path, piece=chunk).rowrange(cell_id, self.table) or (0, nrows) for chunk in chunks ]
+
+					start, stop = i*nrows // n, (i+1)*nrows // n
+					assert ranges[0][0] == start and ranges[-1][1] == stop, (ranges, start, stop)
+					assert all( a[1] == b[0] for a, b in zip(ranges[:-1], ranges[1:]) ), ranges
+					assert all( b - a <= qe.chunk_rows for a, b in ranges ), (ranges, qe.chunk_rows)
+					if nrows <= n*qe.chunk_rows:
+						assert chunks == [ piece ], chunks
+
+				# Cells are not chunked when the neighbor cache is included
+				assert qe._chunks(cell_id, None, True) == [ None ]
+
+	def test_chunked_query(self):
+		""" A query returns the same rows with cells streamed in chunks """
+		ids = np.sort(self.db.query('obj_id FROM t').fetch(nworkers=1)['obj_id'])
+		assert len(ids) == 500
+		saved = os.environ.get('LSD_CHUNK_ROWS')
+		try:
+			os.environ['LSD_CHUNK_ROWS'] = '7'
+			q = self.db.query('obj_id FROM t')
+			assert q.qengine.chunk_rows == 7
+			assert np.all(np.sort(q.fetch(nworkers=1)['obj_id']) == ids)
+		finally:
+			if saved is None:
+				os.environ.pop('LSD_CHUNK_ROWS', None)
+			else:
+				os.environ['LSD_CHUNK_ROWS'] = saved
+
+class Test_margin_strips:
+	def setUp(self):
+		from pixelization import Pixelization
+		self.pix = Pixelization(level=6, t0=54335, dt=1)
+		self.d = bhpix.pix_size(self.pix.level)
+		self.margin = self.d / 8
+
+	def _points(self, lon, lat, n=5000):
+		# A cell, and random points (x, y) within its bounding box
+		cell_id = self.pix.cell_id_for_pos(lon, lat)
+		cx, cy, _ = self.pix._xyt_from_cell_id(cell_id)
+		np.random.seed(42)
+		x = cx + self.d*np.random.uniform(-.5, .5, n)
+		y = cy + self.d*np.random.uniform(-.5, .5, n)
+		return cell_id, cx, cy, x, y
+
+	def _near_edges(self, cx, cy, x, y):
+		# Points within the margin of any edge of the cell's box
+		d, margin = self.d, self.margin
+		return (x - (cx - d/2) < margin) | ((cx + d/2) - x < margin) | (y - (cy - d/2) < margin) | ((cy + d/2) - y < margin)
+
+	def test_interior_cells(self):
+		""" Points are sent to exactly those neighbors they're within the margin of """
+		for (lon, lat) in [ (12, 22), (45, 41.81), (0, 89.9) ]:
+			cell_id, cx, cy, x, y = self._points(lon, lat)
+			masks = _margin_strips(self.pix, cell_id, x, y, self.margin)
+			assert sorted(masks) == sorted(self.pix.neighboring_cells(cell_id))
+
+			for neighbor, mask in masks.iteritems():
+				# The neighbors are adjacent in the projection
+				nx, ny, _ = self.pix._xyt_from_cell_id(neighbor)
+				assert np.allclose(max(abs(nx - cx), abs(ny - cy)), self.d)
+
+				# Distance from the neighbor, along each axis
+				dx = np.maximum(abs(x - nx) - self.d/2, 0)
+				dy = np.maximum(abs(y - ny) - self.d/2, 0)
+				assert np.all(mask == ((dx < self.margin) & (dy < self.margin)))
+
+			# 4 edge and 4 corner strips
+			assert sum(mask.any() for mask in masks.itervalues()) == 8
+
+	def test_projection_edge(self):
+		""" Points near the edges of the projection go to the neighbors across them """
+		cell_id, cx, cy, x, y = self._points(90, -41.9)
+		masks = _margin_strips(self.pix, cell_id, x, y, self.margin)
+		assert sorted(masks) == sorted(self.pix.neighboring_cells(cell_id))
+
+		near = self._near_edges(cx, cy, x, y)
+		sent = np.zeros(len(x), dtype=bool)
+		for mask in masks.itervalues():
+			sent |= mask
+		assert np.all(sent == near)
+
+		# The strip along the y = -1 edge goes to a neighbor that
+		# isn't adjacent in the projection
+		edge = (y - (cy - self.d/2) < self.margin) & (abs(x - cx) < self.d/2 - self.margin)
+		assert edge.any()
+		across = [ neighbor for neighbor, mask in masks.iteritems() if mask[edge].all() ]
+		assert len(across) == 1
+		nx, ny, _ = self.pix._xyt_from_cell_id(across[0])
+		assert not np.allclose(max(abs(nx - cx), abs(ny - cy)), self.d)
+
+	def test_triangle(self):
+		""" Half-pixels send everything in their margin to all neighbors """
+		cell_id, cx, cy, x, y = self._points(0, 0)
+		p, _ = self.pix.cell_bounds(cell_id)
+		assert p.nPoints() == 3
+
+		masks = _margin_strips(self.pix, cell_id, x, y, self.margin)
+		assert sorted(masks) == sorted(self.pix.neighboring_cells(cell_id))
+
+		mask = masks.values()[0]
+		assert all( np.all(m == mask) for m in masks.itervalues() )
+		assert np.all(mask[self._near_edges(cx, cy, x, y)])
+		assert not mask.all()
+
+class Test_neighbor_cache:
+	def setUp(self):
+		import tempfile
+		self.tmpdir = tempfile.mkdtemp()
+		self.db = DB(self.tmpdir)
+		self.schema = {
+			'schema': {
+				'main': {
+					'columns': [ ('obj_id', 'u8'), ('ra', 'f8'), ('dec', 'f8'), ('mag', 'f4') ],
+					'primary_key': 'obj_id',
+					'spatial_keys': ['ra', 'dec']
+				}
+			},
+			'commit_hooks': [ ('Updating neighbors', 0, 'lsd.tasks', 'build_neighbor_cache') ]
+		}
+
+		# Rows around the corner of four cells, appended in two batches
+		np.random.seed(42)
+		pix = None
+		with self.db.transaction():
+			pix = self.db.create_table('t', self.schema).pix
+		x, y, _ = pix._xyt_from_cell_id(pix.cell_id_for_pos(12, 22))
+		d = bhpix.pix_size(pix.level)
+		rows = []
+		for n in [3000, 1000]:
+			ra, dec = bhpix.deproj_bhealpix(x + d/2 + np.random.uniform(-.02, .02, n)*d, y + d/2 + np.random.uniform(-.02, .02, n)*d)
+			rows.append(dict(ra=ra, dec=dec, mag=np.random.uniform(15, 20, n).astype('f4')))
+		self.rows = rows
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmpdir)
+
+	def _cached(self, tabname):
+		# The (_ID, mag) of the rows cached in each cell
+		table = self.db.table(tabname)
+		cached = {}
+		for cell_id in table.get_cells(include_cached=True):
+			rows = self.db.query("_ID, mag FROM '%s' WHERE _CACHED == True" % tabname).fetch_cell(cell_id, include_cached=True)
+			if rows is not None and len(rows):
+				rows = rows[np.argsort(rows['_ID'])]
+				cached[cell_id] = (list(rows['_ID']), list(rows['mag']))
+		return cached
+
+	def _check(self):
+		# Build the cache of all the rows (with the same keys) at
+		# once, and compare
+		rows = self.db.query('_ID, ra, dec, mag FROM t').fetch(nworkers=1)
+		with self.db.transaction():
+			table = self.db.create_table('full', self.schema)
+			table.append(dict(obj_id=rows['_ID'], ra=rows['ra'], dec=rows['dec'], mag=rows['mag']), _update=True)
+		assert self._cached('t') == self._cached('full')
+		assert len(self._cached('t'))
+
+	def test_append(self):
+		""" Rows appended to a cell are added to the caches of its neighbors """
+		for rows in self.rows:
+			with self.db.transaction():
+				self.db.table('t').append(rows)
+		self._check()
+
+	def test_moved(self):
+		""" Rows moved away from the margins are dropped from the caches """
+		with self.db.transaction():
+			self.db.table('t').append(self.rows[0])
+		# Move some rows to the centers of their cells
+		table = self.db.table('t')
+		ids = self.db.query('_ID FROM t').fetch(nworkers=1)['_ID'][::5]
+		x, y, _ = table.pix._xyt_from_cell_id(table.pix.cell_for_id(ids))
+		ra, dec = bhpix.deproj_bhealpix(x, y)
+		with self.db.transaction():
+			self.db.table('t').append(dict(obj_id=ids, ra=ra, dec=dec), _update=True)
+		self._check()
+
 if __name__ == "__main__":
 	def test():
 		from tasks import compute_coverage
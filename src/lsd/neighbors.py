@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+Neighbor searches, for crossmatching
+
+A neighbor search indexes a set of points in the tangent plane (see
+utils.gnomonic), and answers fixed-radius (within()) and k nearest
+neighbor (knn()) queries against them. The available backends are:
+
+	grid	-- spatial_index.GridIndex, a sorted grid of bins searched
+		   with vectorized binary searches (the default)
+	kdtree	-- scipy.spatial.cKDTree (requires scipy)
+	ann	-- scikits.ann (requires scikits.ann)
+
+The backend is chosen by setting LSD_NN_BACKEND, or per query with the
+nn argument of a crossmatch (e.g., '... FROM ps1_obj, sdss(matchedto=ps1_obj,
+nmax=1,dmax=1,nn=kdtree)', or lsd-xmatch --nn=kdtree).
+
+New backends subclass NeighborSearch, implement within() and/or knn()
+(the base class implements each in terms of the other), and register
+themselves in the backends dictionary.
+"""
+
+import os
+import numpy as np
+import spatial_index
+from utils import gnomonic, gc_dist
+
+class NeighborSearch(object):
+	""" An index of points (x, y) in the tangent plane centered on
+	    (clon, clat), all in degrees.
+	"""
+	clon = clat = None	# Center of the projection
+	n = 0			# Number of indexed points
+
+	def __init__(self, x, y, clon, clat):
+		self.clon, self.clat, self.n = clon, clat, len(x)
+
+	def __len__(self):
+		return self.n
+
+	@classmethod
+	def build(cls, lon, lat, clon, clat):
+		""" Index the points (lon, lat), in the tangent plane at
+		    (clon, clat).
+		"""
+		x, y = gnomonic(lon, lat, clon, clat)
+		return cls(x, y, clon, clat)
+
+	def within(self, x, y, r):
+		""" Find the indexed points within distance r of points
+		    (x, y). Returns a tuple of arrays (i, j, d), with the
+		    indices into x, y, the indices of the indexed points, and
+		    their distances.
+		"""
+		# k nearest neighbor queries, with k doubled for the points
+		# whose k-th neighbor is still within r
+		ii, jj, dd = [], [], []
+		pending, k = np.arange(len(x)), 8
+		while len(pending):
+			i, j, d = self.knn(x[pending], y[pending], k, rmax=r)
+			cnt = np.bincount(i, minlength=len(pending))
+			done = (cnt < k) | (k >= self.n)
+			keep = done[i]
+			ii.append(pending[i[keep]]); jj.append(j[keep]); dd.append(d[keep])
+			pending, k = pending[~done], 2*k
+
+		return _concatenate(ii, jj, dd)
+
+	def knn(self, x, y, k, rmax=None):
+		""" Find up to k nearest indexed points to each of the points
+		    (x, y), no farther than rmax (if given). Returns a tuple
+		    of arrays (i, j, d), as for within(), sorted by i and d.
+		"""
+		# Fixed radius queries, with the radius doubled for the points
+		# with fewer than k neighbors within it. Start from the radius
+		# expected to hold k points, if they were uniformly distributed
+		ii, jj, dd = [], [], []
+		if self.n:
+			pending = np.arange(len(x))
+			span = max(np.ptp(x), np.ptp(y), 1e-5) if len(x) else 1e-5
+			r = span * np.sqrt(float(k) / self.n)
+			if rmax is not None:
+				r = min(r, rmax)
+			while len(pending):
+				i, j, d = self.within(x[pending], y[pending], r)
+				cnt = np.bincount(i, minlength=len(pending))
+				done = (cnt >= min(k, self.n)) | (rmax is not None and r >= rmax)
+				keep = done[i]
+				ii.append(pending[i[keep]]); jj.append(j[keep]); dd.append(d[keep])
+				pending, r = pending[~done], 2*r
+				if rmax is not None:
+					r = min(r, rmax)
+
+		i, j, d = _concatenate(ii, jj, dd)
+		i, j, d, _ = _nearest(i, j, d, k)
+		return i, j, d
+
+class GridSearch(NeighborSearch):
+	""" Searches a spatial_index.GridIndex """
+	def __init__(self, x, y, clon, clat, index=None):
+		if index is None:
+			index = spatial_index.GridIndex.from_xy(x, y, np.arange(len(x)), clon, clat)
+		NeighborSearch.__init__(self, index.x, index.y, clon, clat)
+		self.index = index
+
+	@staticmethod
+	def from_index(index):
+		return GridSearch(None, None, index.clon, index.clat, index=index)
+
+	def within(self, x, y, r):
+		return self.index.candidates(x, y, r)
+
+class KDTreeSearch(NeighborSearch):
+	""" Searches a scipy.spatial.cKDTree """
+	def __init__(self, x, y, clon, clat):
+		from scipy.spatial import cKDTree
+
+		NeighborSearch.__init__(self, x, y, clon, clat)
+		self.tree = cKDTree(np.column_stack((x, y))) if self.n else None
+
+	def within(self, x, y, r):
+		if self.tree is None or not len(x):
+			return _concatenate([], [], [])
+
+		lists = self.tree.query_ball_point(np.column_stack((x, y)), r)
+		cnt = np.fromiter((len(l) for l in lists), dtype=np.int64, count=len(lists))
+		i = np.repeat(np.arange(len(x)), cnt)
+		j = np.fromiter((v for l in lists for v in l), dtype=np.int64, count=cnt.sum())
+		d = np.hypot(self.tree.data[j, 0] - x[i], self.tree.data[j, 1] - y[i])
+		return i, j, d
+
+	def knn(self, x, y, k, rmax=None):
+		if self.tree is None or not len(x):
+			return _concatenate([], [], [])
+
+		k = min(k, self.n)
+		d, j = self.tree.query(np.column_stack((x, y)), k, distance_upper_bound=np.inf if rmax is None else rmax * (1 + 1e-12))
+		d, j = d.reshape(len(x), k), j.reshape(len(x), k)
+		i = np.repeat(np.arange(len(x)), k)
+		d, j = d.ravel(), j.ravel().astype(np.int64)
+		found = j != self.n
+		return i[found], j[found], d[found]
+
+class ANNSearch(NeighborSearch):
+	""" Searches a scikits.ann kD-tree. ANN has no fixed radius
+	    queries, so these are answered with k nearest neighbor ones.
+	"""
+	def __init__(self, x, y, clon, clat):
+		from scikits.ann import kdtree
+
+		NeighborSearch.__init__(self, x, y, clon, clat)
+		self.tree = kdtree(np.column_stack((x, y))) if self.n else None
+
+	def knn(self, x, y, k, rmax=None):
+		if self.tree is None or not len(x):
+			return _concatenate([], [], [])
+
+		k = min(k, self.n)
+		j, d2 = self.tree.knn(np.column_stack((x, y)), k)
+		i = np.repeat(np.arange(len(x)), k)
+		j, d = j.ravel().astype(np.int64), np.sqrt(d2.ravel())
+		if rmax is not None:
+			near = d <= rmax
+			i, j, d = i[near], j[near], d[near]
+		return i, j, d
+
+# Registered backends, and the one used when none is given
+backends = {
+	'grid': GridSearch,
+	'kdtree': KDTreeSearch,
+	'ann': ANNSearch,
+}
+default_backend = os.getenv("LSD_NN_BACKEND", "grid")
+
+def get_backend(name=None):
+	""" Return the backend class registered as name (or the default
+	    one, if name is None).
+	"""
+	if name is None:
+		name = default_backend
+	try:
+		return backends[name.lower()]
+	except KeyError:
+		raise Exception("Unknown neighbor search backend '%s' (known backends: %s)" % (name, ', '.join(sorted(backends))))
+
+def available_backends():
+	""" Names of the backends whose dependencies are installed """
+	avail = []
+	for name in sorted(backends):
+		try:
+			backends[name].build(np.zeros(1), np.zeros(1), 0., 0.)
+		except ImportError:
+			continue
+		avail.append(name)
+	return avail
+
+def for_cell(table, cell_id, lon, lat, backend=None):
+	""" Return a neighbor search of the points (lon, lat), being the
+	    spatial keys of all rows (including the neighbor cache) of a
+	    cell of table. The grid backend uses the index stored at commit
+	    (see spatial_index.index_for_cell).
+	"""
+	cls = get_backend(backend)
+	if cls is GridSearch:
+		return GridSearch.from_index(spatial_index.index_for_cell(table, cell_id, lon, lat))
+
+	clon, clat = spatial_index.cell_center(table.pix, cell_id)
+	return cls.build(lon, lat, clon, clat)
+
+def xmatch(search, lon1, lat1, lon2, lat2, nmax, dmax):
+	""" Find up to nmax nearest neighbors among (lon2, lat2),
+	    indexed by search, closer than dmax (degrees) to each of
+	    (lon1, lat1).
+
+	    Returns a tuple of arrays (i1, i2, dist, nr), with the
+	    indices into lon1 and lon2 of the matched pairs, their
+	    great circle distances, and the rank of the neighbor
+	    (0 for the nearest). The pairs are sorted by i1 and dist.
+	"""
+	if len(lon1) == 0 or len(search) == 0:
+		empty = np.empty(0, dtype=np.int64)
+		return empty, empty, np.empty(0), empty
+
+	# The gnomonic projection stretches distances by up to 1 + r^2
+	# at radius r (in radians) from the center
+	x1, y1 = gnomonic(lon1, lat1, search.clon, search.clat)
+	rmax = np.radians(np.sqrt(x1*x1 + y1*y1).max() + dmax)
+	i1, i2, _ = search.within(x1, y1, dmax * (1 + rmax*rmax) * (1 + 1e-6))
+
+	dist = gc_dist(lon1[i1], lat1[i1], lon2[i2], lat2[i2])
+	near = dist < dmax
+	return _nearest(i1[near], i2[near], dist[near], nmax)
+
+def _concatenate(ii, jj, dd):
+	if not ii:
+		return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+	return np.concatenate(ii).astype(np.int64), np.concatenate(jj).astype(np.int64), np.concatenate(dd)
+
+def _nearest(i, j, d, k):
+	# Sort the pairs by i and d, rank the neighbors of each point by
+	# distance, and keep the nearest k. Returns (i, j, d, rank).
+	order = np.lexsort((d, i))
+	i, j, d = i[order], j[order], d[order]
+	first = np.ones(len(i), dtype=bool)
+	first[1:] = i[1:] != i[:-1]
+	at = np.arange(len(i))
+	nr = at - np.maximum.accumulate(np.where(first, at, 0))
+
+	keep = nr < k
+	return i[keep], j[keep], d[keep], nr[keep]
+
+###################################################################
+## Unit tests
+
+class Test_NeighborSearch:
+	def setUp(self):
+		np.random.seed(11)
+		self.lon2 = np.random.uniform(10, 11, 3000)
+		self.lat2 = np.random.uniform(40, 41, 3000)
+		self.lon1 = np.random.uniform(10, 11, 500)
+		self.lat1 = np.random.uniform(40, 41, 500)
+
+	def brute(self, nmax, dmax):
+		d = gc_dist(self.lon1[:, None], self.lat1[:, None], self.lon2[None, :], self.lat2[None, :])
+		pairs = set()
+		for i in xrange(len(d)):
+			near = np.flatnonzero(d[i] < dmax)
+			for k, j in enumerate(near[np.argsort(d[i][near])][:nmax]):
+				pairs.add((i, j, k))
+		return pairs
+
+	def check_xmatch(self, search):
+		for (nmax, dmax) in [(1, 30/3600.), (3, 60/3600.), (2, 0.1)]:
+			i1, i2, dist, nr = xmatch(search, self.lon1, self.lat1, self.lon2, self.lat2, nmax, dmax)
+			assert set(zip(i1, i2, nr)) == self.brute(nmax, dmax)
+			assert np.all(dist < dmax)
+
+	def check_knn(self, search):
+		x1, y1 = gnomonic(self.lon1, self.lat1, search.clon, search.clat)
+		x2, y2 = gnomonic(self.lon2, self.lat2, search.clon, search.clat)
+		d = np.hypot(x1[:, None] - x2[None, :], y1[:, None] - y2[None, :])
+		for (k, rmax) in [(1, None), (4, None), (4, 0.01)]:
+			i, j, dist = search.knn(x1, y1, k, rmax)
+			assert np.allclose(dist, d[i, j])
+			expect = np.sort(d, axis=1)[:, :k]
+			nexpect = (expect <= rmax).sum(axis=1) if rmax is not None else np.repeat(k, len(d))
+			assert np.all(np.bincount(i, minlength=len(d)) == nexpect)
+			for q in xrange(len(d)):
+				assert np.allclose(dist[i == q], expect[q, :nexpect[q]])
+
+	def test_backends(self):
+		""" Crossmatches and k-NN queries with all available backends """
+		avail = available_backends()
+		assert 'grid' in avail
+		for name in avail:
+			search = get_backend(name).build(self.lon2, self.lat2, 10.5, 40.5)
+			self.check_xmatch(search)
+			self.check_knn(search)
+
+	def test_defaults(self):
+		""" within() and knn() implemented in terms of each other """
+		class KNNOnly(NeighborSearch):
+			def __init__(self, x, y, clon, clat):
+				NeighborSearch.__init__(self, x, y, clon, clat)
+				self.x, self.y = x, y
+
+			def knn(self, x, y, k, rmax=None):
+				d = np.hypot(x[:, None] - self.x[None, :], y[:, None] - self.y[None, :])
+				i, j = np.nonzero(d <= (np.inf if rmax is None else rmax))
+				i, j, d, _ = _nearest(i, j, d[i, j], k)
+				return i, j, d
+
+		search = KNNOnly.build(self.lon2, self.lat2, 10.5, 40.5)
+		self.check_xmatch(search)
+		self.check_knn(search)
+
+		search = GridSearch.build(self.lon2, self.lat2, 10.5, 40.5)
+		self.check_knn(search)
+
+	def test_empty(self):
+		""" Searches with no indexed points """
+		search = GridSearch.build(self.lon2[:0], self.lat2[:0], 10.5, 40.5)
+		i1, i2, dist, nr = xmatch(search, self.lon1, self.lat1, self.lon2[:0], self.lat2[:0], 1, 1/3600.)
+		assert len(i1) == len(i2) == len(dist) == len(nr) == 0
+		i, j, d = search.knn(np.zeros(3), np.zeros(3), 2)
+		assert len(i) == 0
@@ -5,7 +5,7 @@ import Polygon.Shapes
 from interval import intervalset
 from numpy import fabs
 import bounds as bn
-import glob, os
+import glob, os, re
 from collections import defaultdict
 
 u1 = np.uint64(1)
@@ -284,6 +284,20 @@ class Pixelization(object):
 
 		return path
 
+	def cell_for_path(self, path):
+		# Return the cell_id of the cell stored in directory path,
+		# relative to the tablets directory (the inverse of
+		# path_to_cell())
+		parts = path.strip('/').split('/')
+		assert len(parts) == self.level + 1, path
+
+		m = re.match(r'^([+-][0-9.]+(?:e[+-][0-9]+)?)([+-][0-9.]+(?:e[+-][0-9]+)?)$', parts[-2])
+		assert m is not None, path
+		x, y = float(m.group(1)), float(m.group(2))
+		t = self.t0 if parts[-1] == 'static' else float(parts[-1][1:])
+
+		return self._cell_id_for_xyt(x, y, t)
+
 	def _get_temporal_siblings(self, x, y, path, pattern):
 		""" Given a cell_id, get all sibling temporal cells (including the static
 		    sky cell) that exist in it.
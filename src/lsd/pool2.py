@@ -1,21 +1,31 @@
 #!/usr/bin/env python
 
-from multiprocessing import Process, Queue, cpu_count, current_process
+from multiprocessing import Process, Queue, Event, cpu_count, current_process
 import threading
 from pyrpc import PyRPCProxy, RPCError
 from Queue import Empty
 from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+from contextlib import contextmanager
 import socket
 import cPickle as pickle
 import cPickle
+import pickletools
+import types
 import os
 import sys
 import tempfile
+import shutil
+import heapq
+import glob
+import mmap
 import time
 import traceback
 import platform
 import logging
 import signal
+import atexit
 from utils import unpack_callable
 
 logger = logging.getLogger('lsd.pool2')
@@ -23,19 +33,30 @@ logger = logging.getLogger('lsd.pool2')
 RET_KEYVAL = 1
 RET_KEYVAL_LIST = 2
 
-BUFSIZE = 100 * 2**20 if platform.architecture()[0] == '32bit' else 1000 * 2**30
+# spill intermediate map-reduce results to disk (see _ShuffleWriter),
+# unless diskless operation is requested with LSD_DISKLESS
+back_to_disk = os.getenv("LSD_DISKLESS") != "1"
 
-# OS X HFS+ filesystem does not support sparse files
-back_to_disk = platform.system() != 'Darwin'
+# per-worker buffer size for intermediate results before they're
+# spilled to disk, and the number of partitions they're spilled to
+# (0: eight per worker)
+shuffle_bufsize = int(os.getenv("LSD_SHUFFLE_BUFSIZE", 128 * 2**20))
+shuffle_nparts = int(os.getenv("LSD_SHUFFLE_PARTITIONS", 0))
 
-# do not use memory-mapping, if requested
+# maximum number of values a worker collects before running the
+# combiner over them (see _Combiner)
+combine_nvalues = int(os.getenv("LSD_COMBINE_NVALUES", 100000))
+
+# do not use memory-mapping, if requested (the intermediate results
+# are now spilled to run files, read sequentially, so this only
+# disables passing results through shared memory)
 use_mmap = False if os.getenv("LSD_NOMMAP") == "1" else True
-if use_mmap:
-	import mmap
 
-# allow diskless operation with LSD_DISKLESS environment variable
-if os.getenv("LSD_DISKLESS") == "1":
-	back_to_disk = False
+# pass large ColGroup results from workers through shared memory
+# (see _shm_pack), unless disabled with LSD_NOSHM or not available
+shm_dir = os.getenv("LSD_SHMDIR", "/dev/shm")
+use_shm = os.path.isdir(shm_dir) and os.getenv("LSD_NOSHM") != "1" and use_mmap
+shm_min_bytes = int(os.getenv("LSD_SHM_MIN_BYTES", 2**20))
 
 def _profiled_worker(*args, **kwargs):
 	import cProfile, time
@@ -50,13 +71,183 @@ def _profiled_worker(*args, **kwargs):
 		if time.time() - t0 > tmin:
 			profiler.dump_stats('%s/%s.%d.profile' % (os.getenv("PROFILE_DIR", "."), current_process().name, os.getpid()))
 
-def _worker(ident, qcmd, qbroadcast, qin, qout):
+class _ShmColGroup:
+	""" Stands in for a ColGroup whose columns have been placed into
+	    a shared memory segment (a file in shm_dir), in messages sent
+	    from a worker to the parent. See _shm_pack/_shm_unpack.
+	"""
+	def __init__(self, fn, layout, info):
+		self.fn = fn		# Segment filename
+		self.layout = layout	# List of (name, dtype, shape, offset) tuples
+		self.info = info	# ColGroup.info
+
+	def load(self):
+		""" Map the segment and return a ColGroup whose columns
+		    are views into it (no data is copied). The segment file
+		    is removed; the memory is released once the columns are
+		    no longer referenced.
+		"""
+		import numpy as np
+		from colgroup import ColGroup
+
+		with open(self.fn, 'r+b') as f:
+			mm = mmap.mmap(f.fileno(), 0)
+		os.unlink(self.fn)
+
+		cols = []
+		for (name, dtype, shape, offs) in self.layout:
+			count = int(np.prod(shape))
+			cols.append((name, np.frombuffer(mm, dtype=dtype, count=count, offset=offs).reshape(shape)))
+		return ColGroup(cols, info=self.info)
+
+def _shm_pack(result, prefix):
+	""" Replace ColGroups larger than shm_min_bytes in result (either
+	    a ColGroup, or a tuple, such as (cell_id, rows)) with
+	    _ShmColGroup descriptors, copying their data into shared
+	    memory segments whose filenames begin with prefix. This
+	    avoids pickling the data and sending it through a pipe.
+	"""
+	if isinstance(result, tuple):
+		return tuple(_shm_pack(v, prefix) for v in result)
+
+	from colgroup import ColGroup
+	if not isinstance(result, ColGroup) or not result.ncols():
+		return result
+
+	# Only numeric columns can be placed into shared memory
+	cols = [ (name, result[name]) for name in result.keys() ]
+	if any(col.dtype.hasobject for (_, col) in cols):
+		return result
+
+	# Lay out the columns (aligned to 64 bytes)
+	import numpy as np
+	layout, size = [], 0
+	for (name, col) in cols:
+		layout.append((name, col.dtype, col.shape, size))
+		size += (col.nbytes + 63) // 64 * 64
+	if size < shm_min_bytes:
+		return result
+
+	fd, fn = tempfile.mkstemp(prefix=prefix, dir=shm_dir)
+	try:
+		os.ftruncate(fd, size)
+		mm = mmap.mmap(fd, size)
+		for ((name, col), (_, dtype, shape, offs)) in zip(cols, layout):
+			np.frombuffer(mm, dtype=dtype, count=col.size, offset=offs).reshape(shape)[...] = col
+		mm.close()
+	except:
+		os.unlink(fn)
+		raise
+	finally:
+		os.close(fd)
+
+	return _ShmColGroup(fn, layout, result.info)
+
+def _shm_unpack(result):
+	""" Inverse of _shm_pack """
+	if isinstance(result, tuple):
+		return tuple(_shm_unpack(v) for v in result)
+	if isinstance(result, _ShmColGroup):
+		return result.load()
+	return result
+
+def _result_nbytes(result):
+	# A cheap estimate of the pickled size of a result (the
+	# results are pickled only once, when their frame is sent)
+	if isinstance(result, tuple):
+		return sum(_result_nbytes(v) for v in result)
+	if isinstance(result, str):
+		return len(result)
+
+	import numpy as np
+	from colgroup import ColGroup
+	if isinstance(result, np.ndarray):
+		return result.nbytes
+	if isinstance(result, ColGroup):
+		return sum(result[name].nbytes for name in result.keys())
+	return 64
+
+class _ResultFramer:
+	""" Buffers the results (and item completion notices) of a
+	    worker, and sends them to the parent in batches ('FRAME'
+	    messages), to amortize the cost of Queue.put() over many
+	    small results. A frame is sent once it holds more than
+	    max_items results, about max_bytes of data (as estimated by
+	    _result_nbytes), or its oldest entry is older than max_delay
+	    seconds.
+
+	    If frame is None, sends one 'RESULT' message per result and
+	    one 'DONE' message per item (the per-item protocol).
+
+	    If shm is not None, large ColGroup results are passed through
+	    shared memory segments, with filenames beginning with shm
+	    (see _shm_pack).
+	"""
+	def __init__(self, ident, qout, frame, shm=None):
+		self.ident, self.qout, self.shm = ident, qout, shm
+		self.batched = frame is not None
+		if self.batched:
+			self.max_items, self.max_bytes, self.max_delay = frame
+		self._reset()
+
+	def _reset(self):
+		self.results, self.done, self.nbytes, self.t0 = [], [], 0, None
+
+	def result(self, i, result):
+		if self.shm is not None:
+			result = _shm_pack(result, self.shm)
+
+		if not self.batched:
+			self.qout.put((self.ident, 'RESULT', (i, result)))
+			return
+
+		self.results.append((i, result))
+		self.nbytes += _result_nbytes(result)
+		self._maybe_flush()
+
+	def item_done(self, i):
+		if not self.batched:
+			self.qout.put((self.ident, 'DONE', i))
+			return
+
+		self.done.append(i)
+		self._maybe_flush()
+
+	def _maybe_flush(self):
+		if self.t0 is None:
+			self.t0 = time.time()
+		if len(self.results) >= self.max_items or self.nbytes >= self.max_bytes or time.time() - self.t0 >= self.max_delay:
+			self.flush()
+
+	def flush(self):
+		if self.results or self.done:
+			self.qout.put((self.ident, 'FRAME', (self.results, self.done)))
+			self._reset()
+
+def _main_definitions():
+	""" The functions and classes defined in __main__. Pickles refer
+	    to these by name, so the workers unpickle the definitions
+	    they were forked with.
+	"""
+	main = sys.modules['__main__']
+	return dict( (name, obj) for (name, obj) in vars(main).items() if isinstance(obj, (types.FunctionType, types.ClassType, type)) )
+
+def _refers_to_main(pickled):
+	""" Does the pickle refer to any globals of __main__ """
+	for (op, arg, _) in pickletools.genops(pickled):
+		if op.name in ('GLOBAL', 'INST') and arg.split(' ')[0] == '__main__':
+			return True
+	return False
+
+def _worker(ident, qcmd, qbroadcast, qin, qout, cancelled):
 	""" Waits for commands on qcmd. Possible commands are:
 		MAP: On MAP, store mapper and mapper_args, and
 		     begin listening on qin for a stream of
-		     items to be passed to mapper, until a
+		     batches of items to be passed to mapper, until a
 		     message 'DONE' is encountered. Return the
-		     results yielded by mapper via qout.
+		     results yielded by mapper via qout (see
+		     _ResultFramer). Once the cancelled event is
+		     set, the remaining items are skipped.
 	"""
 
 	def check_bqueue():
@@ -64,6 +255,7 @@ def _worker(ident, qcmd, qbroadcast, qin, qout):
 		try:
 			(cmd, args) = qbroadcast.get_nowait()
 			if cmd == "STOP":
+				out.flush()	# Don't sit on results while stopped
 				qout.put((ident, 'STOPPED', None))
 				cmd, args = qcmd.get()	# Expect 'CONT' to unfreeze the job
 				assert cmd == 'CONT', cmd
@@ -71,35 +263,97 @@ def _worker(ident, qcmd, qbroadcast, qin, qout):
 			pass
 
 
+	# The most recently used (mapper, mapper_args), keyed by the digest
+	# of their pickle. Workers of a persistent pool (see shared_pool())
+	# reuse these if the next map is the same, rather than unpickling
+	# (and re-initializing) them again.
+	warm_key, warm = None, None
+
 	try:
 		for cmd, args in iter(qcmd.get, 'EXIT'):
 			if cmd == 'MAP':
-				mapper, mapper_args = cPickle.loads(args)
+				args, frame, shm = args
+				key = digest(args)
+				if key != warm_key:
+					warm_key, warm = None, None
+					try:
+						warm = cPickle.loads(args)
+					except KeyboardInterrupt:
+						raise
+					except:
+						# E.g., a mapper defined in __main__ after
+						# the fork. Report it, and skip the items.
+						type, value, tb = sys.exc_info()
+						tb_str = traceback.format_tb(tb)
+						del tb
+						qout.put((ident, 'EXCEPT', (type, value, tb_str)))
+						for _ in iter(qin.get, 'DONE'):
+							pass
+						qout.put((ident, 'MAPDONE', None))
+						continue
+					warm_key = key
+				mapper, mapper_args = warm
+				out = _ResultFramer(ident, qout, frame, shm)
 
 				check_bqueue()
 
-				i, item, result = None, None, None
-				for (i, item) in iter(qin.get, 'DONE'):
-					# Process an item
+				i, item, result, batch = None, None, None, None
+				for batch in iter(qin.get, 'DONE'):
+					for (i, item) in batch:
+						# Skip the rest of the items if the parent is
+						# no longer interested (see imap_unordered)
+						if cancelled.is_set():
+							continue
+
+						# Process an item
+						try:
+							for result in mapper(item, *mapper_args):
+								out.result(i, result)
+							out.item_done(i)
+						except KeyboardInterrupt:
+							# Handle Ctrl-C by just exiting and not spewing output to stderr
+							raise
+						except:
+							type, value, tb = sys.exc_info()
+							tb_str = traceback.format_tb(tb)
+							del tb    # See docs for sys.exec_info() for why this has to be here
+							out.flush()
+							qout.put((ident, 'EXCEPT', (type, value, tb_str)))
+
+						check_bqueue()
+
+					# Send what we have before waiting for more work
+					out.flush()
+
+				# Let the mapper return any results it has held back
+				# (e.g., see _ShuffleWriter.map_done)
+				if hasattr(mapper, 'map_done') and not cancelled.is_set():
 					try:
-						for result in mapper(item, *mapper_args):
-							qout.put((ident, 'RESULT', (i, result)))
-						qout.put((ident, 'DONE', i))
+						for result in mapper.map_done():
+							out.result(None, result)
 					except KeyboardInterrupt:
-						# Handle Ctrl-C by just exiting and not spewing output to stderr
 						raise
 					except:
 						type, value, tb = sys.exc_info()
 						tb_str = traceback.format_tb(tb)
-						del tb    # See docs for sys.exec_info() for why this has to be here
+						del tb
+						out.flush()
 						qout.put((ident, 'EXCEPT', (type, value, tb_str)))
-
-					check_bqueue()
-
-				# Immediately release memory
-				del result, i, item
+						warm_key, warm = None, None
+					out.flush()
+
+				# A mapper whose map was cancelled may hold state
+				# from the items it has seen (that map_done would
+				# have returned), so it mustn't be reused
+				if cancelled.is_set():
+					warm_key, warm = None, None
+
+				# Immediately release memory (except for the
+				# warm mapper/mapper_args)
+				del result, i, item, batch
 				del mapper, mapper_args
 				del args
+				out = None
 
 				# Announce we're done with this mapper
 				qout.put((ident, 'MAPDONE', None))
@@ -110,42 +364,148 @@ def _worker(ident, qcmd, qbroadcast, qin, qout):
 		for q in [qcmd, qbroadcast, qin, qout]:
 			q.cancel_join_thread()
 
-def _unserializer(file, offsets):
-	# Helper for _reduce_from_pickle_jar -- takes a filename and
-	# a list of offsets, and returns a generator unpickling objects
-	# at given offsets
-	with open(file) as f:
-		if use_mmap:
-			mm = mmap.mmap(f.fileno(), 0, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
-		else:
-			mm = f
+def _task_batches(items, nworkers, costs=None, max_batch=64):
+	""" Split the list of (i, item) tasks into batches to be
+	    pulled by the workers, with sizes decreasing as the work
+	    runs out (guided self-scheduling): each batch holds about
+	    1/(4*nworkers) of the remaining cost (or number of items, if
+	    no costs are given), but no more than max_batch items.
+	"""
+	if costs is None or not sum(costs):
+		costs = [1.]*len(items)
+
+	remaining = float(sum(costs))
+	at = 0
+	while at < len(items):
+		target = remaining / (4 * nworkers)
+		end, c = at + 1, costs[at]
+		while end < len(items) and end - at < max_batch and c + costs[end] <= target:
+			c += costs[end]
+			end += 1
+
+		yield items[at:end]
+		remaining -= c
+		at = end
+
+def _partition(k, nparts):
+	# The partition of key k. The bits of hash(k) are mixed first (by
+	# Fibonacci hashing), as keys such as cell_ids hash to themselves,
+	# and differ mostly in their high bits. The partition is taken from
+	# the top bits of the product, which depend on all bits of the key.
+	h = (hash(k) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+	return int((h * nparts) >> 64)
+
+class _ShuffleWriter:
+	""" Wraps a map (or intermediate reduce) kernel, and writes the
+	    (key, value) pairs it yields to disk, hash-partitioned by key
+	    into nparts partitions, instead of returning them to the
+	    parent.
+
+	    The pairs are buffered in the worker until their (pickled)
+	    size exceeds the buffer size, and then spilled to the
+	    worker's run file of each partition, sorted by key. For each
+	    spilled run, a (partition, (filename, offset, nrecords)) tuple
+	    is returned to the parent. The remaining buffer is spilled by
+	    map_done(), which the worker calls once it runs out of items.
+
+	    The runs are merged and grouped by key by _reduce_from_runs.
+	"""
+	def __init__(self, K_fun, K_args, rundir, nparts, bufsize):
+		self.K_fun, self.K_args = K_fun, K_args
+		self.rundir, self.nparts, self.bufsize = rundir, nparts, bufsize
+		self.buffers, self.nbytes = defaultdict(list), 0
+
+	def __call__(self, item):
+		for (k, v) in self.K_fun(item, *self.K_args):
+			if self._add(k, v):
+				for run in self._spill():
+					yield run
+
+	def _add(self, k, v):
+		# Buffer a (key, value) pair; returns True if it's time to spill
+		p = cPickle.dumps(v, -1)
+		self.buffers[_partition(k, self.nparts)].append((k, p))
 
-		for offs in offsets:
-			##print "Seek to ", offs
-			mm.seek(offs)
-			yield cPickle.load(mm)
+		self.nbytes += len(p) + 64
+		return self.nbytes >= self.bufsize
 
-		mm.close()
+	def _spill(self):
+		buffers, self.buffers, self.nbytes = self.buffers, defaultdict(list), 0
 
-def _reduce_from_pickle_jar(kw, file, reducer, reducer_args):
-	# open the pickle jar, load the objects, pass them on to the
-	# actual reducer
-	key, offsets = kw
-	for result in reducer((key, _unserializer(file, offsets)), *reducer_args):
-		yield result
+		for part, records in buffers.iteritems():
+			records.sort(key=itemgetter(0))
 
-def _output_pickled_kv(item, K_fun, K_args):
-	# return a pickled value, deduplicating if possible
-	unique_objects = set()
+			fn = '%s/%d.%d.run' % (self.rundir, part, os.getpid())
+			with open(fn, 'ab') as fp:
+				offs = fp.tell()
+				for rec in records:
+					cPickle.dump(rec, fp, -1)
 
-	for (k, v) in K_fun(item, *K_args):
-		p = cPickle.dumps(v, -1)
+			yield part, (fn, offs, len(records))
+
+	def map_done(self):
+		# Collect what the wrapped kernel may have held back (e.g.,
+		# see _Combiner), and spill everything
+		if hasattr(self.K_fun, 'map_done'):
+			for (k, v) in self.K_fun.map_done():
+				self._add(k, v)
 
-		hash = digest(p)
-		if hash in unique_objects:
-			p = None
+		return self._spill()
 
-		yield (k, (hash, p))
+class _Combiner:
+	""" Wraps a map kernel, and pre-aggregates the (key, value) pairs
+	    it yields within the worker, before they're sent on to the
+	    reducers.
+
+	    The values are collected per key, until more than nvalues
+	    have been collected in total. The combiner is then called
+	    for each key as combiner((key, values), *combiner_args), and
+	    the (key, value) pairs it yields are passed on. The remaining
+	    values are combined by map_done(), which the worker calls
+	    once it runs out of items.
+	"""
+	def __init__(self, K_fun, K_args, combiner, nvalues):
+		self.K_fun, self.K_args = K_fun, K_args
+		self.C_fun, self.C_args = unpack_callable(combiner)
+		self.nvalues = nvalues
+		self.values, self.n = defaultdict(list), 0
+
+	def __call__(self, item):
+		for (k, v) in self.K_fun(item, *self.K_args):
+			self.values[k].append(v)
+			self.n += 1
+
+			if self.n >= self.nvalues:
+				for kv in self._combine():
+					yield kv
+
+	def _combine(self):
+		values, self.values, self.n = self.values, defaultdict(list), 0
+
+		for kv in values.iteritems():
+			for result in self.C_fun(kv, *self.C_args):
+				yield result
+
+	def map_done(self):
+		return self._combine()
+
+def _read_run(fn, offs, nrecords):
+	# Helper for _reduce_from_runs -- yield the (key, pickled value)
+	# records of a run
+	with open(fn, 'rb') as fp:
+		fp.seek(offs)
+		for _ in xrange(nrecords):
+			yield cPickle.load(fp)
+
+def _reduce_from_runs(kw, reducer, reducer_args):
+	# Merge the (sorted) runs of a partition, and call the actual
+	# reducer once for each key, with a generator unpickling its values
+	_, runs = kw
+	records = heapq.merge(*[ _read_run(*run) for run in runs ])
+	for key, group in groupby(records, itemgetter(0)):
+		values = ( cPickle.loads(p) for _, p in group )
+		for result in reducer((key, values), *reducer_args):
+			yield result
 
 def _reduce_from_pickled(kw, pkl, reducer, args):
 	# open the piclke jar, load the objects, pass them on to the
@@ -161,6 +521,15 @@ def _reduce_from_pickled(kw, pkl, reducer, args):
 
 	return reducer((k, va), *args)
 
+def _nvalues(kv):
+	# Cost estimate for reducer inputs: the number of values
+	return len(kv[1])
+
+def _nrecords(kv):
+	# Cost estimate for partitions of spilled reducer inputs: the
+	# number of (key, value) records in their runs
+	return sum(nrecords for _, _, nrecords in kv[1])
+
 def progress_default(stage, step, input, index, result):
 	self = progress_default
 
@@ -226,20 +595,128 @@ def progress_dots(stage, step, input, index, result):
 def progress_pass(stage, step, input, index, result):
 	pass
 
+def default_nworkers():
+	""" The default number of workers ($NWORKERS or the number of CPUs) """
+	return int(os.getenv('NWORKERS', cpu_count()))
+
 def where(cond, a, b):
 	""" A readable C-ish ternary operator.
 	"""
 	return a if cond else b
 
+# The process-wide persistent pool (see shared_pool())
+_shared = None			# The shared Pool instance
+_shared_pid = None		# PID of the process that created it (forked children must not reuse it)
+_shared_busy = False		# True while the shared pool is checked out
+_shared_timer = None		# Timer that closes the pool's workers once idle
+_shared_lock = threading.Lock()
+
+def _close_idle_shared_pool(pool):
+	# Called by the idle timer; shut down the workers of the
+	# shared pool, unless it's been checked out in the meantime.
+	with _shared_lock:
+		if pool is _shared and not _shared_busy:
+			pool.close()
+
+@atexit.register
+def _shutdown_shared_pool():
+	# Stop the idle timer and the shared pool's workers at exit
+	global _shared, _shared_timer
+	with _shared_lock:
+		timer, _shared_timer = _shared_timer, None
+		if timer is not None:
+			timer.cancel()
+		if _shared is not None and _shared_pid == os.getpid():
+			_shared.close()
+		_shared = None
+
+	# Don't leave the timer thread to be torn down with the interpreter
+	if timer is not None:
+		timer.join()
+
+@contextmanager
+def shared_pool(nworkers=None):
+	""" Check out the process-wide persistent worker pool.
+
+	    Creating a Pool and its workers for every map-reduce run
+	    dominates the runtime of short queries. This context manager
+	    returns a Pool that is kept alive between uses, so that its
+	    worker processes (with the modules they've imported, and the
+	    mapper and arguments of the last map they ran) stay warm.
+	    The workers are started lazily (on first parallel map), and
+	    more are added if a larger nworkers is requested later. They
+	    are shut down once the pool has been idle for more than
+	    $LSD_POOL_IDLE_TIMEOUT seconds (default: 300; 0 disables
+	    the persistent pool altogether). As the workers unpickle
+	    mappers defined in __main__ by name, they're forked anew if
+	    a map refers to __main__ after functions or classes have been
+	    (re)defined there (e.g., in an interactive session).
+
+	    If the shared pool is already in use (e.g., a query is being
+	    run from within the loop iterating over the results of
+	    another), a new private Pool is returned instead, and closed
+	    on exit.
+
+	    Usage:
+	    	with pool2.shared_pool() as pool:
+	    		for result in pool.imap_unordered(...):
+	    			...
+	"""
+	global _shared, _shared_pid, _shared_busy, _shared_timer
+
+	timeout = float(os.getenv('LSD_POOL_IDLE_TIMEOUT', 300))
+
+	timer = None
+	with _shared_lock:
+		if timeout > 0 and not (_shared_busy and _shared_pid == os.getpid()):
+			if _shared is None or _shared_pid != os.getpid():
+				_shared, _shared_pid = Pool(), os.getpid()
+			timer, _shared_timer = _shared_timer, None
+			if timer is not None:
+				timer.cancel()
+			pool = _shared
+			pool.set_nworkers(nworkers)
+			_shared_busy = True
+		else:
+			pool = None
+
+	# Reap the cancelled idle timer's thread (outside of the lock,
+	# which the timer may be waiting for)
+	if timer is not None:
+		timer.join()
+
+	if pool is None:
+		# Not sharing; fall back to a private pool
+		pool = Pool(nworkers)
+		try:
+			yield pool
+		finally:
+			pool.close()
+		return
+
+	try:
+		yield pool
+	finally:
+		with _shared_lock:
+			_shared_busy = False
+			_shared_timer = threading.Timer(timeout, _close_idle_shared_pool, (pool,))
+			_shared_timer.daemon = True
+			_shared_timer.start()
+
 class Pool:
 	qcmd = None
 	qin = None
 	qbroadcast = None
 	qout = None
+	cancelled = None	# Event telling the workers to skip the remaining items of a map
 	ps = []
+	main = None		# The __main__ definitions the workers were forked with (None if they differ between workers)
 	min_tasks_for_parallel = 3
 	DEBUG = None	# Filled in in __init__ from getenv
-	nworkers = None	# Filled in in __init__ from getenv or cpu_count()
+	nworkers = None	# Filled in in __init__ from getenv or cpu_count(); number of workers used by a map
+	batched = True	# Send tasks and results in batches (set LSD_POOL_BATCH=0 for one message per task/result)
+	max_batch = 64	# Maximum number of tasks in a batch (see _task_batches)
+	frame = (256, 4 * 2**20, 0.1)	# Maximum number of results, bytes, and seconds a worker buffers before sending them (see _ResultFramer)
 
 	def __del__(self):
 		self.close()
@@ -286,6 +763,14 @@ class Pool:
 		# Release the queues and worker objects
 		del self.ps[:]
 
+		# Remove any shared memory segments that were in flight
+		if use_shm:
+			for fn in glob.glob(os.path.join(shm_dir, self._shm_prefix() + '*')):
+				try:
+					os.unlink(fn)
+				except OSError:
+					pass
+
 		# Close all queues
 		for qq in [ self.qcmd, self.qin, self.qbroadcast, self.qout ]:
 			if qq is None:
@@ -296,35 +781,57 @@ class Pool:
 			for q in qq:
 				q.close()
 		self.qcmd = self.qin = self.qbroadcast = self.qout = None
+		self.cancelled = None
 
 	def _create_workers(self):
 		""" Lazily create workers, when needed. This routine
 		    creates the worker processes when called the first
-		    time.
+		    time, and adds more if self.nworkers has grown
+		    since.
 		"""
-		if len(self.ps) == self.nworkers:	# Already created?
+		# Start from scratch if any of the workers has died
+		if not all(p.is_alive() for p in self.ps):
+			self.terminate()
+
+		if len(self.ps) >= self.nworkers:	# Already created?
 			return
 
-		self.qin = Queue()
-		self.qbroadcast = Queue()
-		self.qout = Queue(self.nworkers*2)
-		self.qcmd = [ Queue() for _ in xrange(self.nworkers) ]
-		
-		target = _worker if not os.getenv("PROFILE", 0) else _profiled_worker
-		self.ps = [ Process(target=target, name="%s{%02d}" % (current_process().name, i), args=(i, self.qcmd[i], self.qbroadcast, self.qin, self.qout)) for i in xrange(self.nworkers) ]
+		if not len(self.ps):
+			self.qin = Queue()
+			self.qbroadcast = Queue()
+			self.qout = Queue(max(self.nworkers, cpu_count())*2)
+			self.cancelled = Event()
+			self.qcmd = []
+			self.ps = []
+			self.main = _main_definitions()
+		elif self.main != _main_definitions():
+			self.main = None
 
-		for p in self.ps:
+		target = _worker if not os.getenv("PROFILE", 0) else _profiled_worker
+		for i in xrange(len(self.ps), self.nworkers):
+			self.qcmd.append(Queue())
+			p = Process(target=target, name="%s{%02d}" % (current_process().name, i), args=(i, self.qcmd[i], self.qbroadcast, self.qin, self.qout, self.cancelled))
 			p.daemon = True
 			p.start()
+			self.ps.append(p)
 
-	def __init__(self, nworkers = None):
-		self.DEBUG    = int(os.getenv('DEBUG', False))
-		self.nworkers = int(os.getenv('NWORKERS', cpu_count()))
+	def _shm_prefix(self):
+		# Filename prefix of shared memory segments used by this pool's workers
+		return 'lsd-shm-%d-%x-' % (os.getpid(), id(self))
 
-		if nworkers != None:
-			self.nworkers = nworkers
+	def set_nworkers(self, nworkers=None):
+		""" Set the number of workers to use in subsequent maps
+		    (None = $NWORKERS or the number of CPUs). Workers are
+		    added lazily, if needed.
+		"""
+		self.nworkers = default_nworkers() if nworkers is None else nworkers
+		self._ntarget, self._ntarget_time = self.nworkers, 0
 
-		self._ntarget = self.nworkers
+	def __init__(self, nworkers = None):
+		self.DEBUG    = int(os.getenv('DEBUG', False))
+		self.batched  = os.getenv('LSD_POOL_BATCH', '1') != '0'
+		self.ps       = []
+		self.set_nworkers(nworkers)
 
 	_ntarget_time = 0	# Last time _ntarget was refreshed
 	_ntarget = None		# Target number of active workers
@@ -341,13 +848,33 @@ class Pool:
 
 		return self._ntarget
 
-	def imap_unordered(self, input, mapper, mapper_args=(), progress_callback=None, progress_callback_stage='map'):
+	def imap_unordered(self, input, mapper, mapper_args=(), progress_callback=None, progress_callback_stage='map', cost=None):
 		""" Execute in parallel a callable <mapper> on all values of
 		    iterable <input>, ensuring that no more than ~nworkers
-		    results are pending in the output queue """
+		    results are pending in the output queue.
+
+		    If a callable <cost> is given, it must return the
+		    (estimated) cost of processing an item. Items are then
+		    dispatched in order of decreasing cost, so that the most
+		    expensive ones don't end up straggling at the end. As
+		    workers pull items from a common queue, the rest of the
+		    load is balanced dynamically.
+
+		    If the returned generator is closed before all results
+		    have been consumed (e.g., once a query's LIMIT has been
+		    reached), the items not yet started are cancelled and
+		    the workers are kept for reuse.
+		"""
 		if progress_callback == None:
 			progress_callback = progress_default;
 
+		costs = None
+		if cost is not None:
+			costed = sorted(( (cost(item), item) for item in input ), key=lambda ci: ci[0], reverse=True)
+			costs = [ c for (c, _) in costed ]
+			input = [ item for (_, item) in costed ]
+			del costed
+
 		progress_callback(progress_callback_stage, 'begin', input, None, None)
 
 		# Try to optimize and not dispatch to workers if there are less
@@ -362,7 +889,14 @@ class Pool:
 		# Dispatch/execute
 		if parallel:
 			try:
-				# Create workers (if not created already)
+				# Create workers (if not created already). If the
+				# mapper or its arguments refer to __main__, where
+				# functions or classes were (re)defined since the
+				# workers were forked (e.g., in an interactive
+				# session), fork them anew so they'll see those.
+				map_args = cPickle.dumps((mapper, mapper_args), -1)
+				if self.ps and _refers_to_main(map_args) and self.main != _main_definitions():
+					self.close()
 				_mgr = PyRPCProxy("localhost", 9029)
 				self._create_workers()
 
@@ -374,16 +908,24 @@ class Pool:
 				for _ in xrange(nstopping):
 					self.qbroadcast.put( ('STOP', None) )
 
-				# Initialize this map
-				map_args = cPickle.dumps((mapper, mapper_args), -1)
-				for q in self.qcmd:
-					q.put( ('MAP', map_args) )
+				# Initialize this map (there may be more workers
+				# than needed, if the pool is reused; only the first
+				# self.nworkers are sent the MAP command)
+				frame = self.frame if self.batched else None
+				shm = self._shm_prefix() if use_shm else None
+				for q in self.qcmd[:self.nworkers]:
+					q.put( ('MAP', (map_args, frame, shm)) )
 
 				# Queue the data to operate on
-				i = -1
-				for (i, item) in enumerate(input):
-					self.qin.put( (i, item) )
-				n = i + 1
+				tasks = list(enumerate(input))
+				if self.batched:
+					batches = _task_batches(tasks, self.nworkers, costs, self.max_batch)
+				else:
+					batches = ( [ task ] for task in tasks )
+				for batch in batches:
+					self.qin.put(batch)
+				n = len(tasks)
+				del tasks, batches
 
 				# Queue the end-of-map markers
 				for _ in xrange(self.nworkers):
@@ -395,9 +937,16 @@ class Pool:
 				wf = 0	# Number of workers that have finished
 				while wf != self.nworkers or k != n or nstopping != 0:
 					(ident, what, data) = self.qout.get()
-					if what == 'RESULT':
+					if what == 'FRAME':
+						results, done = data
+						for (i, result) in results:
+							yield _shm_unpack(result)
+						for i in done:
+							k += 1
+							progress_callback(progress_callback_stage, 'step', input, k, None)
+					elif what == 'RESULT':
 						i, result = data
-						yield result
+						yield _shm_unpack(result)
 					elif what == 'MAPDONE':
 						wf += 1
 					elif what == 'DONE':
@@ -449,6 +998,39 @@ class Pool:
 				assert k == n			# All items must have been processed
 				assert nstopping == 0		# No outstanding STOP orders
 
+			except GeneratorExit:
+				# The consumer has stopped iterating. Have the
+				# workers skip the remaining items, and wait for
+				# them to finish the ones they've begun, discarding
+				# the results.
+				try:
+					self.cancelled.set()
+					for ident in stopped:
+						self.qcmd[ident].put(("CONT", None))
+
+					while wf != self.nworkers:
+						(ident, what, data) = self.qout.get()
+						if what == 'FRAME':
+							for (i, result) in data[0]:
+								_shm_unpack(result)	# Releases shm segments
+						elif what == 'RESULT':
+							_shm_unpack(data[1])
+						elif what == 'MAPDONE':
+							wf += 1
+						elif what == 'STOPPED':
+							nstopping -= 1
+							self.qcmd[ident].put(("CONT", None))
+
+					# Rescind outstanding STOP orders, if any
+					for _ in xrange(nstopping):
+						self.qbroadcast.get()
+
+					self.cancelled.clear()
+				except BaseException:
+					self.terminate()
+					raise
+
+				raise
 			except BaseException as e:
 				# Terminate the workers if an exception ocurred
 				# If the reason we're exiting is a KeyboardInterrupt, assume all
@@ -466,6 +1048,9 @@ class Pool:
 				for result in mapper(item, *mapper_args):
 					yield result
 				progress_callback(progress_callback_stage, 'step', input, i, None)
+			if hasattr(mapper, 'map_done'):
+				for result in mapper.map_done():
+					yield result
 
 		progress_callback(progress_callback_stage, 'end', input, None, None)
 
@@ -540,7 +1125,7 @@ class Pool:
 		if progress_callback != None:
 			progress_callback('mapreduce', 'end', None, None, None)
 
-	def map_reduce_chain(self, input, kernels, progress_callback=None):
+	def map_reduce_chain(self, input, kernels, progress_callback=None, cost=None, combiner=None):
 		""" A poor-man's map-reduce implementation.
 		
 		    Calls the mapper for each value in the <input> iterable. 
@@ -557,6 +1142,28 @@ class Pool:
 		    	- mapper must return a dictionary of (key, value) pairs
 		    	- reducer must expect a (key, value) pair as the first
 		    	  argument, where the value will be an iterable
+		    	- if given, cost(item) must return the estimated
+		    	  cost of mapping an item of <input>; the most
+		    	  expensive items are dispatched first (see
+		    	  imap_unordered). Reducer inputs are dispatched in
+		    	  order of decreasing number of values.
+		    	- unless LSD_DISKLESS=1, intermediate (key, value)
+		    	  pairs are hash-partitioned by key and spilled to
+		    	  disk, sorted (see _ShuffleWriter), and the reducers
+		    	  are dispatched one partition at a time, getting
+		    	  called for each of its keys in sorted order (see
+		    	  _reduce_from_runs). The keys must be hashable and
+		    	  comparable.
+		    	- if given, the combiner is called within the
+		    	  workers with the (key, values) pairs yielded by the
+		    	  mapper (across one or more items), and must yield
+		    	  (key, value) pairs that are passed on to the
+		    	  reducer instead (see _Combiner). Use it to
+		    	  pre-aggregate associative reductions (counts, sums,
+		    	  histograms); note that the reducer may receive
+		    	  combined as well as uncombined values for a key,
+		    	  and that the combiner may be called more than once
+		    	  for the same key.
 		"""
 
 		if progress_callback == None:
@@ -565,92 +1172,53 @@ class Pool:
 		progress_callback('mapreduce', 'begin', input, None, None)
 
 		if back_to_disk:
-			fp, prev_fp = None, None
-			mm, prev_mm = None, None
-
-		for i, K in enumerate(kernels):
-			K_fun, K_args = unpack_callable(K)
-			last_step = (i + 1 == len(kernels))
-			stage = where(i == 0, 'map', 'reduce')
-
-			if back_to_disk:
-				# Reinitialize the unique_hash->file_offset map
-				unique_objects = {}
-
-				# Insert picklers/unpicklers
-				if i != 0:
-					# Insert unpickler
-					K_fun, K_args = _reduce_from_pickle_jar, (prev_fp.name, K_fun, K_args)
-
-				if not last_step:
-					# Insert pickler
-					K_fun, K_args = _output_pickled_kv, (K_fun, K_args)
-
-					# Create a disk backing store for intermediate results
-					fp = tempfile.NamedTemporaryFile(mode='wb', prefix='mapresults-', dir=os.getenv('LSD_TEMPDIR'), suffix='.pkl', delete=True)
-					if use_mmap:
-						fd = fp.file.fileno()
-						os.ftruncate(fd, BUFSIZE)
-						mm = mmap.mmap(fd, 0)
-					else:
-						mm = fp
+			nparts = shuffle_nparts or 8 * max(self.nworkers, 1)
+		rundir, prev_rundir = None, None
+
+		try:
+			for i, K in enumerate(kernels):
+				K_fun, K_args = unpack_callable(K)
+				last_step = (i + 1 == len(kernels))
+				stage = where(i == 0, 'map', 'reduce')
+
+				# Insert the combiner
+				if i == 0 and combiner is not None and not last_step:
+					K_fun, K_args = _Combiner(K_fun, K_args, combiner, combine_nvalues), ()
+
+				if back_to_disk:
+					# Insert the merger of the previous stage's runs
+					if i != 0:
+						K_fun, K_args = _reduce_from_runs, (K_fun, K_args)
+
+					# Insert the spiller, and create a directory for its runs
+					if not last_step:
+						rundir = tempfile.mkdtemp(prefix='mapresults-', dir=os.getenv('LSD_TEMPDIR'))
+						K_fun, K_args = _ShuffleWriter(K_fun, K_args, rundir, nparts, shuffle_bufsize), ()
 
-			try:
 				# Call the distributed mappers
 				mresult = defaultdict(list)
-				for r in self.imap_unordered(input, K_fun, K_args, progress_callback=progress_callback, progress_callback_stage=stage):
+				for r in self.imap_unordered(input, K_fun, K_args, progress_callback=progress_callback, progress_callback_stage=stage, cost=cost):
 					if last_step:
 						# yield the final result
 						yield r
 					else:
+						# Prepare for next reduction. If spilling to disk,
+						# this is a (partition, run) tuple.
 						(k, v) = r
-
-						if back_to_disk:
-							(hash, v) = v
-							if hash in unique_objects:
-								v = unique_objects[hash]
-							else:
-								# The output value has already been pickled (but not the key). Store the
-								# pickled value into the pickle jar, and keep the (key, offset) tuple.
-								offs = mm.tell()
-								mm.write(v)
-								assert len(v) == mm.tell() - offs
-								v = offs
-								unique_objects[hash] = offs
-
-						# Prepare for next reduction
 						mresult[k].append(v)
 
 				input = mresult.items()
-			except:
-				# In case of an exception, delete the temporary file so the kernel
-				# won't attempt to flush them to the disk
-				if back_to_disk:
-					if mm is not None and use_mmap:
-						mm.resize(1)
-						mm.close()
-						mm = None
-
-					if fp is not None:
-						os.ftruncate(fp.file.fileno(), 0)
-						fp.close()
-						fp = None
-				raise
-			finally:
-				if back_to_disk:
-					# Close/clear the intermediate result backing store from the previous step
-					# ensuring it's truncated first so it doesn't hit the disk if it hasn't
-					# already.
-					if prev_fp is not None:
-						if use_mmap:
-							prev_mm.resize(1)
-							prev_mm.close()
-						os.ftruncate(prev_fp.file.fileno(), 0)
-						prev_fp.close()
-
-					if fp is not None:
-						prev_fp, prev_mm = fp, mm
-						fp, mm = None, None
+				cost = _nrecords if back_to_disk else _nvalues
+				del mresult
+
+				# Remove the runs of the previous stage
+				if prev_rundir is not None:
+					shutil.rmtree(prev_rundir, ignore_errors=True)
+				prev_rundir, rundir = rundir, None
+		finally:
+			for d in [ rundir, prev_rundir ]:
+				if d is not None:
+					shutil.rmtree(d, ignore_errors=True)
 
 		if progress_callback != None:
 			progress_callback('mapreduce', 'end', None, None, None)
@@ -661,6 +1229,34 @@ def digest(s):
 	#return hashlib.sha1(s).digest()
 	return hashlib.md5(s).digest()
 
+############ Benchmark
+
+def _bench_pool2_mapper(item, nresults):
+	for j in xrange(nresults):
+		yield item, j
+
+def benchmark(nitems=20000, nresults=1, nworkers=None):
+	""" Compare the throughput of the per-item and batched task
+	    dispatch/result protocols, on a mapper that does no work
+	    and yields nresults small results per item.
+
+	    Run as: python -m lsd.pool2 [nitems [nresults [nworkers]]]
+	"""
+	for batched in [False, True]:
+		pool = Pool(nworkers)
+		pool.batched = batched
+
+		t0 = time.time()
+		n = 0
+		for _ in pool.imap_unordered(xrange(nitems), _bench_pool2_mapper, (nresults,), progress_callback=progress_pass):
+			n += 1
+		dt = time.time() - t0
+		pool.close()
+
+		assert n == nitems*nresults
+		print "%-8s: %d items, %d results, %d workers: %.2f sec (%.0f items/sec)" % \
+			('batched' if batched else 'per-item', nitems, n, pool.nworkers, dt, nitems / dt)
+
 ############ Unit tests
 
 # ====
@@ -693,6 +1289,33 @@ def _test_mapred2_red2(kv, d):
 	for val in v:
 		yield val + d
 # ====
+def _test_pool2_pid(a):
+	time.sleep(.05)
+	yield os.getpid()
+# ====
+def _test_pool2_colgroup(n, m):
+	from colgroup import ColGroup
+	yield n, ColGroup([('a', np.arange(m) + n), ('b', np.ones((m, 3)))])
+# ====
+class _TestPool2Counter(object):
+	# A stateful mapper, returning the number of items it has seen
+	# from map_done
+	def __init__(self):
+		self.n = 0
+
+	def __call__(self, a):
+		time.sleep(.01)
+		self.n += 1
+		yield 'item', a
+
+	def map_done(self):
+		n, self.n = self.n, 0
+		yield 'count', n
+# ====
+def _test_pool2_define_in_main(src):
+	# (Re)define a function in __main__, as in an interactive session
+	exec src in vars(sys.modules['__main__'])
+# ====
 
 class Test_Pool:
 	@classmethod
@@ -769,3 +1392,160 @@ class Test_Pool:
 			print r3
 			assert np.all(res == r3)
 
+	def test_mapred_spill(self):
+		""" Map-Reduce: intermediate results spilled in many runs, or kept in memory """
+		global back_to_disk, shuffle_bufsize
+		tmpdir = tempfile.mkdtemp()
+		os.environ['LSD_TEMPDIR'], tempdir0 = tmpdir, os.getenv('LSD_TEMPDIR')
+		try:
+			for disk, bufsize in [(True, 1), (True, 2**10), (False, 0)]:
+				back_to_disk, back_to_disk0 = disk, back_to_disk
+				shuffle_bufsize, shuffle_bufsize0 = bufsize, shuffle_bufsize
+				try:
+					arr = np.arange(300)
+					it = self.pool.map_reduce_chain(arr, [ (_test_mapred2_map, 0, 7), _test_mapred2_red1 ], progress_callback=progress_pass)
+					res = sorted(it)
+				finally:
+					back_to_disk, shuffle_bufsize = back_to_disk0, shuffle_bufsize0
+
+				r = defaultdict(int)
+				for a in arr:
+					r[a] += 1
+					r[a + 7] += a
+				assert res == sorted(r.items())
+				assert not os.listdir(tmpdir)
+		finally:
+			if tempdir0 is None:
+				del os.environ['LSD_TEMPDIR']
+			else:
+				os.environ['LSD_TEMPDIR'] = tempdir0
+			shutil.rmtree(tmpdir)
+
+	def test_partition(self):
+		""" Map-Reduce: keys differing in their high bits spread over all partitions """
+		keys = [ (i << 40) | (j << 34) for i in xrange(128) for j in xrange(16) ]
+		for nparts in [7, 8, 64]:
+			counts = np.bincount([ _partition(k, nparts) for k in keys ], minlength=nparts)
+			assert len(counts) == nparts and counts.max() < 1.5 * len(keys) / nparts
+
+	def test_mapred_combiner(self):
+		""" Map-Reduce: values pre-aggregated by a combiner """
+		global back_to_disk, combine_nvalues
+		for disk, nvalues in [(True, 1), (True, 7), (False, 100000)]:
+			back_to_disk, back_to_disk0 = disk, back_to_disk
+			combine_nvalues, combine_nvalues0 = nvalues, combine_nvalues
+			try:
+				arr = np.arange(300)
+				it = self.pool.map_reduce_chain(arr, [ (_test_mapred2_map, 0, 7), _test_mapred2_red1 ], progress_callback=progress_pass, combiner=_test_mapred2_red1)
+				res = sorted(it)
+			finally:
+				back_to_disk, combine_nvalues = back_to_disk0, combine_nvalues0
+
+			r = defaultdict(int)
+			for a in arr:
+				r[a] += 1
+				r[a + 7] += a
+			assert res == sorted(r.items())
+
+	def test_imap_cost(self):
+		""" Mapper, items dispatched in order of decreasing cost """
+		pool = Pool(1)
+		it = pool.imap_unordered([3, 1, 4, 1, 5, 9, 2, 6], _test_pool2_add, (0,), progress_callback=progress_pass, cost=lambda x: x)
+		assert list(it) == [9, 6, 5, 4, 3, 2, 1, 1]
+
+	def test_shm_colgroup(self):
+		""" Large ColGroup results passed through shared memory """
+		global use_shm
+		for shm in [False, True]:
+			use_shm, use_shm0 = shm and os.path.isdir(shm_dir), use_shm
+			try:
+				m = 2*shm_min_bytes // 8
+				res = dict(self.pool.imap_unordered(range(5), _test_pool2_colgroup, (m,), progress_callback=progress_pass))
+			finally:
+				use_shm = use_shm0
+			for n, rows in res.iteritems():
+				assert np.all(rows['a'] == np.arange(m) + n)
+				assert rows['b'].shape == (m, 3) and np.all(rows['b'] == 1)
+		assert not glob.glob(os.path.join(shm_dir, self.pool._shm_prefix() + '*'))
+
+	def test_imap_cancel(self):
+		""" Mapper, closed early: remaining items cancelled, workers kept """
+		pool = Pool(2)
+		try:
+			it = pool.imap_unordered(range(40), _test_pool2_pid, progress_callback=progress_pass)
+			pids = set([ next(it) for _ in xrange(3) ])
+			workers = [ p.pid for p in pool.ps ]
+			t0 = time.time()
+			it.close()
+			assert time.time() - t0 < 1	# Didn't process all of the remaining items
+			assert pids <= set(workers)
+
+			res = sorted(pool.imap_unordered(range(20), _test_pool2_add, (1,), progress_callback=progress_pass))
+			assert res == range(1, 21)
+			assert workers == [ p.pid for p in pool.ps ]
+		finally:
+			pool.close()
+
+	def test_imap_cancel_stateful(self):
+		""" Mapper, closed early: state of a stateful mapper not carried over to the next map """
+		pool = Pool(3)
+		try:
+			mapper = _TestPool2Counter()
+			it = pool.imap_unordered(range(100), mapper, progress_callback=progress_pass)
+			for _ in xrange(5):
+				next(it)
+			it.close()
+
+			res = list(pool.imap_unordered(range(100), mapper, progress_callback=progress_pass))
+			assert sum( n for (what, n) in res if what == 'count' ) == 100
+			assert sorted( a for (what, a) in res if what == 'item' ) == range(100)
+		finally:
+			pool.close()
+
+	def test_shared_pool(self):
+		""" Persistent pool: workers reused, nested use gets a private pool """
+		with shared_pool(2) as pool:
+			pids1 = set(pool.imap_unordered(range(10), _test_pool2_pid, progress_callback=progress_pass))
+			workers = [ p.pid for p in pool.ps ]
+
+			with shared_pool(2) as pool2:
+				assert pool2 is not pool
+
+		with shared_pool(2) as pool2:
+			assert pool2 is pool
+			pids2 = set(pool2.imap_unordered(range(10), _test_pool2_pid, progress_callback=progress_pass))
+
+		assert workers == [ p.pid for p in pool.ps ]
+		assert pids1 <= set(workers) and pids2 <= set(workers)
+
+	def test_shared_pool_main(self):
+		""" Persistent pool: mappers (re)defined in __main__ after the workers were forked """
+		main = sys.modules['__main__']
+		try:
+			_test_pool2_define_in_main("def _test_pool2_main_map(a):\n\tyield a % 3, a\n")
+			with shared_pool(2) as pool:
+				res1 = sorted(pool.map_reduce_chain(range(30), [ main._test_pool2_main_map, _test_mapred2_red1 ], progress_callback=progress_pass))
+				workers = [ p.pid for p in pool.ps ]
+
+			# The same mapper again: the workers are reused
+			with shared_pool(2) as pool:
+				assert sorted(pool.map_reduce_chain(range(30), [ main._test_pool2_main_map, _test_mapred2_red1 ], progress_callback=progress_pass)) == res1
+				assert workers == [ p.pid for p in pool.ps ]
+
+			# Redefined mapper
+			_test_pool2_define_in_main("def _test_pool2_main_map(a):\n\tyield a % 3, 2*a\n")
+			with shared_pool(2) as pool:
+				res2 = sorted(pool.map_reduce_chain(range(30), [ main._test_pool2_main_map, _test_mapred2_red1 ], progress_callback=progress_pass))
+			assert res1 == [ (k, sum(range(k, 30, 3))) for k in xrange(3) ]
+			assert res2 == [ (k, 2*v) for (k, v) in res1 ]
+
+			# Mapper first defined after the workers were forked
+			_test_pool2_define_in_main("def _test_pool2_main_map2(a):\n\tyield a + 1\n")
+			with shared_pool(2) as pool:
+				assert sorted(pool.imap_unordered(range(10), main._test_pool2_main_map2, progress_callback=progress_pass)) == range(1, 11)
+		finally:
+			for name in [ '_test_pool2_main_map', '_test_pool2_main_map2' ]:
+				vars(main).pop(name, None)
+
+if __name__ == '__main__':
+	benchmark(*[ int(v) for v in sys.argv[1:] ])
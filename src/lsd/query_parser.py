@@ -2,8 +2,9 @@
 
 import StringIO
 import tokenize
+import ast
 
-valid_keys_from = frozenset(['nmax', 'dmax', 'inner', 'outer', 'xmatch', 'matchedto'])
+valid_keys_from = frozenset(['nmax', 'dmax', 'nn', 'inner', 'outer', 'xmatch', 'matchedto'])
 valid_keys_into = frozenset(['spatial_keys', 'temporal_key', 'dtype', 'no_neighbor_cache'])
 
 def unquote(s):
@@ -58,12 +59,162 @@ def parse_args(g, token, valid_keys):
 
 	return args, token
 
+def _tokenize(s):
+	# Tokenize s, returning the list of tokens and a function mapping
+	# a token to its offset in s
+	offsets = [0]
+	for line in StringIO.StringIO(s):
+		offsets.append(offsets[-1] + len(line))
+	def at(tok):
+		(row, col) = tok[2]
+		return offsets[row-1] + col
+
+	tokens = list(tokenize.generate_tokens(StringIO.StringIO(s).readline))
+	return tokens, at
+
+def split_toplevel(s, sep=','):
+	""" Split the string s on the token sep, where it appears
+	    outside of parenthesis (e.g., 'a, f(b, c)' gives ['a',
+	    'f(b, c)']). Returns the list of stripped parts (an empty
+	    list if s is blank).
+	"""
+	tokens, at = _tokenize(s)
+	parts, start, depth = [], 0, 0
+	for tok in tokens:
+		token = tok[1]
+		if token in ['(', '[', '{']:
+			depth += 1
+		elif token in [')', ']', '}']:
+			depth -= 1
+		elif depth == 0 and token == sep:
+			parts.append(s[start:at(tok)].strip())
+			start = at(tok) + len(token)
+	parts.append(s[start:].strip())
+
+	if parts == ['']:
+		return []
+	if '' in parts:
+		raise Exception('Syntax error: empty expression in "%s"' % s)
+	return parts
+
+def parse_group_by(query):
+	""" Split the optional trailing GROUP BY clause off a query of
+	    the form:
+
+	    ... [GROUP BY expr1, expr2, ...]
+
+	    with the ORDER BY and LIMIT clauses already removed (see
+	    parse_order_limit). Returns a (query, group_by) tuple, where
+	    group_by is None or the list of GROUP BY expressions.
+	"""
+	tokens, at = _tokenize(query)
+	depth = 0
+	for k, tok in enumerate(tokens):
+		(id, token) = tok[:2]
+		if token in ['(', '[', '{']:
+			depth += 1
+		elif token in [')', ']', '}']:
+			depth -= 1
+		elif depth == 0 and id == tokenize.NAME and token.lower() == 'group':
+			following = [ t for t in tokens[k+1:] if t[0] not in (tokenize.NEWLINE, tokenize.NL, tokenize.ENDMARKER) ]
+			if following and following[0][1].lower() == 'by':
+				group_by = split_toplevel(query[at(following[0]) + 2:])
+				if not group_by:
+					raise Exception('Syntax error: expected an expression after GROUP BY')
+				return query[:at(tok)].rstrip(), group_by
+			elif not following and k and tokens[k-1][0] != tokenize.OP:
+				# A trailing GROUP, that isn't the operand of an
+				# expression (i.e., a column named 'group')
+				raise Exception('Syntax error: expected BY after GROUP')
+
+	return query, None
+
+def parse_order_limit(query):
+	""" Split the optional trailing ORDER BY and LIMIT clauses off
+	    a query of the form:
+
+	    ... [ORDER BY expr [ASC|DESC]] [LIMIT n]
+
+	    Returns a (query, order_by, limit) tuple, where query is the
+	    rest of the query, order_by is None or an (expr, descending)
+	    tuple, and limit is None or an integer.
+
+	    The clauses are recognized only after the last WHERE (or
+	    FROM) keyword, and LIMIT only at the end of the query,
+	    followed by an integer. Elsewhere, 'order' and 'limit' may
+	    be used as the names of columns (or variables).
+	"""
+	tokens, at = _tokenize(query)
+
+	# The (indices of) tokens outside of parenthesis
+	top, depth = [], 0
+	for k, tok in enumerate(tokens):
+		(id, token) = tok[:2]
+		if token in [')', ']', '}']:
+			depth -= 1
+		elif depth == 0 and id not in [tokenize.NEWLINE, tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER]:
+			top.append(k)
+		if token in ['(', '[', '{']:
+			depth += 1
+
+	def is_name(k, name):
+		return tokens[k][0] == tokenize.NAME and tokens[k][1].lower() == name
+
+	# LIMIT n, at the end of the query. As a name is never followed
+	# by a number in an expression, 'limit n' anywhere else can only
+	# be a misplaced LIMIT clause.
+	limit_at = limit = None
+	for (i, k) in enumerate(top[:-1]):
+		if is_name(k, 'limit') and tokens[top[i+1]][0] == tokenize.NUMBER:
+			try:
+				limit = ast.literal_eval(tokens[top[i+1]][1])
+			except (ValueError, SyntaxError):
+				pass
+			if i + 2 != len(top) or not isinstance(limit, (int, long)):
+				raise Exception('Syntax error in LIMIT clause (expected an integer, at the end of the query)')
+			limit_at = k
+
+	# ORDER BY, after the last WHERE or FROM
+	start = max([ i for (i, k) in enumerate(top) if is_name(k, 'where') or is_name(k, 'from') ] + [ -1 ])
+	order_at = None
+	for (i, k) in enumerate(top[start+1:-1], start+1):
+		if limit_at is not None and k >= limit_at:
+			break
+		if is_name(k, 'order') and is_name(top[i+1], 'by'):
+			order_at = i
+			break
+
+	if order_at is None and limit_at is None:
+		return query, None, None
+
+	rest = query[:at(tokens[top[order_at]] if order_at is not None else tokens[limit_at])].rstrip()
+
+	order_by = None
+	if order_at is not None:
+		end = at(tokens[limit_at]) if limit_at is not None else len(query)
+		expr = query[at(tokens[top[order_at+1]]) + 2:end].strip()
+		desc = False
+		words = expr.rsplit(None, 1)
+		if len(words) == 2 and words[1].lower() in ['asc', 'desc']:
+			expr, desc = words[0], words[1].lower() == 'desc'
+		if not expr:
+			raise Exception('Syntax error: expected an expression after ORDER BY')
+		order_by = (expr, desc)
+
+	return rest, order_by, limit
+
 def parse(query):
 	""" 
 	    Parse query of the form:
 
 	    ra, dec, u , g, r, sdss.u, sdss.r, tmass.*, func(ra,dec) as xx WHERE (expr)
+
+	    The GROUP BY, ORDER BY and LIMIT clauses, if any, are
+	    ignored (see parse_group_by and parse_order_limit).
 	"""
+	query, _, _ = parse_order_limit(query)
+	query, _ = parse_group_by(query)
+
 	g = tokenize.generate_tokens(StringIO.StringIO(query).readline)
 	where_clause = 'True'
 	select_clause = []
@@ -231,6 +382,169 @@ def parse(query):
 
 	return (select_clause, where_clause, from_clause, into_clause)
 
+def referenced_names(expr):
+	""" Return the set of identifiers (NAME tokens) found in the
+	    expression expr. Dotted names (e.g., sdss.ra) are returned
+	    as separate identifiers ('sdss' and 'ra').
+	"""
+	names = set()
+	g = tokenize.generate_tokens(StringIO.StringIO(expr).readline)
+	for (id, token, _, _, _) in g:
+		if id == tokenize.NAME:
+			names.add(token)
+	return names
+
+def free_names(expr):
+	""" Return the set of variable names loaded by the Python
+	    expression expr (unlike referenced_names, this excludes
+	    attribute names and keywords; e.g., for 'sdss.ra > x' it
+	    returns 'sdss' and 'x').
+	"""
+	return set( node.id for node in ast.walk(ast.parse(expr.strip(), mode='eval'))
+			if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) )
+
+_cmp_ops  = frozenset(['<', '<=', '>', '>=', '=='])
+_flip_ops = { '<': '>', '<=': '>=', '>': '<', '>=': '<=', '==': '==' }
+
+def _split_toplevel(tokens, seps):
+	# Split a list of (type, token) tuples on any of the tokens in
+	# seps, appearing outside of parenthesis. Return the list of
+	# parts.
+	parts, cur, depth = [], [], 0
+	for tok in tokens:
+		if tok[1] in ['(', '[']:
+			depth += 1
+		elif tok[1] in [')', ']']:
+			depth -= 1
+		elif depth == 0 and tok[1].lower() in seps:
+			parts.append(cur)
+			cur = []
+			continue
+		cur.append(tok)
+	parts.append(cur)
+	return parts
+
+def _strip_parens(tokens):
+	# Remove the parenthesis enclosing the entire expression, if any.
+	# Return (tokens, stripped)
+	stripped = False
+	while len(tokens) >= 2 and tokens[0][1] == '(' and tokens[-1][1] == ')':
+		depth = 0
+		for i, tok in enumerate(tokens):
+			if tok[1] == '(': depth += 1
+			elif tok[1] == ')': depth -= 1
+			if depth == 0:
+				break
+		if i != len(tokens) - 1:
+			break			# e.g.: (a) & (b)
+		tokens = tokens[1:-1]
+		stripped = True
+	return tokens, stripped
+
+def _comparison_operands(tokens):
+	# Parse a chain of comparisons (e.g., 'a < b.c <= 5') into a list
+	# of operands and operators. An operand is either a column
+	# ('name' or 'table.name') or a number. Return None if the
+	# expression is not of this form.
+	operands, ops = [], []
+	i, n = 0, len(tokens)
+	while i < n:
+		# Operand
+		(tt, tok) = tokens[i]
+		if tt == tokenize.NAME:
+			name = tok
+			while i + 2 < n and tokens[i+1][1] == '.' and tokens[i+2][0] == tokenize.NAME:
+				name += '.' + tokens[i+2][1]
+				i += 2
+			operands.append(('col', name))
+		else:
+			sign = 1
+			if tok in ['-', '+'] and i + 1 < n:
+				sign = -1 if tok == '-' else 1
+				i += 1
+				(tt, tok) = tokens[i]
+			if tt != tokenize.NUMBER:
+				return None
+			try:
+				val = int(tok, 0)
+			except ValueError:
+				try:
+					val = float(tok)
+				except ValueError:
+					return None
+			operands.append(('num', sign*val))
+		i += 1
+
+		# Operator or end
+		if i == n:
+			break
+		if tokens[i][1] not in _cmp_ops or i + 1 == n:
+			return None
+		ops.append(tokens[i][1])
+		i += 1
+
+	return operands, ops
+
+def simple_comparisons(expr):
+	""" Extract simple comparison predicates from a WHERE clause.
+
+	    Finds the terms of expr that are ANDed together (with 'and',
+	    or '&' if the terms are parenthesized) and are comparisons of
+	    a column to a numeric constant, e.g.:
+
+	        (mjd_obs > 56000) & (psf_mag < 18) & (0 < ra < 10)
+
+	    Returns a list of (column, op, value) tuples, with op one of
+	    <, <=, >, >=, == (with the column always on the left hand
+	    side). For every row satisfying expr, all of the returned
+	    predicates will be true (the reverse does not hold -- terms
+	    that are not simple comparisons are ignored). Returns an
+	    empty list if no such predicates can be extracted (e.g., if
+	    the clause contains an 'or' at the top level).
+	"""
+	try:
+		g = tokenize.generate_tokens(StringIO.StringIO(expr).readline)
+		tokens = [ (tt, tok) for (tt, tok, _, _, _) in g if tt not in [tokenize.ENDMARKER, tokenize.NEWLINE, tokenize.NL] ]
+	except tokenize.TokenError:
+		return []
+
+	preds = []
+	def _collect(tokens):
+		tokens, _ = _strip_parens(tokens)
+
+		# 'and' binds weaker than comparisons; '&' binds stronger, so
+		# &-ed terms are comparisons only if they're parenthesized.
+		parts = _split_toplevel(tokens, ['or', '|'])
+		if len(parts) != 1:
+			return
+		parts = _split_toplevel(tokens, ['and'])
+		if len(parts) == 1:
+			parts = _split_toplevel(tokens, ['&'])
+			if len(parts) != 1:
+				for part in parts:
+					part, stripped = _strip_parens(part)
+					if stripped:
+						_collect(part)
+				return
+		else:
+			for part in parts:
+				_collect(part)
+			return
+
+		# A single term
+		ret = _comparison_operands(tokens)
+		if ret is None:
+			return
+		operands, ops = ret
+		for (a, op, b) in zip(operands[:-1], ops, operands[1:]):
+			if a[0] == 'col' and b[0] == 'num':
+				preds.append((a[1], op, b[1]))
+			elif a[0] == 'num' and b[0] == 'col':
+				preds.append((b[1], _flip_ops[op], a[1]))
+
+	_collect(tokens)
+	return preds
+
 def resolve_wildcards(select_clause, tablecols):
 	# Resolve all .* columns, given a dict-like variable
 	# tablecols that should return a list of columns
@@ -260,6 +574,66 @@ def resolve_wildcards(select_clause, tablecols):
 			ret.append((ascol, col))
 	return ret
 
+############ Unit tests
+
+class Test_parse_order_limit:
+	def check(self, query, rest, order_by, limit):
+		assert parse_order_limit(query) == (rest, order_by, limit), parse_order_limit(query)
+
+	def check_error(self, query):
+		try:
+			parse_order_limit(query)
+		except Exception as e:
+			assert 'Syntax error' in str(e)
+		else:
+			assert False, 'Syntax error not detected in: ' + query
+
+	def test_clauses(self):
+		""" ORDER BY and LIMIT clauses """
+		self.check("ra, dec FROM sdss WHERE r < 20 ORDER BY r - i DESC LIMIT 10", "ra, dec FROM sdss WHERE r < 20", ("r - i", True), 10)
+		self.check("ra, dec FROM sdss ORDER BY f(r, i)", "ra, dec FROM sdss", ("f(r, i)", False), None)
+		self.check("ra, dec FROM sdss limit 5", "ra, dec FROM sdss", None, 5)
+		self.check("ra, dec FROM sdss WHERE r < 20", "ra, dec FROM sdss WHERE r < 20", None, None)
+
+	def test_limit_column(self):
+		""" Columns (or variables) named 'limit' and 'order' """
+		self.check("ra, limit FROM sdss WHERE limit > 3", "ra, limit FROM sdss WHERE limit > 3", None, None)
+		self.check("ra FROM sdss WHERE ra < limit", "ra FROM sdss WHERE ra < limit", None, None)
+		self.check("limit, order FROM sdss WHERE order > 1 ORDER BY limit", "limit, order FROM sdss WHERE order > 1", ("limit", False), None)
+		self.check("limit FROM sdss WHERE limit < 5 ORDER BY limit LIMIT 3", "limit FROM sdss WHERE limit < 5", ("limit", False), 3)
+		self.check("f(limit, 2) as limit FROM sdss LIMIT 2", "f(limit, 2) as limit FROM sdss", None, 2)
+
+		select, where, _, _ = parse("ra, limit FROM sdss WHERE limit > 3 LIMIT 10")
+		assert select == [ ([], 'ra'), ([], 'limit') ] and where == 'limit>3', (select, where)
+
+	def test_errors(self):
+		""" Misplaced or malformed LIMIT clauses """
+		self.check_error("ra FROM sdss LIMIT 10 WHERE ra < 3")
+		self.check_error("ra FROM sdss LIMIT 1.5")
+		self.check_error("ra FROM sdss ORDER BY LIMIT 1")
+
+class Test_parse_group_by:
+	def check_error(self, query):
+		try:
+			parse_group_by(query)
+		except Exception as e:
+			assert 'Syntax error' in str(e)
+		else:
+			assert False, 'Syntax error not detected in: ' + query
+
+	def test_clause(self):
+		""" GROUP BY clauses, and columns named 'group' """
+		assert parse_group_by("k, count() FROM t WHERE x > 1 GROUP BY k, f(a, b)") == ("k, count() FROM t WHERE x > 1", ['k', 'f(a, b)'])
+		assert parse_group_by("k FROM t group by k") == ("k FROM t", ['k'])
+		assert parse_group_by("group FROM t WHERE x > group") == ("group FROM t WHERE x > group", None)
+		assert parse_group_by("a FROM t") == ("a FROM t", None)
+
+	def test_errors(self):
+		""" Incomplete GROUP BY clauses """
+		self.check_error("k FROM t GROUP")
+		self.check_error("k FROM t GROUP BY")
+		self.check_error("k FROM t GROUP BY k,")
+
 if __name__ == '__main__':
 	class VerboseDict:
 		def __getitem__(self, key):
@@ -2,7 +2,7 @@ try:
 	import astropy.io.fits as pyfits
 except ImportError:
 	import pyfits
-import pool2
+import ingest
 import numpy as np
 import astropy.coordinates
 from itertools import izip
@@ -89,8 +89,7 @@ def import_from_sweeps(db, sdss_tabname, sweep_files, create=False, all=False):
 
 	t0 = time.time()
 	at = 0; ntot = 0
-	pool = pool2.Pool()
-	for (file, nloaded, nin) in pool.imap_unordered(sweep_files, import_from_sweeps_aux, (db, sdss_tabname, all), progress_callback=pool2.progress_pass):
+	for (file, nloaded, nin) in ingest.import_parsed(db, sweep_files, (import_from_sweeps_aux, sdss_tabname, all)):
 		at = at + 1
 		ntot = ntot + nloaded
 		t1 = time.time()
@@ -98,12 +97,10 @@ def import_from_sweeps(db, sdss_tabname, sweep_files, create=False, all=False):
 		time_tot = time_pass / at * len(sweep_files)
 		sfile = "..." + file[-67:] if len(file) > 70 else file
 		print('  ===> Imported %-70s [%d/%d, %5.2f%%] +%-6d %9d (%.0f/%.0f min.)' % (sfile, at, len(sweep_files), 100 * float(at) / len(sweep_files), nloaded, ntot, time_pass, time_tot))
-	del pool
 
-def import_from_sweeps_aux(file, db, tabname, all=False):
-	# import an SDSS run
+def import_from_sweeps_aux(file, tabname, all=False):
+	# parse an SDSS run (see lsd.ingest)
 	dat   = pyfits.getdata(file, 1)
-	table = db.table(tabname)
 
 	if not all:
 		F1 = F1_BRIGHT | F1_SATURATED | F1_NODEBLEND | F1_EDGE;	# these must not be set for an object to qualify
@@ -143,8 +140,6 @@ def import_from_sweeps_aux(file, db, tabname, all=False):
 		cols['l'] = coords.l.value
 		cols['b'] = coords.b.value
 
-		ids = table.append(cols)
-	else:
-		ids = []
+		yield (tabname, cols)
 
-	yield (file, len(ids), len(ok))
+	yield (None, (file, ok.sum(), len(ok)))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Delta segments of tablets
+
+A transaction writing to a cell whose tablets are stored in an older
+snapshot doesn't copy them into the new snapshot. Instead, it creates
+delta tablets there, holding only the rows it adds or updates. The
+tablets of the cell in the consecutive snapshots are the segments of the
+tablet, and are merged on the fly when read (see Table.fetch_tablet).
+
+A delta tablet is an ordinary tablet, whose root has the DELTA_BASE
+attribute set to the snapshot ID of the segment preceding it. Each of
+its row groups ('main', 'cached') is either:
+
+    - absent, if the group is unchanged from the preceding segments,
+    - a patch of the merged group of the preceding segments. Its
+      '_rowidx' array holds the position of each of its rows in the
+      merged group; rows positioned past the end of the preceding
+      segments are appended, the others replace existing rows. The BLOB
+      refs of rows in a patch are offset by the BLOB_BASE attribute of
+      the BLOB VLArrays, to keep them unique within the merged group.
+    - a replacement (DELTA_REPLACE attribute set), holding the complete
+      group (e.g., a neighbor cache dropped and rewritten in the
+      snapshot).
+
+Long chains of deltas are folded back into full tablets by `lsd-admin
+compact` (see Table.compact_cell).
+"""
+
+import numpy as np
+import tables
+
+def is_delta(fp):
+	""" Is the open tablet fp a delta segment """
+	return getattr(fp.root._v_attrs, 'DELTA_BASE', None) is not None
+
+def base_of(fp):
+	""" The snapshot of the segment preceding delta segment fp """
+	return fp.root._v_attrs.DELTA_BASE
+
+def mark_delta(fp, snapid):
+	""" Mark the (new, empty) tablet fp as a delta of the segment in
+	    snapshot snapid.
+	"""
+	fp.root._v_attrs.DELTA_BASE = str(snapid)
+
+def is_patch(g):
+	""" Is row group g a patch of the preceding segments """
+	return is_delta(g._v_file) and not getattr(g._v_attrs, 'DELTA_REPLACE', False)
+
+def row_groups(segs, group):
+	""" Return the nodes of row group 'group' from segments segs
+	    (oldest first) that make up the merged group, oldest first. An
+	    empty list is returned if none of the segments has the group.
+	"""
+	groups = []
+	for fp in reversed(segs):
+		g = getattr(fp.root, group, None)
+		if g is not None:
+			groups.insert(0, g)
+			if not is_patch(g):
+				break
+		elif not is_delta(fp):
+			break
+	return groups
+
+def init_patch(g, base):
+	""" Set up row group g, newly created in a delta segment, as a
+	    patch of the merged row group base.
+	"""
+	g._v_file.createEArray(g, '_rowidx', tables.UInt64Atom(), (0,))
+
+	# Continue the sequences of primary keys
+	for name, seq in g._v_children.iteritems():
+		if name.startswith('_seq_'):
+			seq[0] = getattr(base[-1], name)[0]
+
+	# Offset the BLOB refs past those of the base
+	if 'blobs' in g:
+		for name, barray in g.blobs._v_children.iteritems():
+			barray._v_attrs.BLOB_BASE = blob_count(base, name)
+
+def _patch_rows(g):
+	""" Return the (sorted) positions in the merged group of the rows
+	    of patch g, and their indices in g. If a position was written
+	    more than once, the latest row is returned.
+	"""
+	idx = g._rowidx.read().astype(np.int64)
+	pos, last = np.unique(idx[::-1], return_index=True)
+	return pos, len(idx) - 1 - last
+
+def nrows(groups):
+	""" The number of rows in the merged group """
+	if not groups:
+		return 0
+
+	n = len(groups[0].table)
+	for g in groups[1:]:
+		if len(g._rowidx):
+			n = max(n, int(g._rowidx.read().max()) + 1)
+	return n
+
+def read(groups, start=None, stop=None, field=None):
+	""" Read the rows in [start, stop) of the merged group (or only
+	    the given field).
+	"""
+	n = nrows(groups)
+	start, stop, _ = slice(start, stop).indices(n)
+	stop = max(start, stop)
+
+	t = groups[0].table
+	rows = t.read(min(start, len(t)), min(stop, len(t)), field=field)
+	if len(groups) == 1:
+		return rows
+
+	out = np.zeros((stop - start,) + rows.shape[1:], dtype=rows.dtype)
+	out[:len(rows)] = rows
+	for g in groups[1:]:
+		pos, idx = _patch_rows(g)
+		sel = (pos >= start) & (pos < stop)
+		if sel.any():
+			out[pos[sel] - start] = g.table.read(field=field)[idx[sel]]
+	return out
+
+def read_coordinates(groups, coords):
+	""" Read the rows at positions coords of the merged group """
+	t = groups[0].table
+	out = np.zeros(len(coords), dtype=t.description._v_dtype)
+
+	inbase = coords < len(t)
+	if inbase.any():
+		out[inbase] = t.readCoordinates(coords[inbase])
+
+	for g in groups[1:]:
+		pos, idx = _patch_rows(g)
+		if not len(pos):
+			continue
+		k = np.minimum(np.searchsorted(pos, coords), len(pos) - 1)
+		hit = pos[k] == coords
+		if hit.any():
+			out[hit] = g.table.readCoordinates(idx[k[hit]])
+	return out
+
+def blob_base(barray):
+	""" The offset of the refs to BLOBs in VLArray barray """
+	return getattr(barray._v_attrs, 'BLOB_BASE', 0)
+
+def blob_count(groups, column):
+	""" The number of (global) BLOB refs of a column of the merged
+	    group.
+	"""
+	barray = getattr(groups[-1].blobs, column)
+	return blob_base(barray) + len(barray)
+
+def blob_arrays(groups, column):
+	""" Return the BLOB VLArrays of a column of the merged group, and
+	    the ref offsets of each.
+	"""
+	arrays = [ getattr(g.blobs, column) for g in groups ]
+	offsets = np.array([ blob_base(barray) for barray in arrays ], dtype=np.int64)
+	return offsets, arrays
@@ -6,11 +6,13 @@ except ImportError:
 	import pyfits
 
 import pool2
+import ingest
 import time
 import numpy as np
 import astropy.coordinates
 import itertools as it
 import bhpix
+import neighbors
 from utils import gnomonic, gc_dist
 from colgroup import ColGroup
 import colgroup
@@ -335,10 +337,9 @@ def import_from_smf(db, det_tabname, exp_tabname, smf_files, survey, create=Fals
 
 	t0 = time.time()
 	at = 0; ntot = 0
-	pool = pool2.Pool()
 	smf_fns = []
 	exp_ids = []
-	for (file, exp_id, smf_fn, nloaded, nin) in pool.imap_unordered(smf_files, import_from_smf_aux, (det_table, exp_table, det_c2f, exp_c2f, survey), progress_callback=pool2.progress_pass):
+	for (file, exp_id, smf_fn, nloaded, nin) in ingest.import_parsed(db, smf_files, (import_from_smf_aux, det_table, exp_table, det_c2f, exp_c2f, survey)):
 		smf_fns.append(smf_fn)
 		exp_ids.append(exp_id)
 		at = at + 1
@@ -347,7 +348,6 @@ def import_from_smf(db, det_tabname, exp_tabname, smf_files, survey, create=Fals
 		time_pass = (t1 - t0) / 60
 		time_tot = time_pass / at * len(smf_files)
 		print >>sys.stderr, '  ===> Imported %s [%d/%d, %5.2f%%] +%-6d %9d (%.0f/%.0f min.)' % (file, at, len(smf_files), 100 * float(at) / len(smf_files), nloaded, ntot, time_pass, time_tot)
-	del pool
 
 	ret = colgroup.ColGroup()
 	ret._EXP   = np.array(exp_ids, dtype=np.uint64)
@@ -539,12 +539,15 @@ def import_from_smf_aux(file, det_table, exp_table, det_c2f, exp_c2f, survey):
 		at = at + len(det_cols['exp_id'])
 	assert at == nrows
 
+	# The exposure is appended right away, as its ID is needed to
+	# fill in the detections; these are passed on to be appended by
+	# cell (see lsd.ingest)
 	(exp_id,) = exp_table.append(exp_cols)
 	det_cols_all['exp_id'][:] = exp_id
 
-	ids = det_table.append(det_cols_all)
+	yield (det_table.name, det_cols_all)
 
-	yield (file, exp_id, fn, len(ids), len(ids))
+	yield (None, (file, exp_id, fn, nrows, nrows))
 
 #########
 
@@ -872,13 +875,13 @@ def _obj_det_match(cells, db, obj_tabname, det_tabname, o2d_tabname, radius, exp
 	   - fetch all existing static sky objects, including the cached ones (*)
 	   - project them to tangent plane around the center of the cell
 	     (we assume the cell is small enough for the distortions not to matter)
-	   - construct a kD tree in (x, y) tangent space
+	   - index them in (x, y) tangent space (see neighbors.py)
 	   - for each temporal cell, in sorted order (++):
 	   	1.) Fetch the detections, including the cached ones (+)
 	   	2.) Project to tangent plane
 
 	   	3.) for each exposure, in sorted order (++):
-		    a.) Match agains the kD tree of objects
+		    a.) Match against the index of objects
 		    b.) Add those that didn't match to the list of objects 
 
 		4.) For newly added objects: store to disk only those that
@@ -918,8 +921,6 @@ def _obj_det_match(cells, db, obj_tabname, det_tabname, o2d_tabname, radius, exp
 	   	Implement a consistency check to verify that.
 	"""
 
-	from scikits.ann import kdtree
-
 	# Input is a tuple of obj_cell, and det_cells falling under that obj_cell
 	obj_cell, det_cells = cells
 	det_cells.sort()
@@ -939,7 +940,8 @@ def _obj_det_match(cells, db, obj_tabname, det_tabname, o2d_tabname, radius, exp
 	objs  = db.query('_ID, _LON, _LAT FROM %s' % obj_tabname).fetch_cell(obj_cell, include_cached=True)
 	xyobj = np.column_stack(gnomonic(objs['_LON'], objs['_LAT'], clon, clat))
 	nobj  = len(objs)	# Total number of static sky objects
-	tree  = None
+	search = None
+	nn_backend = neighbors.get_backend()	# See LSD_NN_BACKEND
 	nobj_old = 0
 
 	# for sanity checks/debugging (see below)
@@ -1000,22 +1002,25 @@ def _obj_det_match(cells, db, obj_tabname, det_tabname, o2d_tabname, radius, exp
 			ndet = len(xydet)
 
 			if len(xyobj) != 0:
-				# Construct kD-tree and find the object nearest to each
-				# detection from this cell
-				if tree is None or nobj_old != len(xyobj):
-					del tree
+				# Index the objects and find the object nearest to each
+				# detection from this cell, searching only within the
+				# match radius (see neighbors.xmatch)
+				if search is None or nobj_old != len(xyobj):
+					del search
 					nobj_old = len(xyobj)
-					tree = kdtree(xyobj)
-				match_idx, match_d2 = tree.knn(xydet, 1)
-				match_idx = match_idx[:,0]		# First neighbor only
+					search = nn_backend(xyobj[:,0], xyobj[:,1], clon, clat)
+				i, j, d, _ = neighbors.xmatch(search, ra2, dec2, objs['_LON'], objs['_LAT'], 1, radius)
 
 				####
 				#if np.uint64(13828114484734072082) in id2:
 				#	np.savetxt('bla.%d.static=%d.txt' % (det_cell, pix.static_cell_for_cell(det_cell)), objs.as_ndarray(), fmt='%s')
 
-				# Compute accurate distances, and select detections not matched to existing objects
-				dist       = gc_dist(objs['_LON'][match_idx], objs['_LAT'][match_idx], ra2, dec2)
-				unmatched  = dist >= radius
+				# Detections with no object within the radius are not
+				# matched to existing objects
+				match_idx  = np.empty(ndet, dtype='i4')
+				dist       = np.zeros(ndet)
+				unmatched  = np.ones(ndet, dtype=bool)
+				match_idx[i], dist[i], unmatched[i] = j, d, False
 			else:
 				# All detections will become new objects (and therefore, dist=0)
 				dist       = np.zeros(ndet, dtype='f4')
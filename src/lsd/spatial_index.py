@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Per-cell spatial indices, for crossmatching (see neighbors.py)
+
+The objects of a cell (including those in its neighbor cache) are
+projected to the tangent plane at the center of the cell, binned onto a
+square grid, and stored sorted by grid bin. A lookup of the neighbors of
+a point then reduces to a binary search for the few bins around it.
+
+The indices are built at commit time (see
+tasks.commit_hook__build_spatial_index), and stored next to the tablets
+of the cell, as a small header followed by the (bin, x, y, row) columns,
+that are memory-mapped when loaded. Crossmatches against cells with no
+stored index (e.g., of tables committed before these were introduced)
+build one on the fly (see index_for_cell).
+"""
+
+import os
+import struct
+import numpy as np
+import bhpix
+from utils import gnomonic
+
+# File header: magic (format version), center of projection (clon,
+# clat), bin size (all in degrees), number of entries (the rows of the
+# cell indexed), and the snapshot the index was built in
+_magic = 'LSDXYIX2'
+_header = struct.Struct('<8sdddq32s')
+_header_size = 128
+_columns = [('key', '<i8'), ('x', '<f8'), ('y', '<f8'), ('row', '<u4')]
+
+# Lookups that would need to search more than (2*max_reach+1)^2 bins
+# around each point use a coarser, temporary, grid instead
+max_reach = 3
+
+def _bin_keys(x, y, binsize):
+	# The (sortable) key of the grid bin of each (x, y) point
+	bx = np.floor(x / binsize).astype(np.int64)
+	by = np.floor(y / binsize).astype(np.int64)
+	return _pack(bx, by)
+
+def _pack(bx, by):
+	return (by << 32) + (bx + 2**31)
+
+class GridIndex(object):
+	""" A grid index of points on the tangent plane centered at
+	    (clon, clat).
+	"""
+	clon = clat = None	# Center of the projection (degrees)
+	binsize = None		# Size of the bins of the grid (degrees, in the tangent plane)
+	key = None		# Bins of the points (see _bin_keys), sorted
+	x = y = None		# Coordinates of the points in the tangent plane
+	row = None		# Rows of the points in the cell
+	snapid = None		# The snapshot of the indexed cell (if stored)
+
+	def __init__(self, cols, clon, clat, binsize, snapid=None):
+		self.key, self.x, self.y, self.row = cols
+		self.clon, self.clat, self.binsize = clon, clat, binsize
+		self.snapid = snapid
+
+	def __len__(self):
+		return len(self.key)
+
+	@staticmethod
+	def from_xy(x, y, rows, clon, clat, binsize=None):
+		""" Index the points (x, y), projected around (clon, clat).
+		    If not given, the bin size is chosen to put about two
+		    points into each bin.
+		"""
+		if binsize is None:
+			if len(x) > 1:
+				area = (x.max() - x.min()) * (y.max() - y.min())
+				binsize = max(np.sqrt(2. * area / len(x)), 1e-5)
+			else:
+				binsize = 1.
+
+		key = _bin_keys(x, y, binsize)
+		order = np.argsort(key, kind='mergesort')
+		cols = [ np.asarray(col)[order].astype(dtype) for (col, (_, dtype)) in zip([key, x, y, rows], _columns) ]
+
+		return GridIndex(cols, clon, clat, binsize)
+
+	@staticmethod
+	def build(lon, lat, clon, clat):
+		""" Index the points (lon, lat), in the tangent plane at
+		    (clon, clat).
+		"""
+		x, y = gnomonic(lon, lat, clon, clat)
+		return GridIndex.from_xy(x, y, np.arange(len(lon)), clon, clat)
+
+	@staticmethod
+	def load(fn):
+		""" Memory-map the index stored in file fn. Returns None if
+		    it's of an unknown format.
+		"""
+		with open(fn, 'rb') as fp:
+			hdr = fp.read(_header_size)
+		if len(hdr) != _header_size:
+			return None
+		magic, clon, clat, binsize, n, snapid = _header.unpack(hdr[:_header.size])
+		if magic != _magic:
+			return None
+
+		cols, offset = [], _header_size
+		for (_, dtype) in _columns:
+			if n:
+				cols.append(np.memmap(fn, dtype=dtype, mode='r', offset=offset, shape=(n,)))
+			else:
+				cols.append(np.empty(0, dtype=dtype))
+			offset += n * np.dtype(dtype).itemsize
+		return GridIndex(cols, clon, clat, binsize, snapid.rstrip('\0'))
+
+	def save(self, fn, snapid):
+		""" Store the index of a cell of snapshot snapid into file fn """
+		self.snapid = str(snapid)
+		assert len(self.snapid) <= 32
+
+		tmp = fn + '.tmp'
+		with open(tmp, 'wb') as fp:
+			hdr = _header.pack(_magic, self.clon, self.clat, self.binsize, len(self), self.snapid)
+			fp.write(hdr.ljust(_header_size, '\0'))
+			for col in [self.key, self.x, self.y, self.row]:
+				col.tofile(fp)
+		os.rename(tmp, fn)
+
+	def candidates(self, x, y, r):
+		""" Find the indexed points within distance r of points
+		    (x, y) (in the tangent plane). Returns a tuple of arrays
+		    (i, rows, d), where i are the indices into x, y, rows
+		    the rows of the indexed points, and d their distances.
+		"""
+		reach = int(np.ceil(r / self.binsize))
+		if reach > max_reach:
+			# Too many bins to search; regrid to bins of size r
+			return GridIndex.from_xy(self.x, self.y, self.row, self.clon, self.clat, binsize=r).candidates(x, y, r)
+
+		# Look the points up in the order of their bins, for
+		# locality of the searches
+		bx = np.floor(x / self.binsize).astype(np.int64)
+		by = np.floor(y / self.binsize).astype(np.int64)
+		qidx = np.argsort(_pack(bx, by))
+		bx, by = bx[qidx], by[qidx]
+
+		ii, jj = [], []
+		for dy in xrange(-reach, reach+1):
+			# Bins (bx-reach .. bx+reach, by+dy) are adjacent in the
+			# order of keys, so their entries are a single range
+			lo = np.searchsorted(self.key, _pack(bx - reach, by + dy), 'left')
+			cnt = np.searchsorted(self.key, _pack(bx + reach, by + dy), 'right') - lo
+			has = cnt > 0
+			if not has.any():
+				continue
+			lo, cnt = lo[has], cnt[has]
+
+			# Expand to (point, entry) pairs
+			i = np.repeat(qidx[has], cnt)
+			j = np.repeat(lo - np.cumsum(cnt) + cnt, cnt) + np.arange(len(i))
+			ii.append(i)
+			jj.append(j)
+
+		if not ii:
+			return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+		i, j = np.concatenate(ii), np.concatenate(jj)
+
+		d = np.hypot(self.x[j] - x[i], self.y[j] - y[i])
+		near = d <= r
+		return i[near], self.row[j[near]].astype(np.int64), d[near]
+
+def index_path(table, cell_id, mode='r'):
+	""" The path to the stored index of a cell """
+	return '%s/%s.xyindex' % (table._cell_path(cell_id, mode), table.name)
+
+def cell_center(pix, cell_id):
+	""" The center of the projection of the cell's index """
+	bounds, _ = pix.cell_bounds(cell_id)
+	return bhpix.deproj_bhealpix(*bounds.center())
+
+def index_for_cell(table, cell_id, lon, lat):
+	""" Return the index of the points (lon, lat), being the
+	    spatial keys of all rows (including the neighbor cache) of
+	    a cell of table. The stored index is used if it exists, and
+	    was built from the same snapshot and number of rows of the
+	    cell, otherwise one is built.
+	"""
+	try:
+		fn = index_path(table, cell_id)
+		snapid = str(table.catalog.snapshot_of_cell(cell_id))
+	except LookupError:
+		fn = None
+
+	index = None
+	if fn is not None and os.path.exists(fn):
+		index = GridIndex.load(fn)
+		if index is not None and (index.snapid != snapid or len(index) != len(lon)):
+			index = None
+	if index is None:
+		clon, clat = cell_center(table.pix, cell_id)
+		index = GridIndex.build(lon, lat, clon, clat)
+
+	return index
+
+###################################################################
+## Unit tests
+
+class Test_GridIndex:
+	def setUp(self):
+		np.random.seed(7)
+		self.lon2 = np.random.uniform(10, 11, 3000)
+		self.lat2 = np.random.uniform(40, 41, 3000)
+		self.lon1 = np.random.uniform(10, 11, 500)
+		self.lat1 = np.random.uniform(40, 41, 500)
+
+	def check(self, index, r):
+		x1, y1 = gnomonic(self.lon1, self.lat1, index.clon, index.clat)
+		x2, y2 = gnomonic(self.lon2, self.lat2, index.clon, index.clat)
+		d = np.hypot(x1[:, None] - x2[None, :], y1[:, None] - y2[None, :])
+		i, j, dist = index.candidates(x1, y1, r)
+		assert set(zip(i, j)) == set(zip(*np.nonzero(d <= r)))
+		assert np.allclose(dist, d[i, j])
+
+	def test_candidates(self):
+		""" Fixed radius lookups in a grid index """
+		index = GridIndex.build(self.lon2, self.lat2, 10.5, 40.5)
+		self.check(index, 30/3600.)
+		self.check(index, 60/3600.)
+		self.check(index, 0.1)		# Regridded
+
+	def test_save_load(self):
+		""" Storing and memory-mapping a grid index """
+		import tempfile, shutil
+		tmpdir = tempfile.mkdtemp()
+		try:
+			fn = os.path.join(tmpdir, 'test.xyindex')
+			GridIndex.build(self.lon2, self.lat2, 10.5, 40.5).save(fn, '20110101000000.000000')
+			index = GridIndex.load(fn)
+			assert isinstance(index.x, np.memmap) and len(index) == len(self.lon2)
+			assert index.snapid == '20110101000000.000000'
+			self.check(index, 40/3600.)
+
+			GridIndex.build(self.lon2[:0], self.lat2[:0], 10.5, 40.5).save(fn, 0)
+			index = GridIndex.load(fn)
+			assert len(index) == 0 and index.snapid == '0'
+		finally:
+			shutil.rmtree(tmpdir)
@@ -17,7 +17,13 @@ import copy
 import glob
 import shutil
 import errno
-from table_catalog import TableCatalog
+import time
+import threading
+import resource
+import socket
+import pool2
+import segments
+from table_catalog import TableCatalog, zonemap_for_rows
 from utils        import is_scalar_of_type
 from pixelization import Pixelization
 from collections  import OrderedDict
@@ -26,6 +32,88 @@ from colgroup     import ColGroup
 
 logger = logging.getLogger("lsd.table")
 
+#: Tablet prefetch policies (see Table.set_prefetch_policy())
+PREFETCH_POLICIES = ('none', 'whole', 'fadvise', 'next')
+
+#: I/O counters kept by each Table instance (see Table.io_stats())
+IOSTATS_KEYS = ('tablets_opened', 'open_time', 'prefetch_bytes', 'prefetch_time', 'bg_prefetch_bytes', 'bg_prefetch_time')
+
+_iostats_lock = threading.Lock()	# Guards Table._iostats (updated from background prefetch threads)
+
+#: Comparison operators of row cuts (see Table.fetch_tablet())
+CUT_OPS = { '<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal, '==': np.equal }
+
+#: Entries of the transaction journal (see Table._journal_cell()): the
+#: cell, the sequence number of the write to the cell, and the numbers
+#: of rows in the main group and the neighbor cache of its primary tablet
+#: after the write (-1 if the group wasn't written)
+JOURNAL_DTYPE = [('cell_id', '<u8'), ('seq', '<u8'), ('main', '<i8'), ('cached', '<i8')]
+
+#: The latest writes to the main groups of cells whose zone maps have been
+#: computed in the transaction (see Table._update_zonemaps())
+ZONEMAPPED_DTYPE = [('cell_id', '<u8'), ('seq', '<u8')]
+
+def _read_whole_file(fn, bufsize=2**20):
+	""" Read the file fn end to end (to bring it into the page cache).
+	    Returns the number of bytes read.
+	"""
+	n = 0
+	with open(fn, 'rb') as f:
+		for buf in iter(lambda: f.read(bufsize), ''):
+			n += len(buf)
+	return n
+
+def _background_prefetch(table, fns):
+	""" Thread body for Table.prefetch_cell() """
+	for fn in fns:
+		t0 = time.time()
+		try:
+			n = _read_whole_file(fn)
+		except IOError:
+			continue
+		table._count_io(bg_prefetch_bytes=n, bg_prefetch_time=time.time() - t0)
+
+def _zonemap_kernel(cell_id, table):
+	""" Compute the zone map of a cell (see Table._update_zonemaps) """
+	zmap = dict()
+	for cgroup, schema in table._cgroups.iteritems():
+		if table._is_pseudotablet(cgroup) or not table.tablet_exists(cell_id, cgroup):
+			continue
+
+		blobs = schema.get('blobs', {})
+		columns = [ name for (name, _) in schema['columns'] if name not in blobs ]
+		with table.lock_cell(cell_id) as cell:
+			with cell.open_segments(cgroup) as segs:
+				zmap.update(zonemap_for_rows(segments.read(segments.row_groups(segs, 'main')), columns))
+
+	yield cell_id, zmap
+
+def _nrows_kernel(cell_id, table):
+	""" Count the rows of a cell, and of its neighbor cache (see
+	    Table._count_unknown_rows)
+	"""
+	with table.lock_cell(cell_id) as cell:
+		with cell.open_segments(table.primary_cgroup) as segs:
+			nmain, ncached = [ segments.nrows(segments.row_groups(segs, group)) for group in ['main', 'cached'] ]
+
+	yield cell_id, nmain, ncached
+
+def _io_bytes():
+	# Bytes read from and written to disk by this process and
+	# its (terminated) children
+	ru1, ru2 = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+	return 512 * (ru1.ru_inblock + ru2.ru_inblock), 512 * (ru1.ru_oublock + ru2.ru_oublock)
+
+@contextmanager
+def _timed_commit_step(stats, step):
+	# Record the wall time and I/O of a step of Table.commit0. The
+	# I/O of pool workers is counted once they exit (DB.commit runs
+	# the hooks with the persistent pool disabled for that reason).
+	t0, (r0, w0) = time.time(), _io_bytes()
+	yield
+	r1, w1 = _io_bytes()
+	stats.append((step, time.time() - t0, r1 - r0, w1 - w0))
+
 class BLOBAtom(tables.ObjectAtom):
 	"""
 	A PyTables atom representing BLOBs
@@ -87,9 +175,12 @@ class Table:
 	_snapshots     = [ 0 ]  #: Sorted (newest to oldest) list of available, committed, snapshots
 	transaction    = False  #: True if we're in a transaction (the current snapshot is writable)
 
-	_default_commit_hooks = [('Updating neighbors', 0, 'lsd.tasks', 'build_neighbor_cache')] #: Default commit hook rebuilds the neighbor cache
+	_default_commit_hooks = [('Updating neighbors', 0, 'lsd.tasks', 'build_neighbor_cache'), ('Building spatial index', 5, 'lsd.tasks', 'build_spatial_index')] #: Default commit hooks rebuild the neighbor cache and the spatial index
 	remote = None
 
+	prefetch       = None	#: Tablet prefetch policy (one of PREFETCH_POLICIES, or None to use $LSD_PREFETCH, defaulting to 'fadvise')
+	_iostats       = None	#: Per-table I/O counters (see io_stats())
+
 	### Transaction/Snapshotting support
 	def set_snapshot(self, snapid):
 	        """ Load the list of committed snapshots <= than snapid
@@ -116,12 +207,20 @@ class Table:
 			for snapid in snapids:
 				local = self._snapshot_path(snapid) + '/'
 				utils.mkdir_p(local)
-				for fn in ['catalog.pkl', 'schema.cfg', '.committed']:
+				for fn in ['catalog.bin', 'schema.cfg', '.committed']:
 					if str(snapid) == "0" and fn == '.committed':	# Backwards compatibility
 						continue
 					local_fn = local + fn
+					if fn == 'catalog.bin' and os.path.exists(local + 'catalog.pkl'):
+						continue
 					if not os.path.exists(local_fn):
-						self.fetch_from_remote(local_fn)
+						try:
+							self.fetch_from_remote(local_fn)
+						except IOError:
+							# Snapshots committed before the binary catalogs were introduced
+							if fn != 'catalog.bin':
+								raise
+							self.fetch_from_remote(local + 'catalog.pkl')
 
 		self._snapshots = self.list_snapshots(self.snapid)
 		# Sorted list of snapshots, newest first
@@ -140,9 +239,12 @@ class Table:
         def _load_catalog(self):
 		# Load the tablet cache.
 		#
-		tabtreepkl = self._find_metadata_path('catalog.pkl')
-		if os.path.isfile(tabtreepkl):
-			self.catalog = TableCatalog(fn=tabtreepkl)
+		catfn = self._find_metadata_path('catalog.bin')
+		if not os.path.isfile(catfn):
+			# Snapshots committed before the binary catalogs were introduced
+			catfn = self._find_metadata_path('catalog.pkl')
+		if os.path.isfile(catfn):
+			self.catalog = TableCatalog(fn=catfn)
 		elif os.path.isdir(os.path.join(self.path, 'tablets')) and not os.path.isdir(os.path.join(self.path, 'tablets', 'snapshots')):
 			# Backwards compatibility: Auto-create it for old-style (pre v0.4) tables
 		        assert self._snapshots[0] == 0
@@ -167,14 +269,153 @@ class Table:
 			# Initialize an empty catalog
 			snapid = 0
 
-		# Update to the requested snapshot
-		pattern = self._tablet_filename(self.primary_cgroup)
-		self.catalog.update(self.path, pattern, snapid)
+		# Update to the requested snapshot. Old tables are scanned,
+		# otherwise the cells written in this snapshot are merged
+		# into the catalog, as recorded in the transaction journal
+		if rebuild_pre_v050_snap:
+			pattern = self._tablet_filename(self.primary_cgroup)
+			self.catalog.update(self.path, pattern, snapid)
+		else:
+			self.catalog.add_tablets(snapid, *self._read_journal(snapid))
+		self._count_unknown_rows()
+		self._update_zonemaps(snapid, rescan=rebuild_pre_v050_snap)
 
 		# Save
-		fn = os.path.join(self._snapshot_path(snapid), 'catalog.pkl')
+		fn = os.path.join(self._snapshot_path(snapid), 'catalog.bin')
 		self.catalog.save(fn)
 
+	def _journal_path(self, snapid):
+		""" The directory with the journal of the transaction
+		    writing snapshot snapid.
+		"""
+		return os.path.join(self._snapshot_path(snapid), '.journal')
+
+	def _journal_cell(self, cell_id, main=-1, cached=-1):
+		"""
+		Record in the journal of the transaction that the primary
+		tablet of cell_id has been written, with main and cached
+		being the numbers of rows in its main group and its
+		neighbor cache (-1 if unchanged).
+
+		Every process appends to its own journal file, and must
+		hold the lock of the cell. The writes to a cell are
+		numbered in the order they were made in (unlike wall-clock
+		times, which may go backwards, or differ between hosts),
+		by a per-cell counter advanced under the lock.
+		"""
+		path = self._journal_path(self.snapid)
+		utils.mkdir_p('%s/.seq' % path)
+
+		# Advance the sequence of writes to the cell
+		seqfn = '%s/.seq/%d' % (path, cell_id)
+		try:
+			with open(seqfn) as fp:
+				seq = int(fp.read()) + 1
+		except IOError as e:
+			if e.errno != errno.ENOENT:
+				raise
+			seq = 0
+		with open(seqfn, 'w') as fp:
+			fp.write('%d' % seq)
+
+		entry = np.array([(cell_id, seq, main, cached)], dtype=JOURNAL_DTYPE)
+		with open('%s/%s.%d' % (path, socket.gethostname(), os.getpid()), 'ab') as fp:
+			fp.write(entry.tostring())
+
+	def _journal_entries(self, snapid, group=None):
+		"""
+		Return the entries of the journal of the transaction writing
+		snapshot snapid. If group is given, return only the latest
+		entry of each cell that wrote that group, sorted by cell_id.
+		"""
+		fns = glob.glob('%s/*' % self._journal_path(snapid))
+		entries = np.concatenate([ np.fromfile(fn, dtype=JOURNAL_DTYPE) for fn in fns ] + [ np.empty(0, dtype=JOURNAL_DTYPE) ])
+		if group is None:
+			return entries
+
+		e = entries[entries[group] >= 0]
+		e = e[np.lexsort((e['seq'], e['cell_id']))]
+		latest = np.ones(len(e), dtype=bool)
+		latest[:-1] = e['cell_id'][1:] != e['cell_id'][:-1]
+		return e[latest]
+
+	def _read_journal(self, snapid):
+		"""
+		Return the (cell_ids, nmain, ncached) arrays of the cells
+		written in snapshot snapid, and of the numbers of rows in
+		them and in their neighbor caches, as recorded in the
+		journal of the transaction (see TableCatalog.add_tablets).
+		"""
+		cell_ids = np.unique(self._journal_entries(snapid)['cell_id'])
+
+		counts = []
+		for group in ['main', 'cached']:
+			# The latest recorded number of rows in the group
+			e = self._journal_entries(snapid, group)
+
+			n = np.empty(len(cell_ids), dtype=np.int64)
+			n[:] = -1
+			n[np.searchsorted(cell_ids, e['cell_id'])] = e[group]
+			counts.append(n)
+
+		return (cell_ids,) + tuple(counts)
+
+	def _count_unknown_rows(self):
+		"""
+		Count the rows of cells whose row counts the catalog
+		doesn't know (those committed by versions of LSD that
+		didn't keep them), and store them into the catalog.
+		"""
+		cell_ids, _, nmain, ncached = self.catalog.get_row_counts()
+		cells = cell_ids[(nmain < 0) | (ncached < 0)]
+		if not len(cells):
+			return
+
+		print >> sys.stderr, "[%s] Counting rows in %d cells:" % (self.name, len(cells)),
+		counts = []
+		with pool2.shared_pool() as pool:
+			for count in pool.imap_unordered(cells, _nrows_kernel, (self,), progress_callback=pool2.progress_pass):
+				counts.append(count)
+		self.catalog.set_nrows(*[ np.array(col) for col in zip(*counts) ])
+
+	def _update_zonemaps(self, snapid, rescan=False):
+		""" Compute the zone maps (per-column min/max/NaN count
+		    statistics) of the cells with data stored in snapshot
+		    snapid, and store them into the catalog.
+
+		    Only the cells whose main groups were written since their
+		    zone maps were last computed in this transaction (as
+		    recorded in the journal, see _journal_cell) are read,
+		    so that rebuilding the catalog after only the neighbor
+		    caches were written (see build_neighbor_cache) reads no
+		    rows. If rescan=True, all cells stored in snapid are
+		    read. Cells from older snapshots keep the zone maps
+		    computed when they were committed.
+		"""
+		cells = self.catalog.get_cells_in_snapshot(snapid, include_cached=False)
+		if not rescan:
+			# The latest writes to the main groups, and those
+			# whose zone maps have already been computed
+			e = self._journal_entries(snapid, 'main')
+			written = np.empty(len(e), dtype=ZONEMAPPED_DTYPE)
+			written['cell_id'], written['seq'] = e['cell_id'], e['seq']
+
+			fn = '%s/.zonemapped' % self._journal_path(snapid)
+			done = np.fromfile(fn, dtype=ZONEMAPPED_DTYPE) if os.path.exists(fn) else np.empty(0, dtype=ZONEMAPPED_DTYPE)
+			done = dict(zip(done['cell_id'], done['seq']))
+
+			stale = [ cell_id for (cell_id, seq) in written if done.get(cell_id) != seq ]
+			cells = cells[np.in1d(cells, np.array(stale, dtype=np.uint64))]
+
+		if len(cells):
+			with pool2.shared_pool() as pool:
+				for cell_id, zmap in pool.imap_unordered(cells, _zonemap_kernel, (self,), progress_callback=pool2.progress_pass):
+					self.catalog.set_zonemap(cell_id, zmap)
+
+		if not rescan and len(written):
+			written.tofile(fn + '.tmp')
+			os.rename(fn + '.tmp', fn)
+
 	def _check_transaction(self):
 		if not self.transaction:
 			raise Exception("Trying to modify a table without starting a transaction. This can also happen if you have multiple directories on LSD_DB path, and the table you're trying to modify is not in the first directory.")
@@ -198,13 +439,23 @@ class Table:
         		self._load_schema()
         		self._load_catalog()
 
+	def has_commit_work(self, pri):
+		""" Return True if commit0(db, pri) has anything to do """
+		return pri in (-1, 10) or any(hookdef[1] == pri for hookdef in self._commit_hooks)
+
 	def commit0(self, db, pri):
-		""" Do post-transaction housekeeping """
+		""" Do post-transaction housekeeping.
+
+		    Returns a list of (step, wall time, bytes read, bytes
+		    written) for each step (commit hook) that was run.
+		"""
+		stats = []
 		if pri == -1:
 			# Build the tablet cache (hardwired)
-			print >> sys.stderr, "[%s] Updating tablet catalog:" % (self.name),
-			self.rebuild_catalog()
-			self._snapshots.insert(0, self.snapid)
+			with _timed_commit_step(stats, "Updating tablet catalog"):
+				print >> sys.stderr, "[%s] Updating tablet catalog:" % (self.name),
+				self.rebuild_catalog()
+				self._snapshots.insert(0, self.snapid)
 
 		# Call post-commit hooks of the given priority. By default, these
 		# rebuild the neighbor cache.
@@ -213,36 +464,59 @@ class Table:
 			(msg, priority, module, func) = hookdef[:4]
 
 			if priority == pri:
-				print >>sys.stderr, "[%s] %s:" % (self.name, msg),
-				try:
-					args = hookdef[4]
-				except IndexError:
-					args = []
-				try:
-					kwargs = hookdef[5]
-				except IndexError:
-					kwargs = {}
+				with _timed_commit_step(stats, msg):
+					print >>sys.stderr, "[%s] %s:" % (self.name, msg),
+					try:
+						args = hookdef[4]
+					except IndexError:
+						args = []
+					try:
+						kwargs = hookdef[5]
+					except IndexError:
+						kwargs = {}
 
-				m = importlib.import_module(module)
-				func = "commit_hook__" + func
-				getattr(m, func)(db, self, *args, **kwargs)
+					m = importlib.import_module(module)
+					func = "commit_hook__" + func
+					getattr(m, func)(db, self, *args, **kwargs)
 
 		if pri == 10:
-			print >>sys.stderr, "[%s] Updating stats:" % self.name,
-			# Compute summary stats (hardwired)
-			from tasks import compute_counts
-			self._nrows = compute_counts(db, self.name)
-			self._store_schema()
+			with _timed_commit_step(stats, "Updating stats"):
+				print >>sys.stderr, "[%s] Updating stats:" % self.name,
+				# Compute summary stats (hardwired)
+				from tasks import compute_counts
+				self._nrows = compute_counts(db, self.name)
+				self._store_schema()
 
 			# Set all files read only
-			print >>sys.stderr, "[%s] Marking tablets read-only..." % self.name
-			path = os.path.abspath(self._snapshot_path(self.snapid))
-			for root, dirs, files in os.walk(path):
-				root = os.path.abspath(root)
-				if root != path:
-					os.chmod(root, 0555)			# r-x
-				for f in files:
-					os.chmod(os.path.join(root, f), 0444)	# r--
+			with _timed_commit_step(stats, "Marking tablets read-only"):
+				print >>sys.stderr, "[%s] Marking tablets read-only..." % self.name
+
+				# The catalog has been rebuilt for the last time
+				# (this is the last priority), so the transaction
+				# journal is no longer needed
+				shutil.rmtree(self._journal_path(self.snapid), ignore_errors=True)
+
+				path = os.path.abspath(self._snapshot_path(self.snapid))
+				for root, dirs, files in os.walk(path):
+					root = os.path.abspath(root)
+					if root != path:
+						os.chmod(root, 0555)			# r-x
+					for f in files:
+						os.chmod(os.path.join(root, f), 0444)	# r--
+
+		return stats
+
+	def reload_after_commit0(self, pri):
+		""" Reload the state changed by commit0(db, pri), if it was
+		    run in another process (see DB.commit).
+		"""
+		if pri == -1 and (not self._snapshots or self._snapshots[0] != self.snapid):
+			self._snapshots.insert(0, self.snapid)
+		if pri == 10:
+			# The schema (and the row count) is only stored in
+			# the new snapshot by then
+			self._load_schema()
+		self._load_catalog()
 
 	def commit1(self):
 		""" Do the actual commit """
@@ -834,7 +1108,7 @@ class Table:
 		logger.debug("Released lock %s" % (lock))
 
 	#### Low level tablet creation/access routines. These employ no locking
-	def _get_row_group(self, fp, group, cgroup):
+	def _get_row_group(self, fp, group, cgroup, base=None):
 		"""
 		Get a handle to the given HDF5 node.
 		
@@ -847,6 +1121,11 @@ class Table:
 		retreiving/creating the group with data belonging to the
 		cell ('main'), or the neighbor cache ('cached').
 
+		If fp is a delta segment (see segments.py), a group being
+		created becomes a patch of the group in the preceding
+		segments, given in 'base' (as returned by
+		segments.row_groups), or a replacement if base is empty.
+
 		TODO: I feel this whole 'group' business hasn't been well
 		      though out and should be reconsidered/redesigned...
 		"""
@@ -855,6 +1134,8 @@ class Table:
 		g = getattr(fp.root, group, None)
 
 		if g is None:
+			delta = segments.is_delta(fp)
+			assert not delta or base is not None
 			schema = self._get_schema(cgroup)
 
 			# cgroup
@@ -889,6 +1170,12 @@ class Table:
 						b.append(None)	# ref=0 always points to None (for BLOBs)
 					else:
 						b.append([]) # ref=0 points to an empty array for other BLOB types
+
+			if delta:
+				if base:
+					segments.init_patch(g, base)
+				else:
+					g._v_attrs.DELTA_REPLACE = True
 		return g
 
 	def drop_row_group(self, cell_id, group):
@@ -906,16 +1193,115 @@ class Table:
 				with cell.open(cgroup) as fp:
 					if group in fp.root:
 						fp.removeNode('/', group, recursive=True);
+					if segments.is_delta(fp):
+						# Mask the group of the preceding segments
+						self._get_row_group(fp, group, cgroup, base=[])
+			self._journal_cell(cell_id, **{ group: 0 })
 
-	def _create_tablet(self, fn, cgroup):
+	def compact_cell(self, cell_id, min_segments=2):
+		"""
+		Fold the delta segments of the tablets of cell_id into
+		full tablets (see segments.py).
+
+		If the tablet of the primary cgroup consists of at least
+		min_segments segments, the merged rows of all tablets of the
+		cell (including the neighbor cache) are rewritten into full
+		tablets in the current snapshot, preserving their order.
+
+		Returns the number of segments that were folded (0 if the
+		cell was left as it was).
+		"""
+		self._check_transaction()
+
+		lock = self._lock_cell(cell_id)
+		try:
+			# Load the merged rows (and BLOBs) of all tablets
+			nsegs = 0
+			data = OrderedDict()
+			for cgroup, schema in self._cgroups.iteritems():
+				if self._is_pseudotablet(cgroup):
+					continue
+
+				fn = self._tablet_file(cell_id, cgroup, mode='w')
+				if not os.path.isfile(fn):
+					if not self.tablet_exists(cell_id, cgroup):
+						continue
+					fn = self._tablet_file(cell_id, cgroup)
+
+				with self._tablet_segments(self._open_tablet_file(fn), cell_id, cgroup) as segs:
+					try:
+						if cgroup == self.primary_cgroup:
+							nsegs = len(segs)
+							if nsegs < max(min_segments, 2):
+								return 0
+
+						data[cgroup] = []
+						for group in ['main', 'cached']:
+							groups = segments.row_groups(segs, group)
+							if not groups:
+								continue
+
+							rows = segments.read(groups)
+							seqs = [ (name, node[0]) for (name, node) in groups[-1]._v_children.iteritems() if name.startswith('_seq_') ]
+							blobs = []
+							for colname in schema.get('blobs', {}):
+								refs, ito = np.unique(rows[colname], return_inverse=True)
+								blobs.append((colname, refs, ito, self._load_segment_blobs(groups, colname, refs)))
+
+							data[cgroup].append((group, rows, seqs, blobs))
+					finally:
+						segs[-1].close()
+
+			if not nsegs:
+				return 0
+
+			# Write them out as full tablets
+			for cgroup, groups in data.iteritems():
+				fn = self._tablet_file(cell_id, cgroup, mode='w')
+				if os.path.isfile(fn):
+					os.unlink(fn)
+
+				fp = self._create_tablet(cell_id, cgroup)
+				try:
+					for group, rows, seqs, blobs in groups:
+						g = self._get_row_group(fp, group, cgroup)
+						for name, val in seqs:
+							getattr(g, name)[0] = val
+
+						# Store the BLOBs anew, remapping the refs
+						for colname, refs, ito, objs in blobs:
+							barray = getattr(g.blobs, colname)
+							newrefs = np.zeros(len(refs), dtype=np.int64)
+							for k in np.nonzero(refs)[0]:
+								newrefs[k] = len(barray)
+								barray.append(objs[k])
+							rows[colname] = newrefs[ito].reshape(rows[colname].shape)
+
+						if len(rows):
+							g.table.append(rows)
+						if cgroup == self.primary_cgroup:
+							self._journal_cell(cell_id, **{ group: len(rows) })
+				finally:
+					fp.close()
+		finally:
+			self._unlock_cell(lock)
+
+		return nsegs
+
+	def _create_tablet(self, cell_id, cgroup, base=None):
 		"""
 		Create a new tablet.
 		
-		Create a tablet in file <fn>, for column group <cgroup>.
+		Create the tablet of cell <cell_id> in the current
+		snapshot, for column group <cgroup>. If base is given, the
+		tablet is created as a delta segment of the tablet in
+		snapshot <base> (see segments.py). Tablets of the primary
+		cgroup are recorded in the transaction journal.
 		"""
 		self._check_transaction()
 
 		# Create a tablet at a given path, for cgroup 'cgroup'
+		fn = self._tablet_file(cell_id, cgroup, mode='w')
 		assert os.access(fn, os.R_OK) == False
 
 		# Create the cell directory if it doesn't exist
@@ -927,8 +1313,17 @@ class Table:
 		logger.debug("Creating tablet %s" % (fn))
 		fp  = tables.openFile(fn, mode='w')
 
-		# Force creation of the main subgroup
-		self._get_row_group(fp, 'main', cgroup)
+		if base is None:
+			# Force creation of the main subgroup
+			self._get_row_group(fp, 'main', cgroup)
+		else:
+			# The row groups get created once written to
+			segments.mark_delta(fp, base)
+
+		if cgroup == self.primary_cgroup and base is None:
+			self._journal_cell(cell_id, 0, 0)
+		elif cgroup == self.primary_cgroup:
+			self._journal_cell(cell_id)
 
 		return fp
 
@@ -947,37 +1342,189 @@ class Table:
 		"""
 
 		if mode == 'r':
-			fn_r = self._tablet_file(cell_id, cgroup)
-		        # --- hack: preload the entire file to have it appear in filesystem cache
-		        #     this will speed up subsequent random reads within the file
-			with open(fn_r) as f:
-				f.read()
-			# ---
-			fp = tables.openFile(fn_r)
+			fp = self._open_tablet_file(self._tablet_file(cell_id, cgroup))
 		elif mode == 'r+':
 			self._check_transaction()
 			fn_w = self._tablet_file(cell_id, cgroup, mode='w')
 			if os.path.isfile(fn_w):
 				fp = tables.openFile(fn_w, mode='a')
 			elif self.tablet_exists(cell_id, cgroup): 	# Note: this will download the tablet from remote, if needed
-				# A file exists in an older snapshot. Copy it over here.
-				fn_r = self._tablet_file(cell_id, cgroup)
-				assert fn_r != fn_w, (fn_r, fn_w)
-				shutil.copy(fn_r, fn_w)
-				os.chmod(fn_w, 0664)	# Ensure it's writable
-				fp = tables.openFile(fn_w, mode='a')
+				# A file exists in an older snapshot. Start a delta
+				# segment here, that will hold only the rows written
+				# in this snapshot.
+				fp = self._create_tablet(cell_id, cgroup, base=self.catalog.snapshot_of_cell(cell_id))
 			else:
 				# No file exists
-				fp = self._create_tablet(fn_w, cgroup)
+				fp = self._create_tablet(cell_id, cgroup)
 		elif mode == 'w':
 			self._check_transaction()
-			fn_w = self._tablet_file(cell_id, cgroup, mode='w')
-			fp = self._create_tablet(fn_w, cgroup)
+			fp = self._create_tablet(cell_id, cgroup)
 		else:
 			raise Exception("Mode must be one of 'r', 'r+', or 'w'")
 
 		return fp
 
+	def _open_tablet_file(self, fn):
+		"""
+		Open the tablet in file fn, read-only.
+		"""
+		self._prefetch_tablet(fn)
+
+		t0 = time.time()
+		fp = tables.openFile(fn)
+		self._count_io(tablets_opened=1, open_time=time.time() - t0)
+
+		return fp
+
+	def _segment_file(self, cell_id, cgroup, snapid):
+		"""
+		Return the full path to the segment of the given tablet
+		stored in snapshot snapid.
+		"""
+		return '%s/tablets/%s/%s' % (self._snapshot_path(snapid), self.pix.path_to_cell(cell_id), self._tablet_filename(cgroup))
+
+	def _open_base_segments(self, fp, cell_id, cgroup):
+		"""
+		Open the segments preceding the tablet fp (see segments.py).
+
+		Returns the list of open segments, oldest first (empty if fp
+		is a full tablet). The caller is responsible for closing
+		them.
+		"""
+		segs = []
+		try:
+			top = fp
+			while segments.is_delta(top):
+				fn = self._segment_file(cell_id, cgroup, segments.base_of(top))
+				if not os.access(fn, os.R_OK) and self.remote is not None:
+					self.fetch_from_remote(fn)
+				top = self._open_tablet_file(fn)
+				segs.insert(0, top)
+		except:
+			for s in segs:
+				s.close()
+			raise
+
+		return segs
+
+	@contextmanager
+	def _tablet_segments(self, fp, cell_id, cgroup):
+		"""
+		Open the segments of the tablet whose latest segment is fp.
+		Yields the list of segments, oldest first (ending with fp).
+		"""
+		segs = self._open_base_segments(fp, cell_id, cgroup)
+		try:
+			yield segs + [ fp ]
+		finally:
+			for s in segs:
+				s.close()
+
+	### Tablet prefetching and I/O accounting
+	def set_prefetch_policy(self, policy):
+		"""
+		Set the policy used to warm up the page cache before a
+		tablet is opened for reading.
+
+		Available policies are:
+		    none    : do nothing; PyTables reads what it needs
+		    whole   : read the entire tablet file before opening it
+		    fadvise : posix_fadvise(WILLNEED) the file, letting the
+		              kernel read it ahead asynchronously (the default)
+		    next    : as fadvise, but also prefetch the tablets of the
+		              next cell in the list of cells being queried, in
+		              a background thread (see prefetch_cell())
+
+		If policy is None, the policy given in the LSD_PREFETCH
+		environment variable is used.
+		"""
+		if policy is not None and policy not in PREFETCH_POLICIES:
+			raise Exception("Unknown prefetch policy '%s' (must be one of %s)" % (policy, ', '.join(PREFETCH_POLICIES)))
+		self.prefetch = policy
+
+	def get_prefetch_policy(self):
+		""" Return the active tablet prefetch policy """
+		if self.prefetch is not None:
+			return self.prefetch
+
+		policy = os.getenv('LSD_PREFETCH', 'fadvise')
+		if policy not in PREFETCH_POLICIES:
+			raise Exception("Unknown prefetch policy '%s' in LSD_PREFETCH (must be one of %s)" % (policy, ', '.join(PREFETCH_POLICIES)))
+		return policy
+
+	def _count_io(self, **counters):
+		""" Increment the I/O counters given as keyword arguments """
+		with _iostats_lock:
+			if self._iostats is None:
+				self._iostats = dict.fromkeys(IOSTATS_KEYS, 0)
+			for k, v in counters.iteritems():
+				self._iostats[k] += v
+
+	def io_stats(self):
+		"""
+		Return a dict of I/O counters for this table.
+
+		The counters are kept per process (i.e., the workers of a
+		query keep their own). Use them to compare the effectiveness
+		of prefetch policies (see set_prefetch_policy()).
+		"""
+		with _iostats_lock:
+			stats = dict(self._iostats) if self._iostats is not None else dict.fromkeys(IOSTATS_KEYS, 0)
+		stats['policy'] = self.get_prefetch_policy()
+		return stats
+
+	def reset_io_stats(self):
+		""" Zero the I/O counters """
+		with _iostats_lock:
+			self._iostats = None
+
+	def _prefetch_tablet(self, fn):
+		""" Warm up the page cache for tablet fn, according to the prefetch policy """
+		policy = self.get_prefetch_policy()
+		if policy == 'none':
+			return
+
+		t0 = time.time()
+		if policy == 'whole':
+			n = _read_whole_file(fn)
+		else:
+			fd = os.open(fn, os.O_RDONLY)
+			try:
+				n = os.fstat(fd).st_size if utils.fadvise_willneed(fd) else 0
+			finally:
+				os.close(fd)
+		self._count_io(prefetch_bytes=n, prefetch_time=time.time() - t0)
+
+	def prefetch_cell(self, cell_id):
+		"""
+		Start prefetching the tablets of cell_id in a background
+		thread, if the prefetch policy is 'next'. A no-op
+		otherwise.
+
+		Called by the query engine with the cell that will be
+		processed after the current one. Only local tablets are
+		prefetched (remote ones are fetched on demand).
+		"""
+		if self.get_prefetch_policy() != 'next':
+			return
+
+		cell_id = self.static_if_no_temporal(cell_id)
+		fns = []
+		for cgroup in self._cgroups:
+			if self._is_pseudotablet(cgroup):
+				continue
+			try:
+				fn = self._tablet_file(cell_id, cgroup)
+			except LookupError:
+				return
+			if os.path.isfile(fn):
+				fns.append(fn)
+
+		if fns:
+			th = threading.Thread(target=_background_prefetch, args=(self, fns))
+			th.daemon = True
+			th.start()
+
 	### Public methods
 	def __init__(self, path, snapid, open_transaction, mode='r', name=None):
 		"""
@@ -1099,76 +1646,14 @@ class Table:
 		"""
 
 		assert group in ['main', 'cached']
-		assert _update == False or group != 'cached'
+		assert _update == False or group != 'cached' or cell_id is not None	# Updates of cached rows are for neighbor cache builds only
 
 		# Must be in a transaction to modify things
 		self._check_transaction()
 
-		# Resolve aliases in the input, and prepare a ColGroup()
-		cols = ColGroup()
-		if getattr(cols_, 'items', None):			# Permit cols_ to be a dict()-like object
-			cols_ = cols_.items()
-		if getattr(cols_, 'dtype', None):			# Allow cols_ to be a ndarray or ColGroup
-			cols_ = [ (name, cols_[name]) for name in cols_.dtype.names ]
-		for name, col in cols_:
-			cols.add_column(self.resolve_alias(name), col)
-		assert cols.ncols()
-
-		# if the primary key column has not been supplied by the user, add it
+		# Resolve aliases and find the cells to store the rows into
+		cols, cells = self._locate_rows(cols_, group, cell_id, _update)
 		key = self.get_primary_key()
-		if key not in cols:
-			cols[key] = np.zeros(len(cols), dtype=self.columns[key].dtype)
-		else:
-			# If the primary column has been supplied by the user, it either
-			# has to refer to cells only, or this append() must be allowed to
-			# update/insert rows.
-			# Alternatively, cell_id may be != None (e.g., for filling in neighbor caches)
-			cid = self.pix.is_cell_id(cols[key])
-			assert cid.all() or _update or cell_id is not None, "If keys are given, they must refer to the cell only."
-
-			# Setup the 'base' keys (with obj_id part equal to zero)
-			cols[key][cid] &= np.uint64(0xFFFFFFFF00000000)
-
-		# Locate the cells into which we're going to store the rows
-		# - if <cell_id> is not None: override everything else and insert into the requested cell(s).
-		# - elif <primary_key> column exists and not all zeros: compute destination cells from it
-		# - elif <spatial_keys> columns exist: use them to determine destination cells
-		#
-		# Rules for (auto)generation of keys:
-		# - if the key is all zeros, the cell part (higher 32 bits) will be set to the cell_part of cell_id
-		# - if the object part of the key is all zeros, it will be generated from the cell's sequence
-		#
-		# Note that a key with cell part of 0x0 points to a valid cell (the south pole)!
-		#
-		if cell_id is not None:
-			# Explicit vector (or scalar) of destination cell(s) has been provided
-			# Overrides anything that would've been computed from primary_key or spatial_keys
-			# Shouldn't be used EVER (unless you really, really, really know what you're doing.)
-			assert group != 'main'	# Allowed only for neighbor cache builds, really...
-			cells = np.array(cell_id, copy=False, ndmin=1)
-			if len(cells) == 1:
-				cells = np.resize(cells, len(cols))
-		else:
-			# Deduce any unset keys from spatial_keys
-			if not cols[key].all():
-				assert group == 'main'
-
-				need_key = cols[key] == 0
-
-				# Deduce remaining cells from spatial and temporal keys
-				lonKey, latKey = self.get_spatial_keys()
-				assert lonKey and latKey, "The table must have at least the spatial keys!"
-				assert lonKey in cols and latKey in cols, "The input must contain at least the spatial keys!"
-				tKey = self.get_temporal_key()
-
-				lon = cols[lonKey][need_key]
-				lat = cols[latKey][need_key]
-				t   = cols[tKey][need_key]   if tKey is not None else None
-
-				cols[key][need_key] = self.pix.obj_id_from_pos(lon, lat, t)
-
-			# Deduce destination cells from keys
-			cells = self.pix.cell_for_id(cols[key])
 
 		#
 		# Do the storing, cell by cell
@@ -1202,11 +1687,16 @@ class Table:
 				if self._is_pseudotablet(cgroup):
 					continue
 
-				# Get the tablet file handles
-				fp    = self._open_tablet(cur_cell_id, mode='r+', cgroup=cgroup)
-				g     = self._get_row_group(fp, group, cgroup)
-				t     = g.table
-				blobs = schema['blobs'] if 'blobs' in schema else dict()
+				# Get the tablet file handles. If the tablet is a delta
+				# segment, the segments preceding it are opened as well,
+				# to read the rows it patches.
+				fp     = self._open_tablet(cur_cell_id, mode='r+', cgroup=cgroup)
+				base   = self._open_base_segments(fp, cur_cell_id, cgroup)
+				g      = self._get_row_group(fp, group, cgroup, segments.row_groups(base, group))
+				groups = segments.row_groups(base + [ fp ], group)
+				patch  = segments.is_patch(g)
+				t      = g.table
+				blobs  = schema['blobs'] if 'blobs' in schema else dict()
 
 				# select out only the columns belonging to this tablet and cell
 				colsT = ColGroup([ (colname, cols[colname][incell]) for colname, _ in schema['columns'] if colname in cols ])
@@ -1214,7 +1704,7 @@ class Table:
 
 				if cgroup == self.primary_cgroup:
 					# Logical number of rows in this cell
-					nrows = len(t)
+					nrows = segments.nrows(groups)
 
 					# Find keys needing an autogenerated ID and generate it
 					_, _, _, i = self.pix._xyti_from_id(colsT[key])
@@ -1244,7 +1734,7 @@ class Table:
 
 					# If this is an update, find where the new rows map
 					if _update:
-						id1 = t.col(self.primary_key.name)	# Load the primary keys of existing rows
+						id1 = segments.read(groups, field=self.primary_key.name)	# Load the primary keys of existing rows
 						id2 = colsT[key]			# Primary keys of new rows
 
 						# The "find-insertion-points" idiom (if only np.in1d returned indices...)
@@ -1270,14 +1760,24 @@ class Table:
 							idx[napp] = ii[idx[napp]]
 #							print id1, id2, idx, app, nnew; exit()
 
-				if _update and not isinstance(idx, slice):
+				if _update and not isinstance(idx, slice) and patch:
+					# Store only the updated and the new rows, patching
+					# those of the preceding segments. Columns that
+					# weren't given keep their values.
+					rowidx = idx
+					rows = np.zeros(len(idx), dtype=np.dtype(schema['columns']))
+					old = idx < nrows
+					if old.any():
+						rows[old] = segments.read_coordinates(groups, idx[old])
+					ridx = slice(None)
+				elif _update and not isinstance(idx, slice):
 					# Load existing rows (and imediately delete them)
 					rows = t.read()
 					t.truncate(0)
 
 					# Resolve blobs, merge them with ours (and immediately delete)
 					for colname in colsB:
-						bb = self._fetch_blobs_fp(fp, colname, rows[colname])
+						bb = self._fetch_blobs_segs([ fp ], colname, rows[colname])
 						len0 = len(bb)
 						bb = np.resize(bb, (nrows + nnew,) + bb.shape[1:])
 						# Since np.resize fills the newly allocated part with zeros, change it to None
@@ -1297,6 +1797,7 @@ class Table:
 
 					# Enlarge the array to accommodate new rows (this will also set them to zero)
 					rows.resize(nrows + nnew)
+					ridx = idx
 
 #					print len(colsB['hdr']), len(rows), nnew
 #					print colsB['hdr']
@@ -1306,13 +1807,16 @@ class Table:
 					# unspecified columns set to zero
 					nnew = np.sum(incell)
 					rows = np.zeros(nnew, dtype=np.dtype(schema['columns']))
-					idx = slice(None)
+					idx = ridx = slice(None)
+					if patch:
+						n0 = segments.nrows(groups)
+						rowidx = np.arange(n0, n0 + nnew, dtype=np.uint64)
 
 				# Update/add regular columns
 				for colname in colsT.keys():
 					if colname in blobs:
 						continue
-					rows[colname][idx] = colsT[colname]
+					rows[colname][ridx] = colsT[colname]
 
 				# Update/add blobs. They're different as they'll touch all
 				# the rows, every time (even when updating).
@@ -1329,7 +1833,7 @@ class Table:
 
 					# Offset indices
 					barray = getattr(g.blobs, colname)
-					bsize = len(barray)
+					bsize = len(barray) + segments.blob_base(barray)
 					ito = ito + bsize
 
 					# Remap any None values to index 0 (where None is stored by convention)
@@ -1355,8 +1859,14 @@ class Table:
 #					print 'LEN:', colname, bsize, len(barray), ito
 
 				t.append(rows)
+				if patch:
+					g._rowidx.append(rowidx)
+				if cgroup == self.primary_cgroup:
+					self._journal_cell(cur_cell_id, **{ group: nrows + nnew })
 				logger.debug("Closing tablet (%s)" % (fp.filename))
 				fp.close()
+				for seg in base:
+					seg.close()
 #				exit()
 
 			self._unlock_cell(lock)
@@ -1370,10 +1880,123 @@ class Table:
 
 		return cols[key]
 
+	def _locate_rows(self, cols_, group, cell_id, _update):
+		"""
+		Resolve the aliases in cols_, set up the primary keys, and
+		compute the cells into which the rows are to be stored.
+
+		Returns the rows as a ColGroup, and the array of their
+		destination cells. See append() for the meaning of the
+		arguments.
+		"""
+		# Resolve aliases in the input, and prepare a ColGroup()
+		cols = ColGroup()
+		if getattr(cols_, 'items', None):			# Permit cols_ to be a dict()-like object
+			cols_ = cols_.items()
+		if getattr(cols_, 'dtype', None):			# Allow cols_ to be a ndarray or ColGroup
+			cols_ = [ (name, cols_[name]) for name in cols_.dtype.names ]
+		for name, col in cols_:
+			cols.add_column(self.resolve_alias(name), col)
+		assert cols.ncols()
+
+		# if the primary key column has not been supplied by the user, add it
+		key = self.get_primary_key()
+		if key not in cols:
+			cols[key] = np.zeros(len(cols), dtype=self.columns[key].dtype)
+		else:
+			# If the primary column has been supplied by the user, it either
+			# has to refer to cells only (or have the object part equal to zero,
+			# as the keys computed from spatial keys by split_by_cell), or this
+			# append() must be allowed to update/insert rows.
+			# Alternatively, cell_id may be != None (e.g., for filling in neighbor caches)
+			cid = self.pix.is_cell_id(cols[key])
+			_, _, _, i = self.pix._xyti_from_id(cols[key])
+			assert (cid | (i == 0)).all() or _update or cell_id is not None, "If keys are given, they must refer to the cell only."
+
+			# Setup the 'base' keys (with obj_id part equal to zero)
+			cols[key][cid] &= np.uint64(0xFFFFFFFF00000000)
+
+		# Locate the cells into which we're going to store the rows
+		# - if <cell_id> is not None: override everything else and insert into the requested cell(s).
+		# - elif <primary_key> column exists and not all zeros: compute destination cells from it
+		# - elif <spatial_keys> columns exist: use them to determine destination cells
+		#
+		# Rules for (auto)generation of keys:
+		# - if the key is all zeros, the cell part (higher 32 bits) will be set to the cell_part of cell_id
+		# - if the object part of the key is all zeros, it will be generated from the cell's sequence
+		#
+		# Note that a key with cell part of 0x0 points to a valid cell (the south pole)!
+		#
+		if cell_id is not None:
+			# Explicit vector (or scalar) of destination cell(s) has been provided
+			# Overrides anything that would've been computed from primary_key or spatial_keys
+			# Shouldn't be used EVER (unless you really, really, really know what you're doing.)
+			assert group != 'main'	# Allowed only for neighbor cache builds, really...
+			cells = np.array(cell_id, copy=False, ndmin=1)
+			if len(cells) == 1:
+				cells = np.resize(cells, len(cols))
+		else:
+			# Deduce any unset keys from spatial_keys
+			if not cols[key].all():
+				assert group == 'main'
+
+				need_key = cols[key] == 0
+
+				# Deduce remaining cells from spatial and temporal keys
+				lonKey, latKey = self.get_spatial_keys()
+				assert lonKey and latKey, "The table must have at least the spatial keys!"
+				assert lonKey in cols and latKey in cols, "The input must contain at least the spatial keys!"
+				tKey = self.get_temporal_key()
+
+				lon = cols[lonKey][need_key]
+				lat = cols[latKey][need_key]
+				t   = cols[tKey][need_key]   if tKey is not None else None
+
+				cols[key][need_key] = self.pix.obj_id_from_pos(lon, lat, t)
+
+			# Deduce destination cells from keys
+			cells = self.pix.cell_for_id(cols[key])
+
+		return cols, cells
+
+	def split_by_cell(self, cols_, _update=False):
+		"""
+		Split a set of rows to be appended to this table by the
+		cells they will be stored in.
+
+		Used to batch the appends of many small sets of rows (e.g.,
+		those parsed from each of the files being imported; see
+		lsd.ingest), so that each cell is written to only once.
+
+		Returns
+		-------
+		A list of (cell_id, rows) tuples, where rows is a ColGroup
+		with the rows that belong to cell_id, ready to be passed on
+		to append(). Rows without a primary key are given the key
+		computed from their spatial (and temporal) keys, with the
+		object part equal to zero (it is generated on append, as if
+		the rows were appended directly).
+		"""
+		cols, cells = self._locate_rows(cols_, 'main', None, _update)
+
+		order = np.argsort(cells, kind='mergesort')
+		ucells, begin = np.unique(cells[order], return_index=True)
+		end = np.append(begin[1:], len(cells))
+
+		return [ (cell_id, cols[order[i:j]]) for cell_id, i, j in zip(ucells, begin, end) ]
+
 	def nrows(self):
 		"""
-		Returns the (cached) number of rows in the table
+		Returns the number of rows in the table
+
+		Outside of transactions, it's the sum of the row counts of
+		the cells kept in the table catalog (if known; the cached
+		count stored with the schema otherwise).
 		"""
+		if not self.transaction:
+			nrows = self.catalog.nrows()
+			if nrows is not None:
+				return nrows
 		return self._nrows
 
 	def close(self):
@@ -1463,9 +2086,28 @@ class Table:
 
 		return blobs
 
-	def _fetch_blobs_fp(self, fp, column, refs, include_cached=False):
+	def _load_segment_blobs(self, groups, column, refs):
+		"""
+		Load the BLOBs referenced by refs from the merged row group
+		groups (see segments.py), using _smart_load_blobs.
+		"""
+		offsets, arrays = segments.blob_arrays(groups, column)
+		if len(arrays) == 1:
+			return self._smart_load_blobs(arrays[0], refs)
+
+		# Find the segments the refs point into
+		seg = np.searchsorted(offsets, refs, 'right') - 1
+		blobs = np.empty(len(refs), dtype=object)
+		for k in np.unique(seg):
+			inseg = seg == k
+			blobs[inseg] = self._smart_load_blobs(arrays[k], refs[inseg] - offsets[k])
+
+		return blobs
+
+	def _fetch_blobs_segs(self, segs, column, refs, include_cached=False):
 		"""
-		Fetch the BLOBs referenced by refs from PyTables file object fp
+		Fetch the BLOBs referenced by refs from the segments of a
+		tablet (a list of PyTables file objects; see segments.py)
 
 		The BLOB references are indices into a VLArray (variable
 		length array) in the HDF5 file. By convention, the indices
@@ -1478,8 +2120,8 @@ class Table:
 		
 		Parameters
 		----------
-		fp : table.File
-		    PyTables file object from which to load the BLOBs
+		segs : list of table.File
+		    PyTables file objects from which to load the BLOBs
 		column : string
 		    The column name of the BLOB column
 		refs : ndarray of int64
@@ -1501,18 +2143,17 @@ class Table:
 		refs = refs.reshape(refs.size)
 
 		# Load the blobs
-		b1 = getattr(fp.root.main.blobs, column)
-		if include_cached and 'cached' in fp.root:
+		g1 = segments.row_groups(segs, 'main')
+		g2 = segments.row_groups(segs, 'cached')
+		if include_cached and g2:
 			# We have cached objects in 'cached' group -- read the blobs
 			# from there as well. blob refs of cached objects are
 			# negative.
-			b2 = getattr(fp.root.cached.blobs, column)
-
 			blobs = np.empty(len(refs), dtype=object)
-			blobs[refs >= 0] = self._smart_load_blobs(b1,   refs[refs >= 0]),
-			blobs[ refs < 0] = self._smart_load_blobs(b2,  -refs[ refs < 0]),
+			blobs[refs >= 0] = self._load_segment_blobs(g1, column,  refs[refs >= 0]),
+			blobs[ refs < 0] = self._load_segment_blobs(g2, column, -refs[ refs < 0]),
 		else:
-			blobs = self._smart_load_blobs(b1, refs)
+			blobs = self._load_segment_blobs(g1, column, refs)
 
 		# Bring back to original shape
 		blobs = blobs.reshape(shape)
@@ -1530,7 +2171,7 @@ class Table:
 		tablet in that cell, a static sky cell corresponding to it
 		is tried next.
 
-		See documentation for _fetch_blobs_fp() for more details.
+		See documentation for _fetch_blobs_segs() for more details.
 		"""
 		# short-circuit if there's nothing to be loaded
 		if len(refs) == 0:
@@ -1545,12 +2186,92 @@ class Table:
 
 		# load the blobs arrays
 		with self.lock_cell(cell_id) as cell:
-			with cell.open(cgroup) as fp:
-				blobs = self._fetch_blobs_fp(fp, column, refs, include_cached)
+			with cell.open_segments(cgroup) as segs:
+				blobs = self._fetch_blobs_segs(segs, column, refs, include_cached)
 
 		return blobs
 
-	def fetch_tablet(self, cell_id, cgroup=None, include_cached=False):
+	def _read_columns(self, groups, columns, start=None, stop=None, cuts=None):
+		"""
+		Read a subset of columns from a (merged) row group.
+
+		Reads only the requested fields (and rows in [start, stop),
+		if given), leaving the rest of the row group untouched on
+		disk. Returns a ColGroup with the columns in the requested
+		order, with only the rows passing the cuts (if given; see
+		fetch_tablet).
+		"""
+		if cuts and len(groups) == 1:
+			# A single segment: have PyTables evaluate the cuts
+			# in-kernel, and read only the rows passing them
+			t = groups[0].table
+			cond = ' & '.join( '(%s %s _cut%d)' % (name, op, k) for k, (name, op, _) in enumerate(cuts) )
+			condvars = dict(( ('_cut%d' % k, val) for k, (_, _, val) in enumerate(cuts) ))
+			coords = t.getWhereList(cond, condvars, start=start, stop=stop)
+			return ColGroup([ (name, t.readCoordinates(coords, field=name)) for name in columns ])
+
+		rows = ColGroup([ (name, segments.read(groups, start, stop, field=name)) for name in columns ])
+		if cuts:
+			# Delta segments: the rows are patched after they're
+			# read, so the cuts are applied to the merged rows
+			keep = np.ones(len(rows), dtype=bool)
+			for name, op, val in cuts:
+				col = rows[name] if name in columns else segments.read(groups, start, stop, field=name)
+				keep &= CUT_OPS[op](col, val)
+			rows = rows[keep]
+		return rows
+
+	def tablet_size(self, cell_id):
+		"""
+		Return the total size (in bytes) of the locally stored
+		tablets of cell_id, or 0 if the cell does not exist. The
+		sizes of all live segments of the tablets (see segments.py)
+		are summed, as they're all read when the cell is.
+
+		Used as a cheap estimate of the cost of processing a cell
+		(see Query.execute).
+		"""
+		size = 0
+		for cgroup in self._cgroups:
+			if self._is_pseudotablet(cgroup):
+				continue
+			try:
+				fn = self._tablet_file(cell_id, cgroup)
+				while True:
+					size += os.path.getsize(fn)
+					with tables.openFile(fn) as fp:
+						if not segments.is_delta(fp):
+							break
+						fn = self._segment_file(cell_id, cgroup, segments.base_of(fp))
+			except (LookupError, EnvironmentError):
+				pass
+		return size
+
+	def main_nrows(self, cell_id):
+		"""
+		Return the number of rows stored in cell_id (excluding the
+		neighbor cache).
+
+		Taken from the table catalog, unless the count is unknown
+		there (for cells committed by versions of LSD that didn't
+		keep them), in which case the tablet is opened to count them.
+		"""
+		cell_id = self.static_if_no_temporal(cell_id)
+		try:
+			nmain, _ = self.catalog.get_nrows(cell_id)
+			if nmain >= 0:
+				return nmain
+		except LookupError:
+			pass
+
+		if not self.tablet_exists(cell_id, self.primary_cgroup):
+			return 0
+
+		with self.lock_cell(cell_id) as cell:
+			with cell.open_segments(self.primary_cgroup) as segs:
+				return segments.nrows(segments.row_groups(segs, 'main'))
+
+	def fetch_tablet(self, cell_id, cgroup=None, include_cached=False, columns=None, rowrange=None, cuts=None):
 		"""
 		Load and return the contents of a tablet.
 
@@ -1564,11 +2285,26 @@ class Table:
 		include_cached : boolean
 		    If True, data from the neighbor cache will be returned
 		    as well.
+		columns : list of strings or None
+		    If given, only these columns of the column group will be
+		    read from disk (column projection). The column names must
+		    be resolved (no aliases), and belong to cgroup.
+		rowrange : (start, stop) tuple or None
+		    If given, only the rows in [start, stop) are read. May
+		    not be combined with include_cached=True.
+		cuts : list of (column, op, value) tuples or None
+		    If given, only the rows for which all 'column op value'
+		    comparisons (op being one of CUT_OPS) are true are
+		    returned. Where possible, the cuts are evaluated by
+		    PyTables while reading, and only the rows passing them
+		    are read. Requires columns to be given; the cut columns
+		    must be resolved, and belong to cgroup.
 
 		Returns
 		-------
-		rows : structured ndarray
-		    The rows from the tablet.
+		rows : structured ndarray or ColGroup
+		    The rows from the tablet. If columns is not None, a
+		    ColGroup with only the requested columns is returned.
 
 		Notes
 		-----
@@ -1592,26 +2328,52 @@ class Table:
 		# unpopulated (happens in static-temporal JOINs)
 		cell_id = self.static_if_no_temporal(cell_id)
 
+		assert rowrange is None or not include_cached
+		assert cuts is None or columns is not None
+		start, stop = rowrange if rowrange is not None else (None, None)
+
 		if self._is_pseudotablet(cgroup):
-			return self._fetch_pseudotablet(cell_id, cgroup, include_cached)
+			assert cuts is None
+			rows = self._fetch_pseudotablet(cell_id, cgroup, include_cached)
+			if rowrange is not None:
+				rows = rows[start:stop]
+			return rows if columns is None else rows[list(columns)]
 
+		schema = self._get_schema(cgroup)
 		if self.tablet_exists(cell_id, cgroup):	# Note: this will download the tablet from remote, if needed
 			with self.lock_cell(cell_id) as cell:
-				with cell.open(cgroup) as fp:
-					rows = fp.root.main.table.read()
-					if include_cached and 'cached' in fp.root:
-						rows2 = fp.root.cached.table.read()
+				with cell.open_segments(cgroup) as segs:
+					main = segments.row_groups(segs, 'main')
+					if columns is None:
+						rows = segments.read(main, start, stop)
+					else:
+						rows = self._read_columns(main, columns, start, stop, cuts)
+
+					cached = segments.row_groups(segs, 'cached')
+					if include_cached and cached:
+						if columns is None:
+							rows2 = segments.read(cached)
+						else:
+							rows2 = self._read_columns(cached, columns, cuts=cuts)
+
 						# Make any neighbor cache BLOBs negative (so that fetch_blobs() know to
 						# look for them in the cache, instead of 'main')
-						schema = self._get_schema(cgroup)
 						if 'blobs' in schema:
 							for blobcol in schema['blobs']:
-								rows2[blobcol] *= -1
+								if columns is None or blobcol in rows2:
+									rows2[blobcol] *= -1
+
 						# Append the data from cache to the main tablet
-						rows = np.append(rows, rows2)
+						if columns is None:
+							rows = np.append(rows, rows2)
+						else:
+							rows = ColGroup([ (name, np.concatenate((rows[name], rows2[name]))) for name in columns ])
 		else:
-			schema = self._get_schema(cgroup)
-			rows = np.empty(0, dtype=np.dtype(schema['columns']))
+			if columns is None:
+				rows = np.empty(0, dtype=np.dtype(schema['columns']))
+			else:
+				coldefs = dict(schema['columns'])
+				rows = ColGroup(dtype=[ (name, coldefs[name]) for name in columns ])
 
 		return rows
 
@@ -1634,9 +2396,9 @@ class Table:
 		nrows1 = nrows2 = 0
 		if self.cell_exists(cell_id):
 			with self.lock_cell(cell_id) as cell:
-				with cell.open(self.primary_cgroup) as fp:
-					nrows1 = len(fp.root.main.table)
-					nrows2 = len(fp.root.cached.table) if (include_cached and 'cached' in fp.root) else 0
+				with cell.open_segments(self.primary_cgroup) as segs:
+					nrows1 = segments.nrows(segments.row_groups(segs, 'main'))
+					nrows2 = segments.nrows(segments.row_groups(segs, 'cached')) if include_cached else 0
 		nrows = nrows1 + nrows2
 
 		cached = np.zeros(nrows, dtype=np.bool)			# _CACHED
@@ -1684,6 +2446,20 @@ class Table:
 			logger.debug("Closing tablet (%s)" % (fp.filename))
 			fp.close()
 
+		@contextmanager
+		def open_segments(self, cgroup=None):
+			"""
+			Opens all segments of the requested tablet within a
+			locked cell (see segments.py). Yields the list of
+			segments, oldest first.
+			"""
+			if cgroup is None:
+				cgroup = self.table.primary_cgroup
+
+			with self.open(cgroup) as fp:
+				with self.table._tablet_segments(fp, self.cell_id, cgroup) as segs:
+					yield segs
+
 	@contextmanager
 	def lock_cell(self, cell_id, mode='r', timeout=None):
 		""" Open and return a proxy object for the given cell, that allows
@@ -1720,3 +2496,180 @@ class Table:
 		defined.
 		"""
 		return self.temporal_key.name if self.temporal_key is not None else None
+
+############ Unit tests
+
+class Test_delta_segments:
+	""" Tablets written to across snapshots (see segments.py) """
+	def setUp(self):
+		import tempfile
+		from join_ops import DB
+		self.tmpdir = tempfile.mkdtemp()
+		self.db = DB(self.tmpdir)
+		schema = {
+			'schema': OrderedDict([
+				('main', {
+					'columns': [ ('obj_id', 'u8'), ('ra', 'f8'), ('dec', 'f8'), ('mag', 'f4'), ('hdr', 'i8') ],
+					'primary_key': 'obj_id',
+					'spatial_keys': ['ra', 'dec'],
+					'blobs': { 'hdr': {} }
+				}),
+				('extra', {
+					'columns': [ ('flag', 'i4') ]
+				})
+			]),
+			'commit_hooks': []
+		}
+		with self.db.transaction():
+			self.db.create_table('t', schema)
+		self.truth = OrderedDict()	# obj_id -> [mag, hdr, flag], in the order of the rows in the cell
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmpdir)
+
+	def _append(self, n, seed):
+		# Append n rows (all within the same cell), in a transaction
+		np.random.seed(seed)
+		ra, dec = np.random.uniform(10, 10.01, n), np.random.uniform(20, 20.01, n)
+		mag = np.random.uniform(15, 20, n).astype('f4')
+		hdr = np.empty(n, dtype=object)
+		for i in xrange(n):
+			hdr[i] = None if i % 7 == 0 else { 'seed': seed, 'i': i }
+		flag = np.arange(n, dtype='i4') + 1000*seed
+
+		with self.db.transaction():
+			ids = self.db.table('t').append([ ('ra', ra), ('dec', dec), ('mag', mag), ('hdr', hdr), ('flag', flag) ])
+		for i, obj_id in enumerate(ids):
+			self.truth[obj_id] = [ mag[i], hdr[i], flag[i] ]
+		self.cell_id = self.db.table('t').pix.cell_for_id(ids[0])
+		return ids
+
+	def _update(self, ids, **cols):
+		# Update columns of existing rows, in a transaction
+		with self.db.transaction():
+			self.db.table('t').append([ ('obj_id', ids) ] + cols.items(), _update=True)
+		for name, col in cols.iteritems():
+			k = ['mag', 'hdr', 'flag'].index(name)
+			for obj_id, val in zip(ids, col):
+				self.truth[obj_id][k] = val
+
+	def _is_delta(self, cgroup='main'):
+		t = self.db.table('t')
+		with tables.openFile(t._tablet_file(self.cell_id, cgroup)) as fp:
+			return segments.is_delta(fp)
+
+	def _check(self):
+		# The merged rows equal the truth, in the same order. Returns
+		# the rows and the BLOBs of the main cgroup.
+		t = self.db.table('t')
+		rows = t.fetch_tablet(self.cell_id, 'main')
+		extra = t.fetch_tablet(self.cell_id, 'extra')
+		hdr = t.fetch_blobs(self.cell_id, 'hdr', rows['hdr'])
+
+		assert list(rows['obj_id']) == self.truth.keys()
+		assert len(extra) == len(rows) == t.main_nrows(self.cell_id)
+		for i, (mag, h, flag) in enumerate(self.truth.itervalues()):
+			assert rows['mag'][i] == mag and hdr[i] == h and extra['flag'][i] == flag, (i, rows[i], hdr[i], extra['flag'][i])
+
+		# The zone map is kept up to date with the rows (see _update_zonemaps)
+		zmin, zmax, _ = t.catalog.get_zonemap(self.cell_id)['mag']
+		assert zmin == rows['mag'].min() and zmax == rows['mag'].max(), (zmin, zmax)
+
+		# Reading a subset of columns and rows goes through the same merge
+		sub = t.fetch_tablet(self.cell_id, 'main', columns=['obj_id', 'mag'], rowrange=(5, 40))
+		assert np.all(sub['obj_id'] == rows['obj_id'][5:40]) and np.all(sub['mag'] == rows['mag'][5:40])
+
+		return rows, hdr
+
+	def test_patch(self):
+		""" Delta segments: rows appended in later snapshots """
+		self._append(100, 1)
+		assert not self._is_delta()
+		self._check()
+
+		self._append(30, 2)
+		assert self._is_delta() and self._is_delta('extra')
+		self._append(20, 3)
+		self._check()
+
+		# The transaction journals are removed once committed
+		t = self.db.table('t')
+		assert not os.path.exists(t._journal_path(t.snapid))
+
+	def test_update(self):
+		""" Delta segments: rows updated in later snapshots """
+		ids = self._append(100, 1)
+		self._append(30, 2)
+
+		upd = ids[::9]
+		hdr = np.empty(len(upd), dtype=object)
+		for i in xrange(len(upd)):
+			hdr[i] = { 'updated': i }
+		self._update(upd, mag=np.full(len(upd), 99, dtype='f4'), hdr=hdr)
+		self._check()
+
+		# Patch the patch, touching only the other cgroup
+		upd = np.concatenate((ids[::13], ids[2::13]))
+		self._update(upd, flag=np.full(len(upd), -5, dtype='i4'))
+		self._check()
+
+	def test_replace(self):
+		""" Delta segments: the neighbor cache dropped and rewritten in later snapshots """
+		self._append(100, 1)
+		t = self.db.table('t')
+
+		def cache(n, seed):
+			# Write n (fake) rows into the neighbor cache of the cell
+			ids = np.array(self.truth.keys()[:n], dtype=np.uint64) + np.uint64(seed)
+			hdr = np.array([ { 'cached': seed, 'i': i } for i in xrange(n) ], dtype=object)
+			with self.db.transaction():
+				self.db.table('t').append([ ('obj_id', ids), ('ra', np.zeros(n)), ('dec', np.zeros(n)), ('mag', np.zeros(n, 'f4')),
+					('hdr', hdr), ('flag', np.zeros(n, 'i4')) ], group='cached', cell_id=self.cell_id)
+			return ids, list(hdr)
+
+		def check_cached(ids, hdr):
+			t = self.db.table('t')
+			nmain = len(self.truth)
+			rows = t.fetch_tablet(self.cell_id, 'main', include_cached=True)
+			assert len(rows) == nmain + len(ids) == len(t.fetch_tablet(self.cell_id, 'extra', include_cached=True))
+			assert list(rows['obj_id'][nmain:]) == list(ids)
+			assert list(t.fetch_blobs(self.cell_id, 'hdr', rows['hdr'], include_cached=True)[nmain:]) == hdr
+			self._check()
+
+		ids1, hdr1 = cache(5, 1)
+		ids2, hdr2 = cache(7, 2)
+		assert self._is_delta()
+		check_cached(np.concatenate((ids1, ids2)), hdr1 + hdr2)
+
+		with self.db.transaction():
+			self.db.table('t').drop_row_group(self.cell_id, 'cached')
+		t = self.db.table('t')
+		with tables.openFile(t._tablet_file(self.cell_id, 'main')) as fp:
+			assert segments.is_delta(fp) and not segments.is_patch(fp.root.cached)
+		check_cached([], [])
+
+		ids3, hdr3 = cache(3, 3)
+		check_cached(ids3, hdr3)
+
+	def test_compact(self):
+		""" Delta segments: compacted into full tablets, keeping the order of rows and the BLOBs """
+		ids = self._append(100, 1)
+		self._append(30, 2)
+		upd = ids[::11]
+		self._update(upd, hdr=np.array([ { 'updated': i } for i in xrange(len(upd)) ], dtype=object))
+		self._update(ids[::5], flag=np.full(len(ids[::5]), 7, dtype='i4'))
+		rows, hdr = self._check()
+
+		with self.db.transaction():
+			assert self.db.table('t').compact_cell(self.cell_id, 10) == 0	# Too few segments
+			assert self.db.table('t').compact_cell(self.cell_id) == 4
+		assert not self._is_delta() and not self._is_delta('extra')
+		rows2, hdr2 = self._check()
+		assert np.all(rows2['obj_id'] == rows['obj_id']) and list(hdr2) == list(hdr)
+
+		# Further deltas on top of the compacted tablet
+		self._append(10, 3)
+		self._update(ids[::3], mag=np.full(len(ids[::3]), 1, dtype='f4'))
+		assert self._is_delta()
+		self._check()
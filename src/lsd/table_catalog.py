@@ -3,9 +3,9 @@
 table_catalog module - TableCatalog implementation
 
 TableCatalog class scans and caches the layout of the <table>/tablets
-directory structure into a fast bitmap+list data structure pickled in
-<table>/tablet_tree.pkl file. These are used by Table.get_cells() routine to
-substantially speed up the cell scan.
+directory structure into a fast bitmap+list data structure stored in
+the catalog.bin file of each snapshot. These are used by Table.get_cells()
+routine to substantially speed up the cell scan.
 
 On very large tables (e.g., ps1_det), this class accellerates the get_cells()
 ~ 40x (6 seconds instead of 240).
@@ -23,8 +23,12 @@ contains do:
 	  where (i, j) range from [0, W)
 	- If bmap[i, j] == 0, the cell is unpopulated
 	- If bmap[i, j] != 0, its value is an index, 'offs' into leaves.
-	- leaves[offs] is a (mjd, next) tuple, with mjd being the
-	  temporal coordinate of the cell.
+	- leaves[offs] is a (mjd, snap, cell_id, next, nmain, ncached)
+	  tuple, with mjd being the temporal coordinate of the cell, snap
+	  the index of the snapshot where the cell is stored (in the list
+	  of snapshot IDs, snapids), and nmain and ncached the numbers of
+	  rows in the cell and in its neighbor cache (-1 if unknown, for
+	  cells committed by versions of LSD that didn't keep them).
 	- The absolute value of next is the offset to the next entry in
 	  leaves that is a temporal cell within this static cell (i.e., offs
 	  += abs(leaves[offs]['next']) will position you to the next cell).  Its
@@ -43,6 +47,34 @@ contains do:
 	  search of that entire subtree can be avoided). TableCatalog
 	  makes use of these 'mipmaps' to accelerate get_cells().
 
+Cell lookup:
+	- The snapshot of a given cell_id is looked up by a binary search
+	  of the sorted array of all cell_ids (cells). cell_leaf holds
+	  the index into leaves of each of them.
+
+File format:
+	- The catalog is stored in a binary, versioned, format that can be
+	  memory-mapped (so that a catalog loaded by many worker processes
+	  gets loaded only once): a magic string (including the format
+	  version), the length of the JSON header that follows it, and the
+	  header itself. The header lists the pixelization, the snapshot
+	  IDs, and the dtype, shape and offset of each of the arrays
+	  (leaves, cells, cell_leaf, and the mipmaps), stored after it. The
+	  zone maps are pickled at the end of the file, and only loaded if
+	  needed.
+	- Catalogs of older snapshots, pickled into catalog.pkl, are still
+	  read (see load()).
+
+Zone maps:
+	- For every cell with data, the catalog can also keep per-column
+	  statistics (min, max, number of NaNs) of the rows stored in the
+	  cell (excluding the neighbor cache). These are stored in a dict
+	  of cell_id -> { colname: (min, max, nnull) }, and saved together
+	  with the rest of the catalog. Query.execute uses them to skip
+	  cells for which a simple WHERE clause predicate (e.g., mag < 18)
+	  is provably false (see cell_excluded()). Table.rebuild_catalog()
+	  computes them for each newly committed cell.
+
 TODO:
 	- the catalog should be build/maintained whenever the database is
 	  modified. Modifications to Table._create_tablet and Table.append
@@ -53,8 +85,11 @@ TODO:
 """
 import logging
 import cPickle, os, glob
+import json
+import struct
 import tables
 import pool2
+import segments
 import numpy as np
 import bounds as bn
 import bhpix
@@ -68,6 +103,35 @@ logger = logging.getLogger('lsd.table_catalog')
 
 END_MARKER=0x7FFFFFFF
 
+# The leaves of the catalog (see the module docstring)
+LEAVES_DTYPE = [('mjd', '<f4'), ('snap', '<i4'), ('cell_id', '<u8'), ('next', '<i4'), ('nmain', '<i8'), ('ncached', '<i8')]
+
+# Binary catalog file format (see the module docstring): magic (with
+# the format version), followed by the length of the JSON header
+_magic = 'LSDCAT01'
+_prefix = struct.Struct('<8sQ')
+_align = 64
+
+# The arrays of the catalog that are memory-mapped when loaded
+_mmapped = ('_bmaps', '_leaves', '_cells', '_cell_leaf')
+
+def _aligned(offset):
+	return (offset + _align - 1) // _align * _align
+
+def _dtype_from_json(descr):
+	if isinstance(descr, list):
+		return np.dtype([ (str(name), str(typ)) for (name, typ) in descr ])
+	return np.dtype(str(descr))
+
+def _upgrade_leaves(old):
+	# Convert the leaves of catalogs stored by older versions of LSD
+	# to LEAVES_DTYPE. Missing columns (i.e., the row counts) are set
+	# to -1 (unknown).
+	leaves = np.empty(len(old), dtype=LEAVES_DTYPE)
+	for name in leaves.dtype.names:
+		leaves[name] = old[name] if name in old.dtype.names else -1
+	return leaves
+
 def _add_bounds(outcells, cell_id, xybounds, tbounds):
 	# cells is a dictionary of cell_id -> dict objects,
 	# where each dict object is another dictionary of xybounds -> tbounds
@@ -90,6 +154,38 @@ def _get_cells_kernel(ij, lev, cc, bounds):
 		cc._get_cells_recursive(cells, bounds_xy, bounds_t, i, j, lev, bhpix.pix_size(lev))
 	yield cells
 
+def tablet_nrows(fn):
+	""" Return the numbers of rows (nmain, ncached) in the main group
+	    and in the neighbor cache of the tablet fn. Delta segments
+	    (see segments.py) are merged with the segments preceding
+	    them.
+	"""
+	segs = []
+	try:
+		while True:
+			fp = tables.openFile(fn)
+			segs.insert(0, fp)
+			if not segments.is_delta(fp):
+				break
+			fn = _segment_path(fn, segments.base_of(fp))
+
+		return tuple( segments.nrows(segments.row_groups(segs, group)) for group in ['main', 'cached'] )
+	finally:
+		for fp in segs:
+			fp.close()
+
+def _segment_path(fn, snapid):
+	# The path of the tablet fn in snapshot snapid
+	at = fn.rfind('/tablets/')
+	snapshot_path = fn[:at]
+	if os.path.basename(os.path.dirname(snapshot_path)) == 'snapshots':
+		table_path = os.path.dirname(os.path.dirname(snapshot_path))
+	else:
+		table_path = snapshot_path
+	if str(snapid) == "0":
+		snapid = 0
+	return get_snapshot_path(table_path, snapid) + fn[at:]
+
 def _scan_recursive_kernel(xy, lev, cc):
 	x, y = xy
 
@@ -99,6 +195,53 @@ def _scan_recursive_kernel(xy, lev, cc):
 
 	yield bmap
 
+def zonemap_for_rows(rows, columns=None):
+	""" Compute the zone map (a dict of colname -> (min, max, nnull))
+	    for a structured ndarray of rows.
+
+	    Only scalar numeric and boolean columns are considered. NaNs
+	    are ignored when computing min/max, and their number is
+	    stored as nnull. If all values are NaN, min and max are set to
+	    None.
+	"""
+	zmap = dict()
+	if not len(rows):
+		return zmap
+
+	for name in (rows.dtype.names if columns is None else columns):
+		col = rows[name]
+		if col.dtype.kind not in 'biuf' or col.ndim != 1:
+			continue
+
+		if col.dtype.kind == 'f':
+			isnan = np.isnan(col)
+			nnull = int(isnan.sum())
+			if nnull:
+				col = col[~isnan]
+		else:
+			nnull = 0
+
+		if len(col):
+			zmap[name] = (col.min().item(), col.max().item(), nnull)
+		else:
+			zmap[name] = (None, None, nnull)
+
+	return zmap
+
+def _predicate_is_false(stats, op, val):
+	# Return True if the comparison 'column <op> val' is
+	# false for all rows summarized by stats
+	(lo, hi, _) = stats
+	if lo is None:
+		return True	# All NaNs -- any comparison will be false
+
+	if   op == '<':  return not (lo <  val)
+	elif op == '<=': return not (lo <= val)
+	elif op == '>':  return not (hi >  val)
+	elif op == '>=': return not (hi >= val)
+	elif op == '==': return not (lo <= val <= hi)
+	return False
+
 def iter_siblings(a, at):
 	# Iterate through a linked list
 	offs = 0
@@ -138,8 +281,15 @@ def isnapshots(table_path, return_path=False, first=None, last=None, no_first=Fa
 
 class TableCatalog:
 	_bmaps = None
-	_leaves = None
+	_leaves = None		# See LEAVES_DTYPE
+	_snapids = None		# Snapshot IDs, indexed by leaves['snap']
+	_cells = None		# Sorted cell_ids of all leaves
+	_cell_leaf = None	# Index into leaves of each of _cells
 	_pix = None
+	_zonemaps = None	# cell_id -> { colname: (min, max, nnull) }, None if not loaded yet
+
+	_fn = None		# The file the catalog was loaded from, if unmodified since
+	_zonemaps_at = None	# (offset, length) of the pickled zone maps in _fn
 	
 	#################
 
@@ -168,7 +318,7 @@ class TableCatalog:
 			xybounds = None if(bounds_xy.area() == box.area()) else bounds_xy
 			next = 0
 			while next != END_MARKER:
-				(t, _, _, next) = self._leaves[offs]
+				(t, _, _, next, _, _) = self._leaves[offs]
 				has_data = next > 0
 				next = abs(next)
 				if next != END_MARKER:	# Not really necessary, but numpy warns of overflow otherwise.
@@ -236,14 +386,13 @@ class TableCatalog:
 		else:
 			# Multi-process implementation (appears to be as good or better than single thread in
 			# nearly all cases of interest)
-			pool = pool2.Pool()
 			lev = min(4, self._pix.level)
 			ij = np.indices((2**lev,2**lev)).reshape(2, -1).T # List of i,j coordinates
-			for cells_ in pool.imap_unordered(ij, _get_cells_kernel, (lev, self, bounds), progress_callback=pool2.progress_pass):
-				for cell_id, b in cells_.iteritems():
-					for xyb, tb in b.iteritems():
-						_add_bounds(cells, cell_id, xyb, tb)
-			del pool
+			with pool2.shared_pool() as pool:
+				for cells_ in pool.imap_unordered(ij, _get_cells_kernel, (lev, self, bounds), progress_callback=pool2.progress_pass):
+					for cell_id, b in cells_.iteritems():
+						for xyb, tb in b.iteritems():
+							_add_bounds(cells, cell_id, xyb, tb)
 
 		if len(cells):
 			# Transform (x, y, t) tuples to cell_ids
@@ -260,20 +409,93 @@ class TableCatalog:
 
 	def get_cells_in_snapshot(self, snapid, include_cached=True):
 		""" Return a list of cells that are physically stored in snapshot snapid """
-		keep = self._leaves['snapid'] == snapid
+		try:
+			snap = self._snapids.index(snapid)
+		except ValueError:
+			return np.empty(0, dtype=np.uint64)
+
+		keep = self._leaves['snap'] == snap
 		if not include_cached:
 			keep &= self._leaves['next'] > 0
 		cells = self._leaves['cell_id'][keep]
 		return cells
 
 	def snapshot_of_cell(self, cell_id):
-		try:
-			return self._cell_to_snapshot[cell_id]
-		except KeyError:
+		cell_id = np.uint64(cell_id)
+		at = np.searchsorted(self._cells, cell_id)
+		if at == len(self._cells) or self._cells[at] != cell_id:
 			raise LookupError()
 
+		return self._snapids[self._leaves['snap'][self._cell_leaf[at]]]
+
+	def get_nrows(self, cell_id):
+		""" Return the numbers of rows (nmain, ncached) in cell_id
+		    and in its neighbor cache (-1 if unknown). Raise
+		    LookupError if the cell is not in the catalog.
+		"""
+		cell_id = np.uint64(cell_id)
+		at = np.searchsorted(self._cells, cell_id)
+		if at == len(self._cells) or self._cells[at] != cell_id:
+			raise LookupError()
+
+		leaf = self._leaves[self._cell_leaf[at]]
+		return int(leaf['nmain']), int(leaf['ncached'])
+
+	def _get_zonemaps(self):
+		# Zone maps of a catalog loaded from a file are unpickled
+		# on first use
+		if self._zonemaps is None:
+			(offset, length) = self._zonemaps_at
+			with open(self._fn, 'rb') as fp:
+				fp.seek(offset)
+				self._zonemaps = cPickle.loads(fp.read(length))
+		return self._zonemaps
+
+	def _detach(self):
+		# The catalog is about to be modified, and will no longer
+		# match the file it was loaded from
+		self._get_zonemaps()
+		self._fn = None
+
+	def set_zonemap(self, cell_id, zmap):
+		""" Store the zone map of cell_id (see zonemap_for_rows()) """
+		self._detach()
+		self._zonemaps[int(cell_id)] = zmap
+
+	def get_zonemap(self, cell_id):
+		""" Return the zone map of cell_id, or None if unknown """
+		return self._get_zonemaps().get(cell_id, None)
+
+	def cell_excluded(self, cell_id, predicates):
+		""" Return True if the zone map of cell_id proves that
+		    at least one of the predicates is false for all rows
+		    in the cell.
+
+		    predicates must be a list of (colname, op, value)
+		    tuples, where op is one of <, <=, >, >=, ==. Cells
+		    without a zone map (or columns without statistics)
+		    are never excluded.
+		"""
+		zmap = self._get_zonemaps().get(cell_id, None)
+		if not zmap:
+			return False
+
+		for (name, op, val) in predicates:
+			if name in zmap and _predicate_is_false(zmap[name], op, val):
+				return True
+
+		return False
+
 	#################
 
+	def _siblings(self, offs):
+		""" Iterate through the (mjd, snapid, cell_id, next, nmain,
+		    ncached) entries of the temporal siblings whose list
+		    begins at offs.
+		"""
+		for (mjd, snap, cell_id, next, nmain, ncached) in iter_siblings(self._leaves, offs):
+			yield (mjd, self._snapids[snap], cell_id, next, nmain, ncached)
+
 	def _get_temporal_siblings(self, path, pattern):
 		""" Given a cell_id, get all sibling temporal cells (including the static
 		    sky cell) that exist in it.
@@ -316,29 +538,24 @@ class TableCatalog:
 			for snapid, path in paths:
 				for tcell, fn in self._get_temporal_siblings(path, self.__pattern):
 					if tcell not in siblings: # Add only if there's no newer version
-						# check if there are any non-cached data in here
-						try:
-							with tables.openFile(fn) as fp:
-								has_data = len(fp.root.main.table) > 0
-						except tables.exceptions.NoSuchNodeError:
-							has_data = False
-						
-						siblings[tcell] = snapid, has_data
+						# count the rows (and the neighbor cache) in here
+						nmain, ncached = tablet_nrows(fn)
+						siblings[tcell] = snapid, nmain > 0, nmain, ncached
 
 			# Add any relevant pre-existing data
 			offs = self._bmaps[self._pix.level][i, j]
 			if offs != 0:
-				for mjd, snapid, _, next in iter_siblings(self._leaves, offs):
+				for mjd, snapid, _, next, nmain, ncached in self._siblings(offs):
 					if mjd not in siblings:
-						siblings[mjd] = snapid, next > 0
+						siblings[mjd] = snapid, next > 0, nmain, ncached
 
 			# Add this list to bitmap
 			assert bmap[i, j] == 0
-			bmap[i, j] = [ (tcell, snapid, self._pix._cell_id_for_xyt(x, y, tcell), has_data) for (tcell, (snapid, has_data)) in siblings.iteritems() ]
+			bmap[i, j] = [ (tcell, snapid, self._pix._cell_id_for_xyt(x, y, tcell), has_data, nmain, ncached) for (tcell, (snapid, has_data, nmain, ncached)) in siblings.iteritems() ]
 
 	def _update(self, table_path, snapid):
 		# Find what we already have loaded
-		prevsnap = np.max(self._leaves['snapid']) if len(self._leaves) > 2 else None
+		prevsnap = max(self._snapids) if self._snapids else None
 		assert prevsnap <= snapid, "Cannot update a catalog to an older snapshot"
 
 		## Enumerate all existing snapshots older or equal to snapid, and newer than prevsnap, and sort them, newest first
@@ -359,60 +576,96 @@ class TableCatalog:
 		w2 = 1 << (lev-1)
 		x, y =  (i - w2 + 0.5)*dx, (j - w2 + 0.5)*dx
 
-		pool = pool2.Pool()
-		for bmap2 in pool.imap_unordered(zip(x, y), _scan_recursive_kernel, (lev, self)):
-			assert not np.any((bmap != 0) & (bmap2 != 0))
-			mask = bmap2 != 0
-			bmap[mask] = bmap2[mask]
-		del pool
-
-		# Add data about cells that were not touched by this update
-		bmap_cur = self._bmaps[self._pix.level]
-		mask_cur = (bmap_cur != 0) & (bmap == 0)
-		lists_cur = [ [ (mjd, snapid, cell_id, next > 0) for (mjd, snapid, cell_id, next) in iter_siblings(self._leaves, offs) ] for offs in bmap_cur[mask_cur] ]
-		try:
-			bmap[mask_cur] = lists_cur
-		except ValueError:
-			# Workaround for a numpy 1.6.0 bug (http://projects.scipy.org/numpy/ticket/1870)
-			coords = np.mgrid[0:w,0:w][:,mask_cur].T	# List of coordinates corresponding to True entries in mask_cur
-			for (ii, jj), vv in izip(coords, lists_cur):
-				bmap[ii, jj] = vv
-
-		# Repack the temporal siblings to a single numpy array, emulating a linked list
-		lists = bmap[bmap != 0]
-		llens = np.fromiter( (len(l) for l in lists), dtype=np.int32 )
-		leaves = np.empty(np.sum(llens)+2, dtype=[('mjd', 'f4'), ('snapid', object), ('cell_id', 'u8'), ('next', 'i4')])
-		leaves[:2] = [(np.inf, 0, 0, END_MARKER)]*2	# We start with two dummy entries, so that offs=0 and 1 are invalid and can take other meanings.
-		seen = dict()
-		at = 2
-		for l in lists:
-			last_i = len(l) - 1
-			for (i, (mjd, snapid, cell_id, has_data)) in enumerate(l):
-				# Make equal strings refer to the same string object
-				try:
-					snapid = seen[snapid]
-				except KeyError:
-					seen[snapid] = snapid
-
-				next = 1 if has_data else -1
-				if i == last_i:
-					next *= END_MARKER
-
-				leaves[at] = (mjd, snapid, cell_id, next)
-				at += 1
+		with pool2.shared_pool() as pool:
+			for bmap2 in pool.imap_unordered(zip(x, y), _scan_recursive_kernel, (lev, self)):
+				assert not np.any((bmap != 0) & (bmap2 != 0))
+				mask = bmap2 != 0
+				bmap[mask] = bmap2[mask]
+
+		return self._pack(bmap)
+
+	def _pack(self, bmap):
+		# Given a (w x w) object array with the lists of (mjd, snapid,
+		# cell_id, has_data, nmain, ncached) tuples of the updated
+		# static cells (including their pre-existing siblings), return
+		# the new (bmaps, leaves, snapids)
+		touched = np.flatnonzero(bmap != 0)
+		lists = bmap.flat[touched]
+		llens = np.fromiter( (len(l) for l in lists), dtype=np.int64, count=len(lists) )
+		entries = [ entry for l in lists for entry in l ]
+		mjd, snapids, cell_ids, has_data, nmain, ncached = zip(*entries) if entries else ((),)*6
+
+		# Intern the snapshot IDs
+		ids = sorted(set(snapids))
+		snaps = dict( (snapid, snap) for (snap, snapid) in enumerate(ids) )
+		snap = np.fromiter( (snaps[snapid] for snapid in snapids), dtype=np.int32, count=len(snapids) )
+
+		keep = ~np.in1d(self._leaf_pixels(), touched)
+		return self._merge(keep, ids, np.repeat(touched, llens), np.array(mjd, dtype='f4'), snap, np.array(cell_ids, dtype=np.uint64),
+			np.array(has_data, dtype=bool), np.array(nmain, dtype=np.int64), np.array(ncached, dtype=np.int64))
+
+	def _leaf_pixels(self):
+		# The flat index into the base bitmap of the static cell of
+		# each leaf (but the two dummy entries). The temporal siblings
+		# of a static cell are consecutive in leaves (see _merge)
+		bmap = np.asarray(self._bmaps[self._pix.level]).ravel()
+		pix = np.flatnonzero(bmap)
+		heads = bmap[pix]
+		order = np.argsort(heads)
+		return pix[order][np.searchsorted(heads[order], np.arange(2, len(self._leaves)), side='right') - 1]
+
+	def _merge(self, keep, snapids, pix, mjd, snap, cell_id, has_data, nmain, ncached):
+		# Merge the leaves of the catalog selected by the boolean mask
+		# keep with the new leaves given by arrays of the flat index of
+		# their static cell in the base bitmap (pix), mjd, snap (indices
+		# into the list snapids), cell_id, has_data and the row counts.
+		# Returns the new (bmaps, leaves, snapids).
+		old = self._leaves[2:][keep]
+		pix = np.concatenate((self._leaf_pixels()[keep], pix))
+		mjd = np.concatenate((old['mjd'], mjd))
+		cell_id = np.concatenate((old['cell_id'], cell_id))
+		has_data = np.concatenate((old['next'] > 0, has_data))
+		nmain = np.concatenate((old['nmain'], nmain))
+		ncached = np.concatenate((old['ncached'], ncached))
+
+		# Intern the snapshot IDs, keeping only those still referred to
+		canon = dict()
+		remap = np.array([ canon.setdefault(snapid, len(canon)) for snapid in list(self._snapids) + list(snapids) ], dtype=np.int32)
+		snap = remap[np.concatenate((old['snap'], np.asarray(snap, dtype=np.int32) + len(self._snapids)))]
+		used, snap = np.unique(snap, return_inverse=True)
+		ids = sorted(canon, key=canon.get)
+		snapids = [ ids[k] for k in used ]
+
+		# Lay out the temporal siblings of each static cell
+		# consecutively, emulating a linked list
+		order = np.lexsort((cell_id, pix))
+		pix = pix[order]
+		n = len(pix)
+		leaves = np.empty(n+2, dtype=LEAVES_DTYPE)
+		leaves[:2] = [(np.inf, -1, 0, END_MARKER, 0, 0)]*2	# We start with two dummy entries, so that offs=0 and 1 are invalid and can take other meanings.
+		leaves['mjd'][2:] = mjd[order]
+		leaves['snap'][2:] = snap[order]
+		leaves['cell_id'][2:] = cell_id[order]
+		leaves['nmain'][2:] = nmain[order]
+		leaves['ncached'][2:] = ncached[order]
+
+		last = np.ones(n, dtype=bool)
+		last[:-1] = pix[1:] != pix[:-1]
+		next = np.where(last, END_MARKER, 1).astype(np.int32)
+		next[~has_data[order]] *= -1
+		leaves['next'][2:] = next
 
 		# Construct bmap that has offsets to head of the linked list of siblings
-		offs     = np.zeros(len(llens), dtype=np.int64)
-		offs[1:] = np.cumsum(llens)[:-1]
-		offs     += 2				# Pointers to beginnings of individual lists
-		assert np.all(abs(leaves['next'][offs-1]) == END_MARKER)
-		obmap = np.zeros(bmap.shape, dtype=np.int32)
-		obmap[bmap != 0] = offs
+		first = np.ones(n, dtype=bool)
+		first[1:] = last[:-1]
+		w = bhpix.width(self._pix.level)
+		obmap = np.zeros(w*w, dtype=np.int32)
+		obmap[pix[first]] = np.flatnonzero(first) + 2
 
 		# Recompute mipmaps
-		bmaps = self._compute_mipmaps(obmap)
+		bmaps = self._compute_mipmaps(obmap.reshape(w, w))
 
-		return bmaps, leaves
+		return bmaps, leaves, snapids
 
 	def _compute_mipmaps(self, bmap):
 		# Create mip-maps
@@ -430,32 +683,219 @@ class TableCatalog:
 		return bmaps
 
 	def _rebuild_internal_state(self):
-		self._cell_to_snapshot = dict(v for v in izip(self._leaves['cell_id'][2:], self._leaves['snapid'][2:]))
-		assert len(self._cell_to_snapshot) == len(self._leaves)-2, (len(self._cell_to_snapshot), len(self._leaves))
+		# Index the leaves by cell_id (see snapshot_of_cell)
+		cell_ids = self._leaves['cell_id'][2:]
+		order = np.argsort(cell_ids, kind='mergesort')
+		self._cells = cell_ids[order]
+		self._cell_leaf = (order + 2).astype(np.int32)
+		assert not np.any(self._cells[1:] == self._cells[:-1]), "Duplicate cells in the catalog"
 
 	def update(self, table_path, pattern, snapid):
 		self.__pattern = pattern
 
-		self._bmaps, self._leaves = self._update(table_path, snapid)
+		self._detach()
+		self._bmaps, self._leaves, self._snapids = self._update(table_path, snapid)
+		self._rebuild_internal_state()
+
+	def add_tablets(self, snapid, cell_ids, nmain, ncached):
+		""" Add the cells whose tablets were written in snapshot
+		    snapid, without rescanning the tablets directory tree.
+
+		    cell_ids must be an array of (unique) cell_ids, and nmain
+		    and ncached arrays with the numbers of rows in each cell
+		    and in its neighbor cache, or -1 where these are unchanged
+		    from the version of the cell already in the catalog. The
+		    cells replace any older versions of the same cells in the
+		    catalog.
+		"""
+		if not len(cell_ids):
+			return
+		self._detach()
+
+		cell_ids = np.asarray(cell_ids, dtype=np.uint64)
+		nmain = np.asarray(nmain, dtype=np.int64)
+		ncached = np.asarray(ncached, dtype=np.int64)
+		x, y, t = self._pix._xyt_from_cell_id(cell_ids)
+
+		# Locate the static cells in the bitmap (see _scan_recursive)
+		w = bhpix.width(self._pix.level)
+		dx = bhpix.pix_size(self._pix.level)
+		ii = (x // dx + w // 2).astype(np.int64)
+		jj = (y // dx + w // 2).astype(np.int64)
+
+		# Inherit what's unchanged from the replaced versions of the
+		# cells (nothing, for new cells)
+		prev = np.zeros(len(cell_ids), dtype=LEAVES_DTYPE)
+		if len(self._cells):
+			at = np.minimum(np.searchsorted(self._cells, cell_ids), len(self._cells) - 1)
+			known = self._cells[at] == cell_ids
+			prev[known] = self._leaves[self._cell_leaf[at[known]]]
+		has_data = np.where(nmain < 0, prev['next'] > 0, nmain > 0)
+		nmain = np.where(nmain < 0, prev['nmain'], nmain)
+		ncached = np.where(ncached < 0, prev['ncached'], ncached)
+
+		keep = ~np.in1d(self._leaves['cell_id'][2:], cell_ids)
+		snap = np.zeros(len(cell_ids), dtype=np.int32)
+		self._bmaps, self._leaves, self._snapids = self._merge(keep, [ snapid ], ii*w + jj, t, snap, cell_ids, has_data, nmain, ncached)
 		self._rebuild_internal_state()
 
+	def set_nrows(self, cell_ids, nmain, ncached):
+		""" Set the numbers of rows in cells cell_ids, and in their
+		    neighbor caches (e.g., for cells whose counts are
+		    unknown).
+		"""
+		self._detach()
+		self._leaves = np.array(self._leaves)	# May be a read-only memmap
+
+		at = self._cell_leaf[np.searchsorted(self._cells, np.asarray(cell_ids, dtype=np.uint64))]
+		assert np.all(self._leaves['cell_id'][at] == cell_ids)
+		self._leaves['nmain'][at] = nmain
+		self._leaves['ncached'][at] = ncached
+
+	def get_row_counts(self):
+		""" Return the arrays (cell_ids, snapids, nmain, ncached) of
+		    all cells in the catalog, with the snapshots the cells are
+		    stored in, and the numbers of rows in each cell and in its
+		    neighbor cache (-1 if unknown).
+		"""
+		leaves = self._leaves[2:]
+		snapids = np.array(self._snapids + [ None ], dtype=object)[leaves['snap']]
+		return leaves['cell_id'], snapids, leaves['nmain'], leaves['ncached']
+
+	def nrows(self, include_cached=False):
+		""" Return the total number of rows in all cells (including
+		    the neighbor caches, if include_cached=True), or None if
+		    the row counts of some cells are unknown.
+		"""
+		leaves = self._leaves[2:]
+		names = ['nmain', 'ncached'] if include_cached else ['nmain']
+		if any(np.any(leaves[name] < 0) for name in names):
+			return None
+		return sum(int(leaves[name].sum()) for name in names)
+
+	def _arrays(self):
+		# The arrays stored in the catalog file, by name
+		arrays = [ ('leaves', self._leaves), ('cells', self._cells), ('cell_leaf', self._cell_leaf) ]
+		arrays += [ ('bmap%d' % lev, self._bmaps[lev]) for lev in xrange(self._pix.level+1) ]
+		return arrays
+
 	def save(self, fn):
+		""" Store the catalog into file fn, in the binary format
+		    described in the module docstring.
+		"""
 		dir = os.path.dirname(os.path.normpath(fn))
 		if dir != '':
 			utils.mkdir_p(dir)
-		cPickle.dump((self._bmaps, self._leaves, self._pix), file(fn, mode='w'), -1)
+
+		zonemaps = cPickle.dumps(self._get_zonemaps(), -1)
+
+		# Lay out the arrays, followed by the zone maps
+		specs, offset = dict(), 0
+		for name, a in self._arrays():
+			dtype = a.dtype.descr if a.dtype.names else a.dtype.str
+			specs[name] = { 'dtype': dtype, 'shape': a.shape, 'offset': offset }
+			offset = _aligned(offset + a.nbytes)
+		hdr = {
+			'pix': { 'level': int(self._pix.level), 't0': float(self._pix.t0), 'dt': float(self._pix.dt) },
+			'snapids': self._snapids,
+			'arrays': specs,
+			'zonemaps': (offset, len(zonemaps))
+		}
+		hdr = json.dumps(hdr)
+		data = _aligned(_prefix.size + len(hdr))
+
+		tmp = fn + '.tmp'
+		with open(tmp, 'wb') as fp:
+			fp.write(_prefix.pack(_magic, len(hdr)))
+			fp.write(hdr)
+			for name, a in self._arrays():
+				fp.seek(data + specs[name]['offset'])
+				np.ascontiguousarray(a).tofile(fp)
+			fp.seek(data + offset)
+			fp.write(zonemaps)
+		os.rename(tmp, fn)
 
 	def load(self, fn):
-		self._bmaps, self._leaves, self._pix = cPickle.load(file(fn))
+		""" Load the catalog from file fn. The arrays of catalogs
+		    in the binary format are memory-mapped; catalogs pickled
+		    by older versions of LSD (catalog.pkl) are read into
+		    memory.
+		"""
+		with open(fn, 'rb') as fp:
+			prefix = fp.read(_prefix.size)
+		if len(prefix) == _prefix.size and prefix[:len(_magic)] == _magic:
+			self._map(fn)
+		else:
+			self._load_pickle(fn)
+
+	def _map(self, fn):
+		# Memory-map the catalog stored in the binary format
+		with open(fn, 'rb') as fp:
+			magic, hlen = _prefix.unpack(fp.read(_prefix.size))
+			hdr = json.loads(fp.read(hlen))
+		data = _aligned(_prefix.size + hlen)
+
+		pix = hdr['pix']
+		self._pix = Pixelization(pix['level'], pix['t0'], pix['dt'])
+		self._snapids = [ snapid if snapid == 0 else str(snapid) for snapid in hdr['snapids'] ]
+
+		arrays = dict()
+		for name, spec in hdr['arrays'].iteritems():
+			dtype, shape = _dtype_from_json(spec['dtype']), tuple(spec['shape'])
+			if all(shape):
+				arrays[name] = np.memmap(fn, dtype=dtype, mode='r', offset=data + spec['offset'], shape=shape)
+			else:
+				arrays[name] = np.empty(shape, dtype=dtype)
+		self._leaves, self._cells, self._cell_leaf = arrays['leaves'], arrays['cells'], arrays['cell_leaf']
+		if self._leaves.dtype != np.dtype(LEAVES_DTYPE):
+			self._leaves = _upgrade_leaves(self._leaves)
+		self._bmaps = dict( (lev, arrays['bmap%d' % lev]) for lev in xrange(self._pix.level+1) )
+
+		offset, length = hdr['zonemaps']
+		self._zonemaps, self._zonemaps_at = None, (data + offset, length)
+		self._fn = fn
+
+	def _load_pickle(self, fn):
+		# Backwards compatibility: catalogs pickled by older versions
+		# of LSD, storing the snapshot IDs in the leaves
+		data = cPickle.load(file(fn))
+		bmaps, leaves, self._pix = data[:3]
+		self._zonemaps = data[3] if len(data) > 3 else dict()	# Catalogs saved before zone maps were introduced
+		self._fn = None
+
+		self._bmaps = dict( (lev, bmap.astype(np.int32) if lev == self._pix.level else bmap) for lev, bmap in bmaps.iteritems() )
+		self._snapids = sorted(set(leaves['snapid'][2:]))
+		snaps = dict( (snapid, snap) for (snap, snapid) in enumerate(self._snapids) )
+		self._leaves = _upgrade_leaves(leaves)
+		self._leaves['snap'][:2] = -1
+		self._leaves['snap'][2:] = [ snaps[snapid] for snapid in leaves['snapid'][2:] ]
 
 		self._rebuild_internal_state()
 
+	def __getstate__(self):
+		# A catalog unmodified since it was loaded is pickled (e.g.,
+		# to be passed to pool2 workers) by reference to its file,
+		# that the receiving process memory-maps
+		state = self.__dict__.copy()
+		if self._fn is not None:
+			for name in _mmapped + ('_zonemaps',):
+				state.pop(name, None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		if self._fn is not None:
+			self._map(self._fn)
+
 	def clear(self):
 		# Initialize an empty table
 		w = bhpix.width(self._pix.level)
-		self._bmaps = self._compute_mipmaps(np.zeros((w, w), dtype=object))
-		self._leaves = np.empty(2, dtype=[('mjd', 'f4'), ('snapid', object), ('cell_id', 'u8'), ('next', 'i4')])
-		self._leaves[:2] = [(np.inf, 0, 0, END_MARKER)]*2
+		self._bmaps = self._compute_mipmaps(np.zeros((w, w), dtype=np.int32))
+		self._leaves = np.empty(2, dtype=LEAVES_DTYPE)
+		self._leaves[:2] = [(np.inf, -1, 0, END_MARKER, 0, 0)]*2
+		self._snapids = []
+		self._zonemaps = dict()
+		self._fn = None
 		
 		self._rebuild_internal_state()
 
@@ -487,24 +927,25 @@ class TableCatalog:
 
 		# Compare the temporal siblings in each bitmap
 		for offs1, offs2 in izip(bmap1[bmap1 > 1], bmap2[bmap2 > 1]):
-			list1 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _) in iter_siblings(self._leaves, offs1))
-			list2 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _) in iter_siblings(b._leaves,    offs2))
+			list1 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _, _, _) in self._siblings(offs1))
+			list2 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _, _, _) in b._siblings(offs2))
 			if list1 != list2:
 				return False
 
-		# Compare _leaves, all columns but 'next'
-		if self._leaves.dtype != b._leaves.dtype:
+		# Compare the leaves, with the snapshot indices (that
+		# depend on the order of interning) resolved to snapshot IDs
+		def leaves(cc):
+			return sorted( (mjd, cc._snapids[snap], cell_id, next > 0) for (mjd, snap, cell_id, next, _, _) in cc._leaves[2:] )
+		if leaves(self) != leaves(b):
 			return False
-		names = [ name for name in self._leaves.dtype.names if name != 'next' ]
-		s1 = np.sort(self._leaves, order=names)
-		s2 = np.sort(b._leaves,    order=names)
-		for name in names:
-			if not np.all(s1[name] == s2[name]):
-				return False
 
-		# Compare the signs of the 'next' column (== has_data)
-		if not np.all((s1['next'] > 0) == (s2['next'] > 0)):
-			return False
+		# Compare the row counts known to both
+		s1 = np.sort(self._leaves[2:], order='cell_id')
+		s2 = np.sort(b._leaves[2:],    order='cell_id')
+		for name in ['nmain', 'ncached']:
+			known = (s1[name] >= 0) & (s2[name] >= 0)
+			if not np.all(s1[name][known] == s2[name][known]):
+				return False
 
 		# The two objects are identical
 		return True
@@ -524,7 +965,9 @@ def check_table_catalog(table_path, pattern, snapid=None):
 	snapshots = dict(isnapshots(table_path, return_path=True))
 	if snapid is None:
 		snapid = max(snapshots.keys())
-	fn = os.path.join(snapshots[snapid], 'catalog.pkl')
+	fn = os.path.join(snapshots[snapid], 'catalog.bin')
+	if not os.path.exists(fn):
+		fn = os.path.join(snapshots[snapid], 'catalog.pkl')
 	cc1 = TableCatalog(fn=fn)
 
 	# Construct one from scratch
@@ -533,6 +976,110 @@ def check_table_catalog(table_path, pattern, snapid=None):
 
 	assert cc1 == cc2
 
+############ Unit tests
+
+class Test_TableCatalog:
+	def setUp(self):
+		import tempfile
+		self.tmpdir = tempfile.mkdtemp()
+		self.pix = Pixelization(7, 54335, 1)
+
+		# Five static cells, and two temporal cells in the first of them
+		ra, dec = np.array([10., 50., 120., 200., 300.]), np.array([20., -30., 60., 0., -75.])
+		self.cells = [ self.pix.cell_id_for_pos(r, d) for (r, d) in zip(ra, dec) ]
+		self.cells += [ self.pix.cell_id_for_pos(ra[0], dec[0], t) for t in [55000.5, 55001.5] ]
+		self.cells = np.array(self.cells, dtype=np.uint64)
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tmpdir)
+
+	def _catalog(self):
+		# A catalog of cells written in two snapshots
+		cc = TableCatalog(pix=self.pix)
+		cc.add_tablets('20110101000000.000000', self.cells[:4], [10, 20, 30, 0], [1, 2, 3, 4])
+		cc.add_tablets('20110102000000.000000', self.cells[2:], [-1, 40, 50, 60, 70], [5, -1, 6, 7, 8])
+		return cc
+
+	def test_add_tablets(self):
+		""" Table catalog: cells added in consecutive snapshots """
+		cc = self._catalog()
+		s1, s2 = '20110101000000.000000', '20110102000000.000000'
+		assert [ cc.snapshot_of_cell(cell_id) for cell_id in self.cells ] == [ s1, s1 ] + [ s2 ]*5
+		assert sorted(cc.get_cells_in_snapshot(s1)) == sorted(self.cells[:2])
+		assert sorted(cc.get_cells_in_snapshot(s2)) == sorted(self.cells[2:])
+
+		# Counts of -1 are inherited from the replaced versions of the cells
+		nrows = [ cc.get_nrows(cell_id) for cell_id in self.cells ]
+		assert nrows == [ (10, 1), (20, 2), (30, 5), (40, 4), (50, 6), (60, 7), (70, 8) ], nrows
+		assert cc.nrows() == 280 and cc.nrows(include_cached=True) == 313
+
+		# A cell with only a neighbor cache isn't a cell with data
+		cc.add_tablets('20110103000000.000000', self.cells[4:5], [0], [9])
+		assert list(cc.get_cells_in_snapshot('20110103000000.000000', include_cached=False)) == []
+		assert list(cc.get_cells_in_snapshot('20110103000000.000000')) == list(self.cells[4:5])
+
+		cell_ids, snapids, nmain, ncached = cc.get_row_counts()
+		assert sorted(cell_ids) == sorted(self.cells) and len(set(snapids)) == 3
+
+		try:
+			cc.get_nrows(self.pix.cell_id_for_pos(100., 10.))
+		except LookupError:
+			pass
+		else:
+			assert 0, 'Expected a LookupError'
+
+	def test_save_load(self):
+		""" Table catalog: stored and memory-mapped """
+		cc = self._catalog()
+		zmap = { 'mag': (12., 19.5, 3) }
+		cc.set_zonemap(self.cells[0], zmap)
+
+		fn = os.path.join(self.tmpdir, 'catalog.bin')
+		cc.save(fn)
+		cc2 = TableCatalog(fn=fn)
+		assert isinstance(cc2._leaves, np.memmap)
+		assert cc2 == cc and cc2._snapids == cc._snapids
+		assert [ cc2.get_nrows(cell_id) for cell_id in self.cells ] == [ cc.get_nrows(cell_id) for cell_id in self.cells ]
+		assert cc2.get_zonemap(self.cells[0]) == zmap and cc2.get_zonemap(self.cells[1]) is None
+
+		# Pickled (e.g., to pool2 workers) by reference to the file
+		cc3 = cPickle.loads(cPickle.dumps(cc2, -1))
+		assert cc3 == cc and cc3.get_zonemap(self.cells[0]) == zmap
+
+		# Modified after loading, and stored again
+		cc2.add_tablets('20110103000000.000000', self.cells[:1], [11], [0])
+		cc2.save(fn)
+		cc4 = TableCatalog(fn=fn)
+		assert cc4 == cc2 and cc4 != cc
+		assert cc4.get_nrows(self.cells[0]) == (11, 0) and cc4.get_zonemap(self.cells[0]) == zmap
+
+	def test_pickle_migration(self):
+		""" Table catalog: catalogs pickled by older versions of LSD """
+		cc = self._catalog()
+
+		# The pickle-era layout: the snapshot IDs in the leaves, and no row counts
+		leaves = np.empty(len(cc._leaves), dtype=[('mjd', 'f4'), ('snapid', object), ('cell_id', 'u8'), ('next', 'i4')])
+		for name in ['mjd', 'cell_id', 'next']:
+			leaves[name] = cc._leaves[name]
+		leaves['snapid'][:2] = 0
+		leaves['snapid'][2:] = [ cc._snapids[snap] for snap in cc._leaves['snap'][2:] ]
+		fn = os.path.join(self.tmpdir, 'catalog.pkl')
+		cPickle.dump((cc._bmaps, leaves, self.pix), file(fn, mode='w'), -1)
+
+		old = TableCatalog(fn=fn)
+		assert old == cc
+		assert [ old.snapshot_of_cell(cell_id) for cell_id in self.cells ] == [ cc.snapshot_of_cell(cell_id) for cell_id in self.cells ]
+		assert old.get_nrows(self.cells[0]) == (-1, -1) and old.nrows() is None
+		assert old.get_zonemap(self.cells[0]) is None
+
+		# Migrated to the binary format
+		fn = os.path.join(self.tmpdir, 'catalog.bin')
+		old.set_nrows(self.cells, *zip(*[ cc.get_nrows(cell_id) for cell_id in self.cells ]))
+		old.save(fn)
+		new = TableCatalog(fn=fn)
+		assert new == cc and new.nrows(include_cached=True) == cc.nrows(include_cached=True)
+
 if __name__ == '__main__':
 	tpath = '/n/pan/mjuric/lsd_test5/ps1_det'
 	#check_table_catalog(tpath, 'ps1_det.astrometry.h5'); exit()
@@ -8,6 +8,8 @@ import numpy as np
 from itertools import izip
 import bhpix
 import sys
+import spatial_index
+import neighbors
 from utils import as_columns, gnomonic, gc_dist, unpack_callable
 from colgroup import ColGroup
 from join_ops import IntoWriter, DB
@@ -64,7 +66,30 @@ def _coverage_mapper(qresult, dx, filter):
 			sky2[0:len(idx)] = idx
 			sky = sky2.reshape((w, h))
 
-		yield (sky, imin, jmin)
+		yield 0, (sky, imin, jmin)
+
+def _sum_patches(patches):
+	# Sum a list of (patch, imin, jmin) partial sky maps into a map
+	# spanning their union
+	patches = list(patches)
+	imin = min(i for (_, i, _) in patches)
+	jmin = min(j for (_, _, j) in patches)
+	imax = max(i + patch.shape[0] for (patch, i, _) in patches)
+	jmax = max(j + patch.shape[1] for (patch, _, j) in patches)
+
+	sky = np.zeros((imax - imin, jmax - jmin))
+	for (patch, i, j) in patches:
+		sky[i - imin:i - imin + patch.shape[0], j - jmin:j - jmin + patch.shape[1]] += patch
+
+	return (sky, imin, jmin)
+
+def _coverage_combiner(kv):
+	key, patches = kv
+	yield key, _sum_patches(patches)
+
+def _coverage_reducer(kv):
+	_, patches = kv
+	yield _sum_patches(patches)
 
 def compute_coverage(db, query, dx = 0.5, bounds=None, include_cached=False, filter=None):
 	""" compute_coverage - produce a sky map of coverage, using
@@ -76,7 +101,10 @@ def compute_coverage(db, query, dx = 0.5, bounds=None, include_cached=False, fil
 
 	sky = np.zeros((width, height))
 
-	for (patch, imin, jmin) in db.query(query).execute([(_coverage_mapper, dx, filter)], bounds=bounds, include_cached=include_cached):
+	# The partial maps are summed within the workers (by the
+	# combiner) before being sent on to the reducer
+	kernels = [(_coverage_mapper, dx, filter), _coverage_reducer]
+	for (patch, imin, jmin) in db.query(query).execute(kernels, bounds=bounds, include_cached=include_cached, combiner=_coverage_combiner):
 		#print patch.shape, imin, jmin, sky.shape
 		sky[imin:imin + patch.shape[0], jmin:jmin + patch.shape[1]] += patch
 
@@ -87,17 +115,15 @@ def compute_coverage(db, query, dx = 0.5, bounds=None, include_cached=False, fil
 ###################################################################
 ## Count the number of objects in the table
 def ls_mapper(cell_id, db, tabname):
-	# return the number of rows in this chunk, keyed by the filename
-	try:
-		with db.table(tabname).lock_cell(cell_id) as cell:
-			with cell.open() as fp:
-				n = fp.root.main.table.nrows
-	except LookupError:
+	# return the number of rows in this cell (merging the delta
+	# segments of its tablet, if any)
+	table = db.table(tabname)
+	if not table.cell_exists(cell_id):
 		# This can occur when counting from cells in previous snapshots,
 		# and the cell in question was not populated there
 		return
 
-	yield n
+	yield table.main_nrows(cell_id)
 
 def compute_counts_aux(db, tabname, cells, progress_callback=None):
 	ntotal = 0
@@ -109,41 +135,20 @@ def compute_counts_aux(db, tabname, cells, progress_callback=None):
 	return ntotal
 
 def compute_counts(db, tabname, force=False):
+	""" Return the number of rows in table tabname. Unless force=True,
+	    it's the sum of the row counts of the cells kept in the
+	    table catalog (see TableCatalog.nrows). Otherwise (or if those
+	    aren't known), the rows of every cell are counted.
+	"""
+	table = db.table(tabname)
 	if not force:
-		# Use the saved count from previous snapshot, and
-		# just add the rows added by this one
-		assert db.in_transaction()
-
-		# Load the count that was valid before this transaction
-		db2 = DB(':'.join(db.path))
-		try:
-			nrows = db2.table(tabname).nrows()
-			new = False
-		except IOError:
-			# This is a new table
-			nrows = 0
-			new = True
-
-		# Fetch all cells modified by this transaction
-		cells = db.table(tabname).get_cells_in_snapshot(db.snapid)
-
-		if not new:
-			# Count up rows before modification
-			nrows_old = compute_counts_aux(db2, tabname, cells, progress_callback=pool2.progress_pct_nnl)
-		else:
-			nrows_old = 0
-
-		# Count up rows in modified cells
-		nrows_new = compute_counts_aux(db,  tabname, cells)
+		nrows = table.catalog.nrows()
+		if nrows is not None:
+			return nrows
 
-		# The new row count
-		nrows += nrows_new - nrows_old
-	else:
-		# Directly count everything
-		cells = db.table(tabname).get_cells()
-		nrows = compute_counts_aux(db, tabname, cells)
-
-	return nrows
+	# Directly count everything
+	cells = table.get_cells()
+	return compute_counts_aux(db, tabname, cells)
 
 ###################################################################
 
@@ -153,23 +158,89 @@ def commit_hook__build_neighbor_cache(db, table):
 	db.build_neighbor_cache(table.name, snapid=table.snapid)
 	print >> sys.stderr, "[%s] Updating tablet catalog:" % (table.name),
 	table.rebuild_catalog()
+
+###################################################################
+## Build the spatial indices used by crossmatches
+
+def _spatial_index_mapper(qresult, tabname):
+	# Index all rows of the cell (including the neighbor cache), in
+	# the order in which crossmatches load them
+	table = qresult.db.table(tabname)
+	blocks = [ rows for rows in qresult ]
+	if not blocks:
+		return
+
+	cell_id = blocks[0].info.cell_id
+	lon = np.concatenate([ rows['_LON'] for rows in blocks ])
+	lat = np.concatenate([ rows['_LAT'] for rows in blocks ])
+
+	clon, clat = spatial_index.cell_center(table.pix, cell_id)
+	spatial_index.GridIndex.build(lon, lat, clon, clat).save(spatial_index.index_path(table, cell_id, 'w'), table.snapid)
+
+	yield cell_id, len(lon)
+
+def build_spatial_index(db, tabname, snapid):
+	""" (Re)Build the spatial indices (see spatial_index.py) of
+	    the cells modified in snapshot snapid.
+	"""
+	table = db.table(tabname)
+	if table.get_spatial_keys() == (None, None):
+		print >>sys.stderr, "No spatial keys."
+		return
+
+	cells = table.get_cells_in_snapshot(snapid)
+	if len(cells) == 0:
+		print >>sys.stderr, "Already up to date."
+		return
+
+	ntotal = ncells = 0
+	for (_, nrows) in db.query("_LON, _LAT FROM '%s'" % tabname).execute(
+					[ (_spatial_index_mapper, tabname) ],
+					cells=cells, include_cached=True, progress_callback=pool2.progress_pass):
+		ntotal += nrows
+		ncells += 1
+	print >>sys.stderr, "%d objects in %d cells." % (ntotal, ncells)
+
+def commit_hook__build_spatial_index(db, table):
+	build_spatial_index(db, table.name, table.snapid)
+
+###################################################################
+## Fold the delta segments of tablets (see segments.py)
+
+def _compact_mapper(cell_id, db, tabname, min_segments):
+	yield db.table(tabname).compact_cell(cell_id, min_segments)
+
+def compact(db, tabname, min_segments=2):
+	""" Rewrite the tablets of the cells of table tabname that
+	    consist of min_segments or more segments as full tablets.
+	    Must be run within a transaction. Returns the number of
+	    cells that were compacted.
+	"""
+	cells = db.table(tabname).get_cells()
+
+	ncells = 0
+	pool = pool2.Pool()
+	for nsegs in pool.map_reduce_chain(cells, [(_compact_mapper, db, tabname, min_segments)], progress_callback=pool2.progress_pct):
+		ncells += nsegs != 0
+
+	return ncells
 ###################################################################
 
 ###################################################################
 ## Cross-match two tables
 
-def _xmatch_mapper(qresult, tabname_to, radius, tabname_xm, n_neighbors):
+def _xmatch_mapper(qresult, tabname_to, radius, tabname_xm, n_neighbors, nn=None):
 	"""
 	    Mapper:
-	    	- given all objects in a cell, make an ANN tree
-	    	- load all objects in tabname_to (including neighbors), make an ANN tree, find matches
+	    	- given all objects in a cell, load all objects in tabname_to
+	    	  (including neighbors), and their spatial index
+	    	- find matches
 	    	- store the output into an index table
 	"""
-	from scikits.ann import kdtree
-
 	db       = qresult.db
 	pix      = qresult.pix
 	table_xm = db.table(tabname_xm)
+	table_to = db.table(tabname_to)
 
 	for rows in qresult:
 		cell_id  = rows.info.cell_id
@@ -180,33 +251,19 @@ def _xmatch_mapper(qresult, tabname_to, radius, tabname_xm, n_neighbors):
 		(id2, ra2, dec2) = db.query('_ID, _LON, _LAT FROM %s' % tabname_to).fetch_cell(cell_id, include_cached=True).as_columns()
 
 		if len(id2) != 0:
-			# Project to tangent plane around the center of the cell. We
-			# assume the cell is small enough for the distortions not to
-			# matter and Euclidian distances apply
-			bounds, _    = pix.cell_bounds(cell_id)
-			(clon, clat) = bhpix.deproj_bhealpix(*bounds.center())
-			xy1 = np.column_stack(gnomonic(ra1, dec1, clon, clat))
-			xy2 = np.column_stack(gnomonic(ra2, dec2, clon, clat))
-
-			# Construct kD-tree to find an object in table_to that is nearest
-			# to an object in table_from, for every object in table_from
-			tree = kdtree(xy2)
-			match_idxs, match_d2 = tree.knn(xy1, min(n_neighbors, len(xy2)))
-			del tree
+			# Find the objects in table_to nearest to each object
+			# in table_from, within the xmatch radius
+			search = neighbors.for_cell(table_to, cell_id, ra2, dec2, nn)
+			(i1, i2, dist, nr) = neighbors.xmatch(search, ra1, dec1, ra2, dec2, n_neighbors, radius)
 
 			# Create the index table array
-			join.resize(match_idxs.size)
-			for k in xrange(match_idxs.shape[1]):
-				match_idx = match_idxs[:,k]
-				join['_M1'][k::match_idxs.shape[1]]   = id1
-				join['_M2'][k::match_idxs.shape[1]]   = id2[match_idx]
-				join['_DIST'][k::match_idxs.shape[1]] = gc_dist(ra1, dec1, ra2[match_idx], dec2[match_idx])
-				join['_LON'][k::match_idxs.shape[1]]  = ra2[match_idx]
-				join['_LAT'][k::match_idxs.shape[1]]  = dec2[match_idx]
-				join['_NR'][k::match_idxs.shape[1]]   = k
-
-			# Remove matches beyond the xmatch radius
-			join = join[join['_DIST'] < radius]
+			join.resize(len(i1))
+			join['_M1']   = id1[i1]
+			join['_M2']   = id2[i2]
+			join['_DIST'] = dist
+			join['_LON']  = ra2[i2]
+			join['_LAT']  = dec2[i2]
+			join['_NR']   = nr
 
 		if len(join):
 			# compute the cell_id part of the join table's
@@ -262,7 +319,7 @@ xm_table_def = \
 	}
 }
 
-def xmatch(db, tabname_from, tabname_to, radius, neighbors):
+def xmatch(db, tabname_from, tabname_to, radius, n_neighbors, nn=None):
 	""" Cross-match objects from tabname_to with tabname_from table and
 	    store the result into a cross-match table in tabname_from.
 
@@ -271,6 +328,7 @@ def xmatch(db, tabname_from, tabname_to, radius, neighbors):
 
 	   Note:
 	   	- The maximum radius is in _degrees_ (!!)
+	   	- nn selects the neighbor search backend (see neighbors.py)
 	        - No attempt is being made to force the xmatch result to be a
 	          one-to-one map. In particular, more than one object from tabname_from
 	          may be mapped to a same object in tabname_to
@@ -305,7 +363,7 @@ def xmatch(db, tabname_from, tabname_to, radius, neighbors):
 
 	ntot = 0
 	for (nfrom, nto, nmatch) in db.query("_ID, _LON, _LAT from '%s'" % tabname_from).execute(
-					[ (_xmatch_mapper, tabname_to, radius, tabname_xm, neighbors) ],
+					[ (_xmatch_mapper, tabname_to, radius, tabname_xm, n_neighbors, nn) ],
 					progress_callback=pool2.progress_pass):
 		ntot += nmatch
 		if nfrom != 0 and nto != 0:
@@ -295,6 +295,34 @@ def mkdir_p(path):
 		else:
 			raise
 
+_posix_fadvise = None
+
+def fadvise_willneed(fd, offset=0, length=0):
+	""" Advise the kernel that the file (or the given byte range)
+	    will be needed soon, so that it can be read ahead
+	    asynchronously (posix_fadvise(POSIX_FADV_WILLNEED)).
+
+	    Returns False if posix_fadvise is not available on this
+	    platform (e.g., OS X), True otherwise.
+	"""
+	global _posix_fadvise
+	if _posix_fadvise is None:
+		try:
+			import ctypes, ctypes.util
+			libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+			_posix_fadvise = libc.posix_fadvise
+			_posix_fadvise.argtypes = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int ]
+			_posix_fadvise.restype  = ctypes.c_int
+		except (OSError, AttributeError):
+			_posix_fadvise = False
+
+	if not _posix_fadvise:
+		return False
+
+	POSIX_FADV_WILLNEED = 3	# Linux value
+	_posix_fadvise(fd, offset, length, POSIX_FADV_WILLNEED)
+	return True
+
 def chunks(l, n):
 	""" Yield successive n-sized chunks from l.
 	    From http://stackoverflow.com/questions/312443/how-do-you-split-a-list-into-evenly-sized-chunks-in-python
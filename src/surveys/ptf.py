@@ -2,7 +2,7 @@ try:
 	import astropy.io.fits as pyfits
 except ImportError:
 	import pyfits
-import lsd.pool2 as pool2
+import lsd.ingest as ingest
 import numpy as np
 import time
 import astropy.coordinates
@@ -321,9 +321,8 @@ def import_from_catalogs(db, det_tabname, exp_tabname, catalog_files, create=Fal
 
 	t0 = time.time()
 	at = 0; ntot = 0
-	pool = pool2.Pool()
 	explist_file = open('explist.txt','w')
-	for (file, nloaded, error_type, expID) in pool.imap_unordered(catalog_files, import_from_catalogs_aux, (det_table, exp_table, djm, all), progress_callback=pool2.progress_pass):
+	for (file, nloaded, error_type, expID) in ingest.import_parsed(db, catalog_files, (import_from_catalogs_aux, det_table, exp_table, djm, all)):
 		at = at + 1
 		ntot = ntot + nloaded
 		t1 = time.time()
@@ -352,7 +351,6 @@ def import_from_catalogs(db, det_tabname, exp_tabname, catalog_files, create=Fal
 #			if n_collected > 0:
 #				dump_garbage()
 
-	del pool
 	explist_file.close()
 
 def import_from_catalogs_aux(file, det_table, exp_table, djm, all=False):
@@ -361,7 +359,7 @@ def import_from_catalogs_aux(file, det_table, exp_table, djm, all=False):
 	try:
 		hdus = pyfits.open(file)
 	except IOError:
-		yield (file, 0, 1, 0)
+		yield (None, (file, 0, 1, 0))
 	else:
 		dat = hdus[1].data
 		hdr_det = hdus[1].header
@@ -376,7 +374,7 @@ def import_from_catalogs_aux(file, det_table, exp_table, djm, all=False):
 		try:
 			wcs = pywcs.WCS(hdr_exp)
 		except:
-			yield (file, 0, 4, 0)
+			yield (None, (file, 0, 4, 0))
 		else:
 			# import header data into exposures table
 			try:
@@ -386,7 +384,7 @@ def import_from_catalogs_aux(file, det_table, exp_table, djm, all=False):
 				exp_cols.update(dict( (name, np.array([0]).astype(coltype)) for (name, coltype, fitsname, _) in coldefs if fitsname != ''))
 				exp_cols.update(dict( (name, np.array([hdr_exp.get(fitsname)]).astype(coltype)) for (name, coltype, fitsname, _) in coldefs if (fitsname != '') & (hdr_exp.has_key(fitsname))))
 			except TypeError:
-				yield (file, 0, 2, 0)
+				yield (None, (file, 0, 2, 0))
 			else:
 				# find the RA and Dec for the center of this exposure
 				pixcrd = np.array([[1024,2048]], np.float_)
@@ -409,7 +407,7 @@ def import_from_catalogs_aux(file, det_table, exp_table, djm, all=False):
 					else:
 						det_cols = dict(( (name, dat.field(fitsname).astype(coltype[-2:])) for (name, coltype, _, _, fitsname, _) in coldefs if fitsname != ''))
 				except TypeError:
-					yield (file, 0, 3, 0)
+					yield (None, (file, 0, 3, 0))
 				else:
 					det_cols['mjd'] = (np.zeros(len(det_cols['ra'])) + hdr_exp['OBSMJD']).astype('f8')
 					det_cols['fid'] = (np.zeros(len(det_cols['ra'])) + hdr_exp['DBFID']).astype('u1')
@@ -430,7 +428,7 @@ def import_from_catalogs_aux(file, det_table, exp_table, djm, all=False):
 				exp_cols.update(dict( (name, np.array([0]).astype(coltype)) for (name, coltype, fitsname, _) in coldefs if fitsname != ''))
 				exp_cols.update(dict( (name, np.array([hdr_exp.get(fitsname)]).astype(coltype)) for (name, coltype, fitsname, _) in coldefs if (fitsname != '') & (hdr_exp.has_key(fitsname))))
 			except TypeError:
-				yield (file, 0, 2, 0)
+				yield (None, (file, 0, 2, 0))
 			else:
 				# find the RA and Dec for the center of this exposure
 				pixcrd = np.array([[1024,2048]], np.float_)
@@ -453,7 +451,7 @@ def import_from_catalogs_aux(file, det_table, exp_table, djm, all=False):
 					else:
 						det_cols = dict(( (name, dat.field(fitsname).astype(coltype[-2:])) for (name, coltype, _, _, fitsname, _) in coldefs if fitsname != ''))
 				except TypeError:
-					yield (file, 0, 3, 0)
+					yield (None, (file, 0, 3, 0))
 				else:
 					det_cols['mjd'] = (np.zeros(len(det_cols['ra'])) + hdr_exp['OBSMJD']).astype('f8')
 					det_cols['fid'] = (np.zeros(len(det_cols['ra'])) + hdr_exp['DBFID']).astype('u1')
@@ -474,11 +472,14 @@ def import_from_catalogs_aux(file, det_table, exp_table, djm, all=False):
 							exp_cols['mumax_rms'] = np.array([mumax_rms]).astype('f4')
 							exp_cols['n_bright'] = np.array([len(bright[0])]).astype('i2')
 
+					# The exposure is appended right away, as its ID is
+					# needed to fill in the detections; these are passed
+					# on to be appended by cell (see lsd.ingest)
 					(exp_id,) = exp_table.append(exp_cols)
 					det_cols['exp_id'] = (np.zeros(len(det_cols['ra'])) + hdr_exp['DBPID']).astype('u8')
 					det_cols['exp_id'][:] = exp_id
-					ids = det_table.append(det_cols)
-					yield (file, len(ids), 0, exp_id)
+					yield (det_table.name, det_cols)
+					yield (None, (file, len(det_cols['exp_id']), 0, exp_id))
 
 
 if __name__ == '__main__':